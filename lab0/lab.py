@@ -38,32 +38,117 @@ def set_pixel(image, x, y, c):
     """
     image['pixels'][x+(image['width']*y)] = c
 
-def apply_per_pixel(image, func):
-    result = {
+def pack_pixels(values):
+    """
+    Return the pixel values as a bytearray if they are all integers in the
+    range [0, 255], and as a list otherwise.
+    """
+    try:
+        return bytearray(values)
+    except (TypeError, ValueError):
+        return list(values)
+
+def byte_pixels(image):
+    """
+    Return True if every pixel of the greyscale image is an integer in the
+    range [0, 255] (so that pack_pixels would make a bytearray of them),
+    without copying the pixels.
+    """
+    pixels = image['pixels']
+    return (isinstance(pixels, (bytes, bytearray))
+            or all(isinstance(c, int) and 0 <= c <= 255 for c in pixels))
+
+def compact_image(image):
+    """
+    Return a copy of the image whose pixels are stored as a bytearray, if
+    they are all integers in the range [0, 255].
+    """
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': pack_pixels(image['pixels']),
+        }
+
+def image_as_lists(image):
+    """
+    Return a copy of the image whose pixels are stored in a plain list (of
+    numbers, or of (r, g, b) tuples for color images), the representation
+    used before pixels were kept in byte buffers.
+    """
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': list(image['pixels']),
+        }
+
+def apply_per_pixel(image, func, lut=None):
+    """
+    Return a new image whose pixels are func applied to each pixel of the
+    given image.  8-bit images have only 256 possible pixel values, so func
+    is called once for each of them to make a lookup table (see make_lut;
+    lut, if given, is that table made in advance), which is then applied to
+    the whole image at once; other images call func on every pixel, in
+    row-major order.
+    """
+    if byte_pixels(image):
+        return apply_lut(image, make_lut(func) if lut is None else lut)
+    return {
         'height': image['height'],
         'width': image['width'],
-        'pixels': ([0]*len(image['pixels'])),
+        'pixels': pack_pixels([func(c) for c in image['pixels']]),
         }
+
+def make_lut(func):
+    """
+    Return the lookup table of a point operation: entry c is func(c), for
+    every 8-bit pixel value c.  The table is a bytearray if every entry is
+    an integer in [0, 255], and a list otherwise.
     """
-    Get inverted image pixels
-    """
-    # iterate over the loop
-    for x in range(result['width']):
-        for y in range(result['height']):
-            # get pixel from image at location x,y
-             color = get_pixel(image, x, y)
-             # generate new color
-             newcolor = func(color)
-             # set the new pixel in result at location x,y
-             set_pixel(result, x, y, newcolor)
+    return pack_pixels([func(c) for c in range(256)])
+
+def compose_luts(*luts):
+    """
+    Return a single lookup table with the same effect as applying the given
+    tables one after the other, first to last.  Every table but the last
+    must map into [0, 255].
+    """
+    result = bytearray(range(256))
+    for lut in luts:
+        if not isinstance(result, bytearray):
+            raise ValueError('only the last lookup table may map outside [0, 255]')
+        if isinstance(lut, (bytes, bytearray)):
+            result = result.translate(lut)
+        else:
+            result = pack_pixels([lut[c] for c in result])
     return result
 
+def apply_lut(image, lut):
+    """
+    Return a new image whose pixels are lut[c] for each pixel c of the given
+    8-bit image.  Pixels already in a bytearray are used as they are;
+    others are packed into one first.
+    """
+    pixels = image['pixels']
+    if not isinstance(pixels, bytearray):
+        pixels = pack_pixels(pixels)
+        if not isinstance(pixels, bytearray):
+            raise ValueError('lookup tables apply only to 8-bit images')
+    if isinstance(lut, (bytes, bytearray)):
+        pixels = pixels.translate(lut)
+    else:
+        pixels = pack_pixels([lut[c] for c in pixels])
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': pixels,
+        }
+
 def inverted(image):
     return apply_per_pixel(image, lambda c: 255-c)
 
 # HELPER FUNCTIONS
     
-def correlate(image, kernel):
+def correlate(image, kernel, exact=False):
     """
     Compute the result of correlating the given image with the given kernel.
 
@@ -75,29 +160,435 @@ def correlate(image, kernel):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
 
-    DESCRIBE YOUR KERNEL REPRESENTATION HERE
+    The kernel is a list of n rows, each a list of n numbers, centered on the
+    pixel being computed, or a kernel already prepared by compile_kernel.
+    Box kernels (every entry the same) are computed from running window
+    sums, so their cost does not depend on n; other separable integer
+    kernels are computed as a horizontal pass followed by a vertical pass;
+    any other kernel goes through correlate_general, which adds the taps in
+    the same order as correlate_pixel (two passes would round float sums
+    differently).
+
+    Integer kernels on integer pixels are summed entirely in integers.  By
+    default a box kernel of 1/d entries reproduces the rounding of a float
+    sum taken tap by tap; with exact=True (and integer pixels) its results
+    are instead the integer window sum divided once by d, so the rounding of
+    those results is exact.
+    """
+    kernel = compile_kernel(kernel)
+    if kernel['box'] is not None:
+        return correlate_box(image, kernel['size'], kernel['box'], exact=exact)
+    if kernel['separable'] is not None:
+        column, row = kernel['separable']
+        return correlate_separable(image, column, row)
+    return correlate_general(image, kernel)
+
+def compile_kernel(kernel):
+    """
+    Prepare a kernel (a list of rows) for correlate, returning a dictionary
+    with:
+        'rows': the kernel entries, as a tuple of tuples
+        'size', 'radius': the number of rows and the distance from the
+            center row to the top row
+        'extent': how far the kernel reaches (up, down, left, right)
+        'taps': the non-zero entries as (row offset, column offset, value),
+            in row-major order
+        'box': the common value of every entry of a box kernel, or None
+        'separable': integer (column, row) factors of a rank-1 integer
+            kernel, or None
+        'integer': True if every entry is an integer
+        'gain': the sum of the absolute values of the entries, which bounds
+            how much larger than the pixels the results can be
+    ('integer' and 'gain' let backend.py and parallel.py size integer
+    buffers.)
+    A kernel that is already compiled is returned unchanged.
+    """
+    if isinstance(kernel, dict):
+        return kernel
+    rows = tuple(tuple(row) for row in kernel)
+    n = len(rows)
+    dis = n//2
+    width = max([len(row) for row in rows] + [0])
+    integer = all(isinstance(k, int) for row in rows for k in row)
+    return {
+        'rows': rows,
+        'size': n,
+        'radius': dis,
+        'extent': (dis, max(n-1-dis, 0), dis, max(width-1-dis, 0)),
+        'taps': [(i-dis, z-dis, rows[i][z]) for i in range(n)
+                 for z in range(len(rows[i])) if rows[i][z]],
+        'box': box_kernel_value(rows),
+        'separable': separate_kernel(rows) if integer else None,
+        'integer': integer,
+        'gain': sum(abs(k) for row in rows for k in row),
+    }
+
+# compiled kernels by (kind, size), least recently used first
+KERNEL_CACHE = {}
+KERNEL_CACHE_SIZE = 64
+
+def cached_kernel(kind, n):
+    """
+    Return the compiled kernel of the given kind ('box' for box_blur(n)) and
+    size, compiling it only if it is not among the KERNEL_CACHE_SIZE most
+    recently used ones.
+    """
+    key = (kind, n)
+    if key in KERNEL_CACHE:
+        kernel = KERNEL_CACHE.pop(key)
+    else:
+        kernel = compile_kernel(KERNEL_KINDS[kind](n))
+        if len(KERNEL_CACHE) >= KERNEL_CACHE_SIZE:
+            del KERNEL_CACHE[next(iter(KERNEL_CACHE))]
+    # (re-)insert as the most recently used
+    KERNEL_CACHE[key] = kernel
+    return kernel
+
+def correlate_pixel(image, kernel, x, y):
+    """
+    Return the correlation of the kernel with the image at (x, y), summing
+    the kernel entries row by row.
     """
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': ([0]*len(image['pixels'])),
-        }
-    #distance from center to edge of kernal
     dis = len(kernel)//2
-    #iterate over every pixel in image
-    for x in range(image['width']):
-        for y in range(image['height']):
-            cor = 0;
-            for i in range(len(kernel)):
-                for z in range(len(kernel[i])):
-                    # input pixel's value multiplied by the associated value
-                    # in the kernel
-                    # get pixel from image at location x-dis+z, y-dis+i * kernel[i][z]
-                    cor += get_pixel_outRange(image, x-dis+z, y-dis+i) * kernel[i][z]
-            set_pixel(result, x, y, cor)
-    return result
-    raise NotImplementedError
+    cor = 0
+    for i in range(len(kernel)):
+        for z in range(len(kernel[i])):
+            cor += get_pixel_outRange(image, x-dis+z, y-dis+i) * kernel[i][z]
+    return cor
 
+def box_kernel_value(kernel):
+    """
+    Return the common value of every entry if the kernel is a square box
+    kernel whose value is an integer or 1/d for an integer d, or None
+    otherwise.  Multiplying a window sum by any other value can round
+    differently from adding the taps one by one, so those kernels are left
+    to correlate_general.
+    """
+    n = len(kernel)
+    if n == 0 or any(len(row) != n for row in kernel):
+        return None
+    value = kernel[0][0]
+    for row in kernel:
+        for k in row:
+            if k != value:
+                return None
+    if not isinstance(value, int) and box_divisor(value) is None:
+        return None
+    return value
+
+def box_divisor(value):
+    """
+    Return the integer d such that value == 1/d, or None if there is none.
+    """
+    if not value:
+        return None
+    d = round(1/value)
+    return d if d and 1/d == value else None
+
+def separate_kernel(kernel):
+    """
+    If the square kernel is separable (every row is a multiple of one row),
+    return (column, row) such that kernel[i][j] == column[i] * row[j] exactly;
+    otherwise return None.  Integer kernels are split into integer factors.
+    """
+    n = len(kernel)
+    if n == 0 or any(len(row) != n for row in kernel):
+        return None
+    # pivot on the non-zero entry of smallest magnitude so that integer
+    # kernels such as Sobel divide exactly
+    pivot = None
+    for i in range(n):
+        for j in range(n):
+            k = kernel[i][j]
+            if k and (pivot is None or abs(k) < abs(kernel[pivot[0]][pivot[1]])):
+                pivot = (i, j)
+    if pivot is None:
+        return None
+    row = list(kernel[pivot[0]])
+    p = kernel[pivot[0]][pivot[1]]
+    if all(isinstance(k, int) for r in kernel for k in r):
+        if any(kernel[i][pivot[1]] % p for i in range(n)):
+            return None
+        column = [kernel[i][pivot[1]] // p for i in range(n)]
+    else:
+        column = [kernel[i][pivot[1]] / p for i in range(n)]
+    for i in range(n):
+        for j in range(n):
+            if column[i] * row[j] != kernel[i][j]:
+                return None
+    return column, row
+
+def image_rows(image):
+    """
+    Return the rows of the image as a list of lists of pixel values.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    return [list(pixels[y*w:(y+1)*w]) for y in range(image['height'])]
+
+def extend_row(row, before, after):
+    """
+    Return the row extended by repeating its first value `before` times and
+    its last value `after` times (the edge behaviour of get_pixel_outRange).
+    """
+    return [row[0]]*before + row + [row[-1]]*after
+
+def clamp(v, low, high):
+    """
+    Return v limited to the range [low, high].
+    """
+    if v < low:
+        return low
+    if v > high:
+        return high
+    return v
+
+def correlate_separable(image, column, row):
+    """
+    Correlate the image with the kernel whose entries are column[i] * row[j]:
+    first every row with `row`, then every column of that result with
+    `column`.  Zero weights are skipped.
+    """
+    w = image['width']
+    h = image['height']
+    n = len(row)
+    dis = n//2
+    # horizontal pass
+    rows = []
+    for r in image_rows(image):
+        ext = extend_row(r, dis, n-1-dis)
+        acc = [0]*w
+        for j in range(n):
+            if row[j]:
+                k = row[j]
+                acc = [a + k*p for a, p in zip(acc, ext[j:j+w])]
+        rows.append(acc)
+    # vertical pass
+    pixels = []
+    for y in range(h):
+        acc = [0]*w
+        for i in range(n):
+            if column[i]:
+                k = column[i]
+                src = rows[clamp(y-dis+i, 0, h-1)]
+                acc = [a + k*p for a, p in zip(acc, src)]
+        pixels.extend(acc)
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+def correlate_box(image, n, value, table=None, exact=False):
+    """
+    Correlate the image with the n-by-n kernel whose entries all equal value.
+    Window sums come from running sums over the rows (see running_box_sums)
+    or, if table is given (it must be summed_area_table(image), shared by
+    several box sizes), from that table, so the cost per pixel is
+    independent of n.  exact is as
+    for correlate.  Values that are neither integers nor 1/d for an integer
+    d go through correlate_general instead (see box_kernel_value).
+    """
+    if not isinstance(value, int) and box_divisor(value) is None:
+        return correlate_general(image, [[value]*n]*n)
+    pixels = []
+    for row in box_rows(image, n, value, table, exact):
+        pixels.extend(row)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+def box_rows(image, n, value, table=None, exact=False):
+    """
+    Yield the rows of correlate_box(image, n, value, table, exact) one at a
+    time, from top to bottom, so that a caller can combine each row with the
+    image before the next one is computed.
+    """
+    if table is not None:
+        window_sums = box_sums(table, n)
+    else:
+        window_sums = running_box_sums(image, n)
+    d = box_divisor(value)
+    if exact and d is not None and d != 1 and (table is not None or integer_pixels(image)):
+        # one correctly rounded division of the exact integer sum (with
+        # d == 1 the sums below are already exact, and stay integers for
+        # an integer kernel)
+        for acc in window_sums:
+            yield [a / d for a in acc]
+        return
+    # a window sum that is exactly halfway between two multiples of 1/value
+    # would be rounded according to the float error of a tap-by-tap sum, so
+    # those few pixels are recomputed in that order
+    half = d//2 if d is not None and d % 2 == 0 else None
+    for y, acc in enumerate(window_sums):
+        row = [a*value for a in acc]
+        if half is not None:
+            for x in [x for x, a in enumerate(acc) if a % d == half]:
+                row[x] = correlate_pixel(image, [[value]*n]*n, x, y)
+        yield row
+
+def running_box_sums(image, n):
+    """
+    Yield the sums of the n-by-n windows centered on the pixels of each row
+    (beyond the edges, pixels are those of the nearest edge), keeping running
+    sums (one value in, one value out per step) in both directions.  Only
+    the horizontal sums of the rows in the current window are kept.
+    """
+    w = image['width']
+    h = image['height']
+    pixels = image['pixels']
+    dis = n//2
+    sums = {}
+    def horizontal(y):
+        # horizontal window sums of row y (clamped to the image)
+        y = clamp(y, 0, h-1)
+        if y not in sums:
+            ext = extend_row(list(pixels[y*w:(y+1)*w]), dis, n-1-dis)
+            s = sum(ext[:n])
+            row = [s]
+            for x in range(w-1):
+                s += ext[x+n] - ext[x]
+                row.append(s)
+            sums[y] = row
+        return sums[y]
+    # vertical window sums, moving the window down one row at a time
+    acc = [0]*w
+    for i in range(n):
+        acc = [a + b for a, b in zip(acc, horizontal(i-dis))]
+    for y in range(h):
+        yield acc
+        if y < h-1:
+            new = horizontal(y+n-dis)
+            old = horizontal(y-dis)
+            acc = [a + b - c for a, b, c in zip(acc, new, old)]
+            # rows above the next window are not needed again
+            for k in [k for k in sums if k <= y-dis]:
+                del sums[k]
+
+def integer_pixels(image):
+    """
+    Return True if every pixel of the greyscale image is an integer.
+    """
+    pixels = image['pixels']
+    return isinstance(pixels, (bytes, bytearray)) or all(isinstance(p, int) for p in pixels)
+
+# SUMMED-AREA TABLES
+
+def summed_area_table(image):
+    """
+    Return the summed-area table of a greyscale image, built in one pass:
+    a dictionary with the 'width' and 'height' of the image and 'rows', in
+    which rows[y][x] is the sum of the pixels above and to the left of
+    (x, y), so that the sum of any rectangle takes four lookups.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    rows = [[0]*(w+1)]
+    for y in range(image['height']):
+        # running sum along the row, added to the row above
+        s = 0
+        row = [0]
+        for p in pixels[y*w:(y+1)*w]:
+            s += p
+            row.append(s)
+        rows.append([a + b for a, b in zip(rows[-1], row)])
+    return {'width': w, 'height': image['height'], 'rows': rows}
+
+def extended_table_row(table, y):
+    """
+    Return row y of the summed-area table of the image extended beyond its
+    top and bottom edges as in get_pixel_outRange (for y < 0, the negated
+    sum of the -y rows above the image).  Each extra row repeats an edge
+    row, so outside the table the rows grow linearly.
+    """
+    rows = table['rows']
+    h = table['height']
+    if y < 0:
+        return [y*v for v in rows[1]]
+    if y > h:
+        k = y - h
+        return [a + k*(a - b) for a, b in zip(rows[h], rows[h-1])]
+    return rows[y]
+
+def extended_prefix(row, w, x):
+    """
+    Return entry x of a row of a summed-area table of width w, extended
+    beyond the left and right edges in the same way as extended_table_row.
+    """
+    if x < 0:
+        return x*row[1]
+    if x > w:
+        return row[w] + (x - w)*(row[w] - row[w-1])
+    return row[x]
+
+def rectangle_sum(table, x0, y0, x1, y1):
+    """
+    Return the sum of the pixels (x, y) with x0 <= x < x1 and y0 <= y < y1
+    of the image whose summed-area table is given, where the pixels beyond
+    the edges are those of get_pixel_outRange, in constant time.
+    """
+    w = table['width']
+    top = extended_table_row(table, y0)
+    bottom = extended_table_row(table, y1)
+    return (extended_prefix(bottom, w, x1) - extended_prefix(bottom, w, x0)
+            - extended_prefix(top, w, x1) + extended_prefix(top, w, x0))
+
+def box_sums(table, n):
+    """
+    Yield, for each row of the image whose summed-area table is given, the
+    sums of the n-by-n windows centered on its pixels (the same as
+    running_box_sums), four table entries per pixel.
+    """
+    w = table['width']
+    h = table['height']
+    dis = n//2
+    rows = {}
+    def extended(y):
+        # row y of the table, extended left and right far enough for every
+        # window; index i holds entry i-dis
+        row = extended_table_row(table, y)
+        return ([x*row[1] for x in range(-dis, 0)] + row
+                + [row[w] + k*(row[w] - row[w-1]) for k in range(1, n-dis)])
+    for y in range(h):
+        top = rows.pop(y-dis) if y-dis in rows else extended(y-dis)
+        bottom = extended(y-dis+n)
+        rows[y-dis+n] = bottom
+        diff = [b - t for b, t in zip(bottom, top)]
+        yield [b - a for a, b in zip(diff, diff[n:])]
+
+def correlate_general(image, kernel):
+    """
+    Correlate the image with an arbitrary kernel.  For pixels whose whole
+    window lies inside the image, each kernel entry is applied to a slice of
+    the flat pixel list at a fixed offset from the row start; only the border
+    band, where the window leaves the image, clamps coordinates to the
+    nearest edge pixel (through precomputed row and column offset tables).
+    """
+    w = image['width']
+    h = image['height']
+    pixels = image['pixels']
+    kernel = compile_kernel(kernel)
+    taps = kernel['taps']
+    top, bottom, left, right = kernel['extent']
+    result = [0]*(w*h)
+    # interior: the window never leaves the image
+    x0 = left
+    x1 = w - right
+    if x1 > x0:
+        for y in range(top, h-bottom):
+            acc = [0]*(x1-x0)
+            for dy, dz, k in taps:
+                start = (y+dy)*w + x0 + dz
+                acc = [a + p*k for a, p in zip(acc, pixels[start:start+x1-x0])]
+            result[y*w+x0:y*w+x1] = acc
+    # border band: clamp through the offset tables
+    row_offset = [clamp(y, 0, h-1)*w for y in range(-top, h+bottom)]
+    col_offset = [clamp(x, 0, w-1) for x in range(-left, w+right)]
+    for y in range(h):
+        if top <= y < h-bottom and x1 > x0:
+            xs = list(range(x0)) + list(range(x1, w))
+        else:
+            xs = range(w)
+        for x in xs:
+            cor = 0
+            for dy, dz, k in taps:
+                cor += pixels[row_offset[y+dy+top] + col_offset[x+dz+left]] * k
+            result[y*w+x] = cor
+    return {'height': h, 'width': w, 'pixels': result}
 
 def round_and_clip_image(image):
     """
@@ -109,99 +600,140 @@ def round_and_clip_image(image):
     Any locations with values higher than 255 in the input should have value
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
+
+    The clipped values are stored back into the dictionary as a bytearray
+    (one byte per pixel).
     """
-    for i in range(len(image['pixels'])):
-            image['pixels'][i] = int(round(image['pixels'][i]))
-            if image['pixels'][i] < 0:
-                image['pixels'][i] = 0
-            elif image['pixels'][i] > 255:
-                image['pixels'][i] = 255
+    clipped = bytearray(len(image['pixels']))
+    for i, c in enumerate(image['pixels']):
+        c = int(round(c))
+        if c < 0:
+            c = 0
+        elif c > 255:
+            c = 255
+        clipped[i] = c
+    image['pixels'] = clipped
 
 # FILTERS
 
-def blurred(image, n):
+def blurred(image, n, table=None, exact=False):
     """
     Return a new image representing the result of applying a box blur (with
     kernel size n) to the given input image.
 
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
+
+    table, if given, is summed_area_table(image), which can be shared by
+    blurs of several sizes (see blurred_sizes).  With exact=True, pixels are
+    the exact mean of their window rounded half to even, rather than the
+    rounding of a float sum (see correlate).
     """
     # first, create a representation for the appropriate n-by-n kernel (you may
     # wish to define another helper function for this)
-    box_blurred = box_blur(n)
+    box_blurred = cached_kernel('box', n)
     # then compute the correlation of the input image with that kernel
-    result = correlate(image, box_blurred)
+    result = correlate_box(image, n, box_blurred['box'], table, exact)
     # and, finally, make sure that the output is a valid image (using the
     # helper function from above) before returning it.
     round_and_clip_image(result)
     return result
 
+def blurred_sizes(image, sizes, exact=False):
+    """
+    Return blurred(image, n, exact=exact) for each n in sizes, all computed
+    from one summed-area table of the image.
+    """
+    table = summed_area_table(image) if integer_pixels(image) else None
+    return [blurred(image, n, table, exact) for n in sizes]
+
 def box_blur(n):
     """
     create a representation for the appropriate n-by-n kernel, and return it
     """
-    kernel = []
-    # generate an n-by-n kernel
-    for i in range(n):
-        # generate an empty row list
-        row = []
-        for j in range(n):
-            # n-by-n square of dentical values that sum to 1
-            row.append(1/n**2)
-        kernel.append(row)
-    return kernel
+    # n-by-n square of identical values that sum to 1
+    value = 1/n**2
+    return [[value]*n for i in range(n)]
+
+KERNEL_KINDS = {
+    'box': box_blur,
+}
 
-def sharpened(i, n):
+def sharpened(i, n, exact=False, table=None):
     """
     Returns a new image, the result of an "unsharp mask" on self.
     n is the size of box blur kernel
+
+    The blurred copy is never stored: each row of it comes from the running
+    window sums of the box blur (see running_box_sums), is combined with the
+    same row of the image and is rounded and clipped straight into the
+    output buffer.  With exact=True (and integer pixels), each pixel is
+    computed as (2*d*p - sum) / d with a single division, so it is rounded
+    exactly.  table is as for blurred.
     """
-    result = {
-        'height': i['height'],
-        'width': i['width'],
-        'pixels': ([0]*len(i['pixels'])),
-        }
-    # generate the blurred copy of the image
-    blurred = correlate(i, box_blur(n))
-    # iterate over loop and use blurred image do calculation
-    for x in range(i['width']):
-        for y in range(i['height']):
-            # value of sharpened image =
-            # 2 * image at location (x,y) - blurred image at location (x,y)
-            c = 2 * get_pixel(i, x, y)-get_pixel(blurred, x, y)
-            set_pixel(result, x, y, c)
-    # ensure that the final image is made up of integer pixels in range [0,255]
-    round_and_clip_image(result)
-    return result
+    w = i['width']
+    pixels = i['pixels']
+    result = bytearray(len(pixels))
+    if exact and (table is not None or integer_pixels(i)):
+        d = n*n
+        window_sums = box_sums(table, n) if table is not None else running_box_sums(i, n)
+        rows = ([round((2*d*p - s) / d) for p, s in zip(pixels[y*w:(y+1)*w], sums)]
+                for y, sums in enumerate(window_sums))
+    else:
+        value = cached_kernel('box', n)['box']
+        # value of sharpened image =
+        # 2 * image at location (x,y) - blurred image at location (x,y)
+        rows = ([round(2*p - b) for p, b in zip(pixels[y*w:(y+1)*w], blurred_row)]
+                for y, blurred_row in enumerate(box_rows(i, n, value, table)))
+    for y, row in enumerate(rows):
+        # ensure that the final image is made up of integer pixels in range [0,255]
+        result[y*w:(y+1)*w] = bytes([0 if c < 0 else 255 if c > 255 else c for c in row])
+    return {'height': i['height'], 'width': w, 'pixels': result}
 
 def edges(im):
+    """
+    Return a new image containing the magnitude of the Sobel gradient of the
+    given image, rounded and clipped to [0, 255].
+
+    Kx and Ky are separable, so each output row only needs the three
+    (edge-extended) input rows around it: their vertical [1, 2, 1] sum and
+    [-1, 0, 1] difference give Ox and Oy for the whole row, and the
+    magnitude is rounded and clipped right away.  The rows are kept in a
+    rolling window, so no full-size Ox, Oy or unclipped image is built.
+    """
+    w = im['width']
+    h = im['height']
+    pixels = im['pixels']
+    integral = isinstance(pixels, (bytes, bytearray)) or all(isinstance(p, int) for p in pixels)
     result = {
-        'height': im['height'],
-        'width': im['width'],
-        'pixels': ([0]*len(im['pixels'])),
+        'height': h,
+        'width': w,
+        'pixels': bytearray(w*h),
     }
-    # Initialize two kernels: Kx and Ky
-    Kx = [[-1, 0, 1],
-          [-2, 0, 2],
-          [-1, 0, 1]]
-    Ky = [[-1, -2, -1],
-          [0, 0, 0],
-          [1, 2, 1]]
-    # computing Ox and Oy by correlating the input with Kx and Ky respectively
-    Ox = correlate(im, Kx)
-    Oy = correlate(im, Ky)
-    # loop over pixels
-    for x in range(im['width']):
-        for y in range(im['height']):
-            # do calculations
-            # c is the root of the sum of squares of corresponding pixels in Ox and Oy
-            c = ((get_pixel(Ox, x, y))**2 + (get_pixel(Oy, x, y))**2)**0.5
-            set_pixel(result, x, y, c)
-    # ensure that the final image is made up of integer pixels in range [0,255]
-    round_and_clip_image(result)
+    def extended_row(y):
+        y = clamp(y, 0, h-1)
+        return extend_row(list(pixels[y*w:(y+1)*w]), 1, 1)
+    above = extended_row(-1)
+    here = extended_row(0)
+    for y in range(h):
+        below = extended_row(y+1)
+        smooth = [a + 2*b + c for a, b, c in zip(above, here, below)]
+        diff = [c - a for a, c in zip(above, below)]
+        ox = [r - l for l, r in zip(smooth, smooth[2:])]
+        oy = [l + 2*m + r for l, m, r in zip(diff, diff[1:], diff[2:])]
+        squares = [gx*gx + gy*gy for gx, gy in zip(ox, oy)]
+        if integral:
+            row = [SOBEL_MAGNITUDE[s] if s < 65281 else 255 for s in squares]
+        else:
+            row = [min(255, max(0, int(round(s**0.5)))) for s in squares]
+        result['pixels'][y*w:(y+1)*w] = bytes(row)
+        above, here = here, below
     return result
 
+# rounded square root of every integer below 255.5**2, the largest squared
+# Sobel magnitude that does not clip to 255
+SOBEL_MAGNITUDE = bytes(round(s**0.5) for s in range(65281))
+
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
 def load_image(filename):
@@ -209,25 +741,55 @@ def load_image(filename):
     Loads an image from the given file and returns a dictionary
     representing that image.  This also performs conversion to greyscale.
 
+    The pixels are returned as a bytearray (one byte per pixel).
+
     Invoked as, for example:
        i = load_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
         if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
+            if img.mode != 'RGB':
+                img = Image.merge('RGB', img.split()[:3])
+            pixels = luma_from_pil(img)
         elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
+            pixels = bytearray(img.getchannel(0).tobytes())
         elif img.mode == 'L':
-            pixels = list(img_data)
+            pixels = bytearray(img.tobytes())
         else:
             raise ValueError('Unsupported image mode: %r' % img.mode)
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
 
+def luma_from_pil(img):
+    """
+    Return round(.299 * r + .587 * g + .114 * b) for every pixel of a PIL
+    image in mode 'RGB', as a bytearray.
+
+    PIL converts with a matrix by adding 0.5 and truncating, so converting
+    with the same weights plus and minus 0.0005 brackets the exact value:
+    both agree unless 299*r + 587*g + 114*b ends in exactly 500, where the
+    floating point expression can round either way.  Only those pixels are
+    computed in Python.
+    """
+    up = img.convert('L', (.299, .587, .114, .0005)).tobytes()
+    down = img.convert('L', (.299, .587, .114, -.0005)).tobytes()
+    pixels = bytearray(up)
+    if up != down:
+        # every byte of up is that of down or one more, so this subtraction
+        # never borrows and leaves a 1 exactly at the halfway pixels
+        halves = (int.from_bytes(up, 'little')
+                  - int.from_bytes(down, 'little')).to_bytes(len(up), 'little')
+        w = img.size[0]
+        i = halves.find(1)
+        while i >= 0:
+            r, g, b = img.getpixel((i % w, i // w))
+            pixels[i] = round(.299 * r + .587 * g + .114 * b)
+            i = halves.find(1, i+1)
+    return pixels
+
+
 def save_image(image, filename, mode='PNG'):
     """
     Saves the given image to disk or to a file-like object.  If filename is
@@ -235,8 +797,13 @@ def save_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    size = (image['width'], image['height'])
+    try:
+        # bytes() takes byte buffers and lists of integers in [0, 255]
+        out = Image.frombytes('L', size, bytes(image['pixels']))
+    except (TypeError, ValueError):
+        out = Image.new(mode='L', size=size)
+        out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -4,6 +4,7 @@ import os
 import lab
 import pickle
 import hashlib
+import tempfile
 import unittest
 
 TEST_DIRECTORY = os.path.dirname(__file__)
@@ -48,6 +49,17 @@ class TestImage(Lab0Test):
         }
         self.compare_images(result, expected)
 
+    def test_compact_round_trip(self):
+        im = lab.load_image('test_images/chess.png')
+        self.assertIsInstance(im['pixels'], bytearray)
+        as_lists = lab.image_as_lists(im)
+        self.assertIsInstance(as_lists['pixels'], list)
+        self.compare_images(lab.compact_image(as_lists), im)
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, 'out.png')
+            lab.save_image(as_lists, outfile)
+            self.compare_images(lab.load_image(outfile), im)
+
 
 class TestInverted(Lab0Test):
     def test_inverted_1(self):
@@ -102,6 +114,47 @@ class TestInverted(Lab0Test):
         result = lab.inverted(im)
         lab.save_image(result, '/Users/yaxinliu/Downloads/lab0/InvertedImage.png')
 
+    def test_lookup_tables(self):
+        im = lab.load_image('test_images/mushroom.png')
+        invert = lab.make_lut(lambda c: 255-c)
+        darken = lab.make_lut(lambda c: c//2)
+        both = lab.compose_luts(invert, darken)
+        expected = [(255-c)//2 for c in im['pixels']]
+        self.assertEqual(list(lab.apply_lut(im, both)['pixels']), expected)
+        self.assertEqual(list(lab.apply_lut(lab.apply_lut(im, invert), darken)['pixels']), expected)
+        self.assertEqual(lab.compose_luts(invert, invert), bytearray(range(256)))
+        # tables may map outside [0, 255] only as the last step
+        scaled = lab.compose_luts(invert, lab.make_lut(lambda c: c/255))
+        self.assertEqual(scaled[0], 1.0)
+        with self.assertRaises(ValueError):
+            lab.compose_luts(lab.make_lut(lambda c: c/255), invert)
+        # non 8-bit images are still mapped pixel by pixel
+        floats = {'height': 1, 'width': 3, 'pixels': [0.5, 300, -2]}
+        self.assertEqual(lab.apply_per_pixel(floats, lambda c: c*2)['pixels'], [1.0, 600, -4])
+        with self.assertRaises(ValueError):
+            lab.apply_lut(floats, invert)
+        # 8-bit pixels in a list go through the table and come back as bytes
+        small = {'height': 1, 'width': 3, 'pixels': [0, 7, 255]}
+        result = lab.apply_per_pixel(small, lambda c: 255-c)
+        self.assertEqual(result['pixels'], bytearray([255, 248, 0]))
+        self.assertEqual(small['pixels'], [0, 7, 255])
+
+    def test_luma_matches_float(self):
+        from PIL import Image
+        # colors where .299*r + .587*g + .114*b is exactly halfway between
+        # two integers, and their neighbours
+        pixels = [(r, g, b+d) for r in range(0, 256, 3) for g in range(256)
+                  for b in range(256) if (299*r + 587*g + 114*b) % 1000 == 500
+                  for d in (-1, 0, 1) if 0 <= b+d <= 255]
+        img = Image.new('RGB', (len(pixels), 1))
+        img.putdata(pixels)
+        expected = [round(.299 * r + .587 * g + .114 * b) for r, g, b in pixels]
+        self.assertEqual(list(lab.luma_from_pil(img)), expected)
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, 'halves.png')
+            img.save(outfile)
+            self.assertEqual(list(lab.load_image(outfile)['pixels']), expected)
+
 class TestCorrelate(Lab0Test):
     def test_correlate_1(self):
         kernel = [[0, 0, 0],
@@ -151,6 +204,18 @@ class TestCorrelate(Lab0Test):
             }
         self.compare_images(result, expected)
 
+    def test_correlate_border(self):
+        kernel = [[-2, -1, 0],
+                  [-1, 1, 1],
+                  [0, 1, 2.5]]
+        for fname in ('pattern', 'centered_pixel'):
+            im = lab.load_image('test_images/%s.png' % fname)
+            result = lab.correlate(im, kernel)
+            for y in range(im['height']):
+                for x in range(im['width']):
+                    self.assertEqual(lab.get_pixel(result, x, y),
+                                     lab.correlate_pixel(im, kernel, x, y))
+
     def test_correlate_3(self):
         kernel = [[0, 0, 0, 0, 0, 0, 0, 0, 0],
                   [0, 0, 0, 0, 0, 0, 0, 0, 0],
@@ -245,6 +310,131 @@ class TestFilters(Lab0Test):
         result = lab.blurred(im, 5)
         lab.save_image(result, '/Users/yaxinliu/Downloads/lab0/BlurredCat.png')
 
+    def test_blurred_matches_direct_sum(self):
+        im = lab.load_image('test_images/pattern.png')
+        for kernsize in (2, 4, 6, 11):
+            with self.subTest(k=kernsize):
+                kernel = lab.box_blur(kernsize)
+                expected = {
+                    'height': im['height'],
+                    'width': im['width'],
+                    'pixels': [lab.correlate_pixel(im, kernel, x, y)
+                               for y in range(im['height'])
+                               for x in range(im['width'])],
+                    }
+                lab.round_and_clip_image(expected)
+                self.compare_images(lab.blurred(im, kernsize), expected)
+
+    def test_correlate_separable(self):
+        im = lab.load_image('test_images/pattern.png')
+        kernel = [[1, 2, 1],
+                  [2, 4, 2],
+                  [1, 2, 1]]
+        self.assertEqual(lab.separate_kernel(kernel), ([1, 2, 1], [1, 2, 1]))
+        result = lab.correlate(im, kernel)
+        for y in range(im['height']):
+            for x in range(im['width']):
+                self.assertEqual(lab.get_pixel(result, x, y),
+                                 lab.correlate_pixel(im, kernel, x, y))
+
+    def test_correlate_float_separable(self):
+        # rank-1 but not dyadic: must add the taps in the direct order
+        im = lab.load_image('test_images/cat.png')
+        kernel = [[.1, .2, .1],
+                  [.2, .4, .2],
+                  [.1, .2, .1]]
+        self.assertIsNone(lab.compile_kernel(kernel)['separable'])
+        result = lab.correlate(im, kernel)
+        expected = [lab.correlate_pixel(im, kernel, x, y)
+                    for y in range(im['height']) for x in range(im['width'])]
+        self.assertEqual(result['pixels'], expected)
+
+    def test_correlate_integer_box(self):
+        im = lab.load_image('test_images/pattern.png')
+        kernel = [[3]*3]*3
+        result = lab.correlate(im, kernel)
+        for y in range(im['height']):
+            for x in range(im['width']):
+                self.assertEqual(lab.get_pixel(result, x, y),
+                                 lab.correlate_pixel(im, kernel, x, y))
+
+    def test_correlate_float_box(self):
+        # 0.3 is not 1/d: scaling window sums would round differently
+        im = lab.load_image('test_images/cat.png')
+        kernel = [[0.3]*3]*3
+        self.assertIsNone(lab.compile_kernel(kernel)['box'])
+        expected = lab.correlate_general(im, kernel)['pixels']
+        self.assertEqual(lab.correlate(im, kernel)['pixels'], expected)
+        self.assertEqual(lab.correlate_box(im, 3, 0.3)['pixels'], expected)
+        self.assertEqual(expected, [lab.correlate_pixel(im, kernel, x, y)
+                                    for y in range(im['height']) for x in range(im['width'])])
+
+    def test_compiled_kernels(self):
+        kernel = lab.compile_kernel([[0, -1, 0],
+                                     [-1, 5, -1],
+                                     [0, -1, 0]])
+        self.assertTrue(kernel['integer'])
+        self.assertIsNone(kernel['box'])
+        self.assertIs(lab.compile_kernel(kernel), kernel)
+        im = lab.load_image('test_images/centered_pixel.png')
+        self.assertEqual(lab.correlate(im, kernel), lab.correlate(im, kernel['rows']))
+
+        lab.KERNEL_CACHE.clear()
+        box = lab.cached_kernel('box', 3)
+        self.assertIs(lab.cached_kernel('box', 3), box)
+        self.assertEqual(box['box'], 1/9)
+        for n in range(lab.KERNEL_CACHE_SIZE):
+            lab.cached_kernel('box', 5 + n)
+        self.assertNotIn(('box', 3), lab.KERNEL_CACHE)
+        self.assertEqual(len(lab.KERNEL_CACHE), lab.KERNEL_CACHE_SIZE)
+
+    def test_summed_area_table(self):
+        im = {'height': 3, 'width': 4, 'pixels': [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 8]}
+        table = lab.summed_area_table(im)
+        # rectangles inside, across and entirely beyond the edges
+        for x0, y0, x1, y1 in ((0, 0, 4, 3), (1, 1, 3, 2), (-2, -1, 2, 2),
+                               (2, 1, 7, 6), (-3, -3, -1, -1), (5, 4, 5, 9)):
+            expected = sum(lab.get_pixel_outRange(im, x, y)
+                           for x in range(x0, x1) for y in range(y0, y1))
+            self.assertEqual(lab.rectangle_sum(table, x0, y0, x1, y1), expected)
+        im = lab.load_image('test_images/cat.png')
+        oim = object_hash(im)
+        sizes = (1, 2, 5, 9)
+        expected = [lab.blurred(im, n) for n in sizes]
+        self.assertEqual(lab.blurred_sizes(im, sizes), expected)
+        table = lab.summed_area_table(im)
+        for n in sizes:
+            self.assertEqual(list(lab.box_sums(table, n)), list(lab.running_box_sums(im, n)))
+            for exact in (False, True):
+                self.assertEqual(lab.sharpened(im, n, exact, table), lab.sharpened(im, n, exact))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_exact_box_kernels(self):
+        def rounded_mean(total, d):
+            # round(total / d), half to even, in integers
+            q, r = divmod(total, d)
+            return q + (2*r > d or (2*r == d and q % 2))
+        im = {'height': 7, 'width': 6, 'pixels': [3, 0, 255, 7, 1, 2]*7}
+        oim = object_hash(im)
+        for n in (1, 2, 4, 5):
+            with self.subTest(n=n):
+                d = n*n
+                sums = [s for row in lab.box_sums(lab.summed_area_table(im), n) for s in row]
+                self.assertEqual(lab.correlate(im, lab.box_blur(n), exact=True)['pixels'],
+                                 [s / d for s in sums])
+                self.assertEqual(list(lab.blurred(im, n, exact=True)['pixels']),
+                                 [rounded_mean(s, d) for s in sums])
+                self.assertEqual(list(lab.sharpened(im, n, True)['pixels']),
+                                 [min(max(rounded_mean(2*d*p - s, d), 0), 255)
+                                  for p, s in zip(im['pixels'], sums)])
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+        kernel = lab.compile_kernel([[1, -2, 1], [0, 3, 0], [0, 0, 0]])
+        self.assertEqual(kernel['gain'], 7)
+        self.assertEqual(lab.box_divisor(lab.compile_kernel(lab.box_blur(3))['box']), 9)
+        self.assertIsNone(lab.box_divisor(0.3))
+        result = lab.correlate(im, kernel['rows'], exact=True)['pixels']
+        self.assertTrue(all(isinstance(p, int) for p in result))
+
     def test_sharpened(self):
         for kernsize in (1, 3, 9):
             for fname in ('mushroom', 'twocats', 'chess'):
@@ -295,6 +485,26 @@ class TestFilters(Lab0Test):
             }
         self.compare_images(result, expected)
 
+    def test_edges_matches_correlation(self):
+        Kx = [[-1, 0, 1],
+              [-2, 0, 2],
+              [-1, 0, 1]]
+        Ky = [[-1, -2, -1],
+              [0, 0, 0],
+              [1, 2, 1]]
+        for im in (lab.load_image('test_images/pattern.png'),
+                   {'height': 3, 'width': 4,
+                    'pixels': [-20.5, 300, 7.25, 0, 12, 255, 511, 3, 3, 1.5, 0, 90]}):
+            Ox = lab.correlate(im, Kx)
+            Oy = lab.correlate(im, Ky)
+            expected = {
+                'height': im['height'],
+                'width': im['width'],
+                'pixels': [(a**2 + b**2)**0.5 for a, b in zip(Ox['pixels'], Oy['pixels'])],
+                }
+            lab.round_and_clip_image(expected)
+            self.compare_images(lab.edges(im), expected)
+
     def test_edges_construct(self):
         im = lab.load_image('test_images/construct.png')
         result = lab.edges(im)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""
+Vectorised implementations of the lab filters.
+
+When NumPy is installed, correlate, round_and_clip_image, inverted, blurred,
+sharpened, edges and the color split/combine are computed with whole-array
+operations; otherwise (or with backend='python') every function here simply
+calls the pure-Python version in lab.py.  The backend is chosen at import
+from the LAB_BACKEND environment variable ('numpy' or 'python', defaulting
+to 'numpy' when it is available), can be changed with set_backend(), and can
+be overridden per call with the `backend` keyword argument.
+
+Both backends produce identical images: the NumPy versions add kernel taps
+in the same order as lab.correlate does, so for integer pixels even the
+unrounded correlation results match.  Integer pixels are summed in int32
+arrays when the kernel's gain guarantees the sums fit, and in int64 arrays
+otherwise.
+"""
+
+import os
+
+import lab
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BACKENDS = ('numpy', 'python') if numpy is not None else ('python',)
+
+BACKEND = os.environ.get('LAB_BACKEND', BACKENDS[0])
+if BACKEND not in BACKENDS:
+    BACKEND = 'python'
+
+
+def set_backend(name):
+    """
+    Select the backend used when a call does not name one.
+    """
+    global BACKEND
+    if name not in BACKENDS:
+        raise ValueError('Unsupported backend: %r (available: %s)'
+                         % (name, ', '.join(BACKENDS)))
+    BACKEND = name
+
+
+def use_numpy(backend):
+    """
+    Return True if a call with the given backend argument should use NumPy.
+    """
+    name = BACKEND if backend is None else backend
+    if name not in BACKENDS:
+        raise ValueError('Unsupported backend: %r (available: %s)'
+                         % (name, ', '.join(BACKENDS)))
+    return name == 'numpy'
+
+
+# CONVERSIONS
+
+def to_array(image):
+    """
+    Return the pixels of a greyscale image as a 2-D array (rows first).
+    Byte buffers are wrapped without copying.
+    """
+    pixels = image['pixels']
+    if isinstance(pixels, (bytes, bytearray)):
+        a = numpy.frombuffer(pixels, dtype=numpy.uint8)
+    else:
+        a = numpy.asarray(pixels)
+    return a.reshape(image['height'], image['width'])
+
+
+def from_array(a):
+    """
+    Return a greyscale image for a 2-D array of pixels, using a bytearray
+    when the values are integers in [0, 255] and a list otherwise.
+    """
+    h, w = a.shape
+    if a.dtype == numpy.uint8:
+        pixels = bytearray(a.tobytes())
+    elif a.dtype.kind in 'iu' and (a.size == 0 or (a.min() >= 0 and a.max() <= 255)):
+        pixels = bytearray(a.astype(numpy.uint8).tobytes())
+    else:
+        pixels = a.ravel().tolist()
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+
+def widen(a):
+    """
+    Return integer arrays as int64 (so sums cannot overflow) and any other
+    array unchanged.
+    """
+    if a.dtype.kind in 'iub':
+        return a.astype(numpy.int64)
+    return a
+
+
+def integer_bound(a):
+    """
+    Return the largest absolute value of an integer array.
+    """
+    if a.dtype == numpy.uint8:
+        return 255
+    if a.size == 0:
+        return 0
+    return max(abs(int(a.min())), abs(int(a.max())))
+
+
+def narrow(a, gain):
+    """
+    Return an integer array as int32 if every sum of its values weighted by
+    integers whose absolute values add up to at most gain fits in int32, as
+    int64 otherwise, and any other array unchanged.
+    """
+    if a.dtype.kind not in 'iub':
+        return a
+    # (at least 1, so that the weights themselves fit too)
+    if max(integer_bound(a), 1)*gain < 2**31:
+        return a.astype(numpy.int32)
+    return a.astype(numpy.int64)
+
+
+def round_and_clip_array(a):
+    """
+    Round (half to even, like Python's round) and clip to [0, 255].
+    """
+    if a.dtype.kind == 'f':
+        a = numpy.rint(a)
+    return numpy.clip(a, 0, 255).astype(numpy.uint8)
+
+
+# CORRELATION
+
+def correlate_array(a, kernel, exact=False):
+    """
+    Correlate a 2-D array with the kernel (a list of rows or a kernel from
+    lab.compile_kernel), treating pixels beyond the edges like
+    lab.get_pixel_outRange.  Returns an integer array (int32 or int64,
+    see narrow) for integer input and kernel, and a float64 array
+    otherwise.  exact is as for lab.correlate.
+    """
+    h, w = a.shape
+    kernel = lab.compile_kernel(kernel)
+    n = kernel['size']
+    dis = kernel['radius']
+    if kernel['box'] is not None:
+        return correlate_box_array(a, n, kernel['box'], exact)
+    a = narrow(a, kernel['gain']) if kernel['integer'] else widen(a)
+    if kernel['separable'] is not None:
+        column, row = kernel['separable']
+        padded = numpy.pad(a, ((0, 0), (dis, n-1-dis)), mode='edge')
+        acc = numpy.zeros((h, w), dtype=numpy.result_type(a, *row))
+        for j in range(n):
+            if row[j]:
+                acc = acc + row[j]*padded[:, j:j+w]
+        padded = numpy.pad(acc, ((dis, n-1-dis), (0, 0)), mode='edge')
+        acc = numpy.zeros((h, w), dtype=numpy.result_type(padded, *column))
+        for i in range(n):
+            if column[i]:
+                acc = acc + column[i]*padded[i:i+h, :]
+        return acc
+    top, bottom, left, right = kernel['extent']
+    padded = numpy.pad(a, ((top, bottom), (left, right)), mode='edge')
+    values = [k for dy, dz, k in kernel['taps']]
+    acc = numpy.zeros((h, w), dtype=numpy.result_type(a, *values))
+    for dy, dz, k in kernel['taps']:
+        acc = acc + padded[top+dy:top+dy+h, left+dz:left+dz+w]*k
+    return acc
+
+
+def correlate_box_array(a, n, value, exact=False):
+    """
+    Correlate with the n-by-n kernel whose entries all equal value, using
+    window sums taken from a summed-area table (the vectorised form of
+    lab.summed_area_table and lab.box_sums), with the same treatment of
+    exact halfway values and of exact=True as lab.box_rows.  Values that are
+    neither integers nor 1/d for an integer d are correlated tap by tap
+    instead (see lab.box_kernel_value).
+    """
+    if not isinstance(value, int) and lab.box_divisor(value) is None:
+        return correlate_array(a, [[value]*n]*n, exact)
+    h, w = a.shape
+    dis = n//2
+    # the table holds sums of up to the whole padded image
+    a = narrow(a, (h+n)*(w+n))
+    padded = numpy.pad(a, ((dis, n-1-dis), (dis, n-1-dis)), mode='edge')
+    table = numpy.zeros((padded.shape[0]+1, padded.shape[1]+1), dtype=padded.dtype)
+    table[1:, 1:] = padded.cumsum(axis=0, dtype=padded.dtype).cumsum(axis=1, dtype=padded.dtype)
+    sums = table[n:n+h, n:n+w] - table[:h, n:n+w] - table[n:n+h, :w] + table[:h, :w]
+    d = lab.box_divisor(value)
+    if exact and sums.dtype.kind == 'i' and d is not None and d != 1:
+        return sums / d
+    result = sums*value
+    if d is not None and d % 2 == 0:
+        ys, xs = numpy.nonzero(sums % d == d//2)
+        if len(ys):
+            image = from_array(a)
+            kernel = [[value]*n]*n
+            for y, x in zip(ys.tolist(), xs.tolist()):
+                result[y, x] = lab.correlate_pixel(image, kernel, x, y)
+    return result
+
+
+def edges_array(a):
+    """
+    Sobel edge magnitude of a 2-D array, rounded and clipped.
+    """
+    # |ox| and |oy| are at most 4 times the largest pixel
+    padded = numpy.pad(narrow(a, 32*integer_bound(a)) if a.dtype.kind in 'iub' else a,
+                       1, mode='edge')
+    # Kx = [1, 2, 1]^T [-1, 0, 1] and Ky = [-1, 0, 1]^T [1, 2, 1]
+    smooth = padded[:-2, :] + 2*padded[1:-1, :] + padded[2:, :]
+    ox = smooth[:, 2:] - smooth[:, :-2]
+    diff = padded[2:, :] - padded[:-2, :]
+    oy = diff[:, :-2] + 2*diff[:, 1:-1] + diff[:, 2:]
+    return round_and_clip_array(numpy.sqrt((ox*ox + oy*oy).astype(numpy.float64)))
+
+
+# FILTERS
+
+def correlate(image, kernel, backend=None, exact=False):
+    """
+    Same as lab.correlate.
+    """
+    if not use_numpy(backend):
+        return lab.correlate(image, kernel, exact)
+    result = correlate_array(to_array(image), kernel, exact)
+    return {'height': image['height'], 'width': image['width'],
+            'pixels': result.ravel().tolist()}
+
+
+def round_and_clip_image(image, backend=None):
+    """
+    Same as lab.round_and_clip_image (modifies the image in place).
+    """
+    if not use_numpy(backend):
+        return lab.round_and_clip_image(image)
+    image['pixels'] = bytearray(round_and_clip_array(to_array(image)).tobytes())
+
+
+def inverted(image, backend=None):
+    """
+    Same as lab.inverted.
+    """
+    if not use_numpy(backend):
+        return lab.inverted(image)
+    return from_array(255 - widen(to_array(image)))
+
+
+def blurred(image, n, backend=None, exact=False):
+    """
+    Same as lab.blurred.
+    """
+    if not use_numpy(backend):
+        return lab.blurred(image, n, exact=exact)
+    return from_array(round_and_clip_array(correlate_array(to_array(image), lab.cached_kernel('box', n), exact)))
+
+
+def sharpened(image, n, backend=None, exact=False):
+    """
+    Same as lab.sharpened.
+    """
+    if not use_numpy(backend):
+        return lab.sharpened(image, n, exact)
+    a = widen(to_array(image))
+    if exact and a.dtype.kind == 'i':
+        # (2*d*p - sum) / d, with a single division
+        d = n*n
+        sums = correlate_array(a, [[1]*n]*n)
+        return from_array(round_and_clip_array((2*d*a - sums) / d))
+    return from_array(round_and_clip_array(2*a - correlate_array(a, lab.cached_kernel('box', n))))
+
+
+def edges(image, backend=None):
+    """
+    Same as lab.edges.
+    """
+    if not use_numpy(backend):
+        return lab.edges(image)
+    return from_array(edges_array(to_array(image)))
+
+
+# COLOR IMAGES
+
+def spilt_color(im, backend=None):
+    """
+    Same as lab.spilt_color.
+    """
+    if not use_numpy(backend):
+        return lab.spilt_color(im)
+    pixels = im['pixels']
+    if isinstance(pixels, lab.ColorPixels):
+        return lab.spilt_color(im)
+    a = numpy.asarray(list(pixels)).reshape(im['height'], im['width'], 3)
+    return tuple(from_array(numpy.ascontiguousarray(a[:, :, k])) for k in range(3))
+
+
+def combine_image(red, green, blue, backend=None):
+    """
+    Same as lab.combine_image.
+    """
+    if not use_numpy(backend):
+        return lab.combine_image(red, green, blue)
+    planes = [to_array(c) for c in (red, green, blue)]
+    if all(p.dtype == numpy.uint8 for p in planes):
+        pixels = lab.ColorPixels(*[bytearray(p.tobytes()) for p in planes])
+    else:
+        pixels = list(zip(*(p.ravel().tolist() for p in planes)))
+    return {'height': red['height'], 'width': red['width'], 'pixels': pixels}
+
+
+# like the lab versions, these never modify the image they are given
+inverted.keeps_input = True
+blurred.keeps_input = True
+sharpened.keeps_input = True
+edges.keeps_input = True
+
+
+def color_filter_from_greyscale_filter(filt, backend=None):
+    """
+    Same as lab.color_filter_from_greyscale_filter, splitting and combining
+    the channels with the chosen backend.
+    """
+    def color_filter(im):
+        red, green, blue = spilt_color(im, backend)
+        return combine_image(filt(red), filt(green), filt(blue), backend)
+    return color_filter
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+"""
+Apply a filter to many images at once.
+
+    python batch.py test_images -o out --filter 'blur 5, invert'
+    python batch.py 'photos/*.jpg' -o out --filter 'seam 40' --jobs 4
+    python batch.py test_images -o out --grey --filter 'edges, threshold 40 200'
+
+The filter is a comma-separated cascade of steps, each a name and its
+integer arguments:
+
+    invert            blur N            sharpen N
+    edges             threshold LOW HIGH
+    seam K            (remove K columns by seam carving; color only)
+
+and is built with lab.filter_cascade, so runs of point filters are folded
+and the color channels are split once per run of greyscale filters.
+
+Inputs are files, directories (every image in them) or glob patterns.  The
+files are processed on a pool of --jobs processes.  Each task is only a
+pair of file names: the worker reads the image, filters it and writes the
+result itself, so no pixels travel between processes.  At most --in-flight
+tasks are submitted at a time (and, with --max-megapixels, at most that many
+megapixels of input, read from the image headers), so memory stays bounded
+however many files there are.
+
+An output is skipped when it is newer than its input and was made from the
+same input with the same filter, as recorded in a manifest in the output
+directory (--force redoes everything).  A run that would write an output
+over one of its own inputs is refused.  With --cache DIR the result of every
+stage of the filter is also kept in a cache shared by all the runs and
+workers (see cache.py), so a filter that was applied to the same pixels
+before, or that starts with the same steps, is not computed again.
+
+Every file's time in the worker and
+its latency (from submission to completion, including waiting for a free
+worker) are printed, followed by the total throughput; --json writes the
+same as JSON.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from PIL import Image
+
+import lab
+import cache
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+MANIFEST = '.batch-manifest.json'
+
+
+def threshold_filter(low, high):
+    """
+    Return a greyscale filter that sets pixels above high to 255 and below
+    low to 0, as lab.threshold does to every channel.
+    """
+    return lab.make_point_filter(lambda c: 255 if c > high else 0 if c < low else c)
+
+
+def seam_filter(k):
+    """
+    Return a color filter removing k columns by seam carving.
+    """
+    return lambda im: lab.seam_carving(im, k)
+
+
+# name: (number of integer arguments, filter factory, kind of filter made)
+STEPS = {
+    'invert': (0, lambda: lab.inverted, 'grey'),
+    'blur': (1, lab.make_blur_filter, 'grey'),
+    'sharpen': (1, lab.make_sharpen_filter, 'grey'),
+    'edges': (0, lambda: lab.edges, 'grey'),
+    'threshold': (2, threshold_filter, 'grey'),
+    'seam': (1, seam_filter, 'color'),
+}
+
+
+def parse_spec(spec):
+    """
+    Parse a filter spec into a list of (name, arguments) steps, raising
+    ValueError if it is not valid.
+    """
+    steps = []
+    for text in spec.split(','):
+        words = text.split()
+        if not words:
+            raise ValueError('Empty step in filter %r' % spec)
+        name, args = words[0], words[1:]
+        if name not in STEPS:
+            raise ValueError('Unknown filter step: %r (available: %s)'
+                             % (name, ', '.join(sorted(STEPS))))
+        if len(args) != STEPS[name][0]:
+            raise ValueError('%s takes %d argument(s), got %d'
+                             % (name, STEPS[name][0], len(args)))
+        try:
+            args = tuple(int(a) for a in args)
+        except ValueError:
+            raise ValueError('Arguments of %s must be integers: %r' % (name, text.strip()))
+        steps.append((name, args))
+    return steps
+
+
+def format_spec(steps):
+    """
+    Return the canonical text of parsed steps.
+    """
+    return ', '.join(' '.join([name] + [str(a) for a in args]) for name, args in steps)
+
+
+def build_filter(steps, color=True):
+    """
+    Return the filter for parsed steps, on color images or (if color is
+    False) on greyscale images.
+    """
+    filters = []
+    for name, args in steps:
+        nargs, factory, kind = STEPS[name]
+        filt = factory(*args)
+        if kind == 'color' and not color:
+            raise ValueError('%s only works on color images' % name)
+        if kind == 'grey' and color:
+            filt = lab.color_filter_from_greyscale_filter(filt)
+        filters.append(filt)
+    return lab.filter_cascade(filters)
+
+
+def named_steps(steps, color=True):
+    """
+    Return (name, filter) for each of the parsed steps, one by one, as
+    cache.cached_cascade takes them.
+    """
+    return [(format_spec([step]), build_filter([step], color)) for step in steps]
+
+
+def find_images(inputs):
+    """
+    Return the image files named by the inputs (files, directories or glob
+    patterns), sorted and without duplicates.
+    """
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            names = [os.path.join(item, n) for n in os.listdir(item)]
+        elif os.path.exists(item):
+            names = [item]
+        else:
+            names = glob.glob(item)
+        for name in names:
+            if os.path.isfile(name) and name.lower().endswith(IMAGE_EXTENSIONS):
+                found.add(os.path.abspath(name))
+    return sorted(found)
+
+
+def load_manifest(out_dir):
+    """
+    Return the manifest of the output directory (output name: the source
+    and filter it was made from), or {} if there is none.
+    """
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(out_dir, manifest):
+    """
+    Write the manifest of the output directory, replacing it atomically.
+    """
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def up_to_date(source, output, entry, spec, mode):
+    """
+    Return True if output exists, is at least as new as source, and its
+    manifest entry says it was made from source with the same filter.
+    """
+    if entry != {'source': source, 'filter': spec, 'mode': mode}:
+        return False
+    try:
+        return os.path.getmtime(output) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+
+def image_megapixels(filename):
+    """
+    Return the size of an image in megapixels, from its header only.
+    """
+    with Image.open(filename) as img:
+        w, h = img.size
+    return w*h / 1e6
+
+
+# one built filter per (spec, color, cache) in each process
+FILTERS = {}
+
+
+def process_file(source, output, spec, color, cache_dir=None, cache_bytes=cache.CACHE_SIZE):
+    """
+    Load source, apply the filter spec and save the result to output.  With
+    a cache_dir, the filter goes through a cache kept there (see cache.py).
+    Returns the size of the image and the time taken by each stage.
+    """
+    key = (spec, color, cache_dir)
+    if key not in FILTERS:
+        if cache_dir is None:
+            FILTERS[key] = build_filter(parse_spec(spec), color)
+        else:
+            FILTERS[key] = cache.cached_cascade(cache.open_cache(cache_dir, cache_bytes),
+                                                named_steps(parse_spec(spec), color))
+    start = time.perf_counter()
+    if color:
+        image = lab.load_color_image(source)
+    else:
+        image = lab.load_greyscale_image(source)
+    loaded = time.perf_counter()
+    result = FILTERS[key](image)
+    filtered = time.perf_counter()
+    tmp = output + '.tmp' + os.path.splitext(output)[1]
+    if color:
+        lab.save_color_image(result, tmp)
+    else:
+        lab.save_greyscale_image(result, tmp)
+    os.replace(tmp, output)
+    saved = time.perf_counter()
+    return {
+        'width': image['width'],
+        'height': image['height'],
+        'load_seconds': loaded - start,
+        'filter_seconds': filtered - loaded,
+        'save_seconds': saved - filtered,
+        'seconds': saved - start,
+    }
+
+
+def same_file(source, output):
+    """
+    Return True if writing output would overwrite source.
+    """
+    if os.path.abspath(source) == os.path.abspath(output):
+        return True
+    try:
+        return os.path.samefile(source, output)
+    except OSError:
+        # output does not exist yet
+        return False
+
+
+def run_batch(sources, out_dir, spec, color=True, jobs=None, in_flight=None,
+              max_megapixels=None, force=False, report=None, cache_dir=None,
+              cache_bytes=cache.CACHE_SIZE):
+    """
+    Filter every source file into out_dir (see the module docstring).
+    report, if given, is called with the result of each file as soon as it
+    is known.  Returns the results, one dictionary per source with 'input',
+    'output' and 'status' ('done', 'skipped' or 'failed') plus the timings
+    of those done or the 'error' of those that failed, in the order they
+    finished, and the number of seconds the whole batch took.
+    """
+    spec = format_spec(parse_spec(spec))
+    build_filter(parse_spec(spec), color)  # reject invalid specs up front
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = {}
+    for source in sources:
+        name = os.path.basename(source)
+        if name in outputs:
+            raise ValueError('%s and %s would both be written to %s'
+                             % (outputs[name], source, name))
+        if same_file(source, os.path.join(out_dir, name)):
+            raise ValueError('%s would be overwritten by its own output' % source)
+        outputs[name] = source
+    manifest = load_manifest(out_dir)
+    mode = 'color' if color else 'grey'
+    results = []
+
+    def finish(result):
+        results.append(result)
+        if result['status'] == 'done':
+            manifest[os.path.basename(result['output'])] = {
+                'source': result['input'], 'filter': spec, 'mode': mode}
+        if report is not None:
+            report(result)
+
+    pending = []
+    for source in sources:
+        output = os.path.join(out_dir, os.path.basename(source))
+        entry = manifest.get(os.path.basename(output))
+        if not force and up_to_date(source, output, entry, spec, mode):
+            finish({'input': source, 'output': output, 'status': 'skipped'})
+        else:
+            pending.append((source, output))
+
+    jobs = jobs or os.cpu_count() or 1
+    in_flight = max(in_flight or 2*jobs, 1)
+    start = time.perf_counter()
+    try:
+        if jobs == 1:
+            for source, output in pending:
+                submitted = time.perf_counter()
+                result = {'input': source, 'output': output}
+                try:
+                    result.update(process_file(source, output, spec, color,
+                                               cache_dir, cache_bytes), status='done')
+                except Exception as e:
+                    result.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+                result['latency_seconds'] = time.perf_counter() - submitted
+                finish(result)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                queue = list(reversed(pending))
+                running = {}
+                megapixels = 0
+                while queue or running:
+                    while queue and len(running) < in_flight:
+                        source, output = queue[-1]
+                        size = image_megapixels(source) if max_megapixels else 0
+                        if max_megapixels and running and megapixels + size > max_megapixels:
+                            break
+                        queue.pop()
+                        task = pool.submit(process_file, source, output, spec, color,
+                                           cache_dir, cache_bytes)
+                        running[task] = (source, output, size, time.perf_counter())
+                        megapixels += size
+                    done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                    for task in done:
+                        source, output, size, submitted = running.pop(task)
+                        megapixels -= size
+                        result = {'input': source, 'output': output}
+                        try:
+                            result.update(task.result(), status='done')
+                        except Exception as e:
+                            result.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+                        result['latency_seconds'] = time.perf_counter() - submitted
+                        finish(result)
+    finally:
+        save_manifest(out_dir, manifest)
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summary(results, elapsed):
+    """
+    Return totals for the results of run_batch: files done, skipped and
+    failed, megapixels done, and throughput.
+    """
+    done = [r for r in results if r['status'] == 'done']
+    megapixels = sum(r['width']*r['height'] for r in done) / 1e6
+    return {
+        'done': len(done),
+        'skipped': sum(r['status'] == 'skipped' for r in results),
+        'failed': sum(r['status'] == 'failed' for r in results),
+        'megapixels': megapixels,
+        'seconds': elapsed,
+        'images_per_second': len(done) / elapsed if elapsed else None,
+        'megapixels_per_second': megapixels / elapsed if elapsed else None,
+    }
+
+
+def print_result(result):
+    """
+    Print one result of run_batch as a row of the results table.
+    """
+    name = os.path.basename(result['input'])
+    if result['status'] == 'done':
+        mp = result['width']*result['height'] / 1e6
+        print('%-30s %11s %9.3f %9.3f %8.2f' % (
+            name, '%dx%d' % (result['width'], result['height']), result['seconds'],
+            result['latency_seconds'], mp / result['seconds'] if result['seconds'] else 0))
+    elif result['status'] == 'skipped':
+        print('%-30s %11s' % (name, 'up to date'))
+    else:
+        print('%-30s %11s %s' % (name, 'FAILED', result['error']))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Apply a filter to many images on a pool of processes.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, metavar='DIR',
+                        help='directory to write the filtered images to')
+    parser.add_argument('--filter', required=True, metavar='SPEC',
+                        help="comma-separated steps, e.g. 'blur 5, invert'")
+    parser.add_argument('--grey', action='store_true',
+                        help='load and filter the images as greyscale')
+    parser.add_argument('--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--in-flight', type=int,
+                        help='most files submitted at once (default: twice --jobs)')
+    parser.add_argument('--max-megapixels', type=float,
+                        help='most megapixels of input submitted at once')
+    parser.add_argument('--force', action='store_true',
+                        help='redo outputs that are up to date')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep the results of every filter stage in this cache directory')
+    parser.add_argument('--cache-size', type=float, default=cache.CACHE_SIZE / 2**20,
+                        metavar='MB', help='size limit of the cache (default: %(default)d)')
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    try:
+        build_filter(parse_spec(args.filter), not args.grey)
+    except ValueError as e:
+        parser.error(str(e))
+    sources = find_images(args.inputs)
+    if not sources:
+        parser.error('no images found')
+    report = None
+    if args.json != '-':
+        print('%-30s %11s %9s %9s %8s' % ('image', 'size', 'seconds', 'latency', 'MP/s'))
+        report = print_result
+    try:
+        results, elapsed = run_batch(
+            sources, args.output, args.filter, not args.grey, args.jobs, args.in_flight,
+            args.max_megapixels, args.force, report, args.cache,
+            int(args.cache_size * 2**20))
+    except ValueError as e:
+        parser.error(str(e))
+    totals = summary(results, elapsed)
+    if args.json != '-':
+        print('%d done, %d up to date, %d failed in %.2fs: %.2f images/s, %.2f MP/s' % (
+            totals['done'], totals['skipped'], totals['failed'], elapsed,
+            totals['images_per_second'] or 0, totals['megapixels_per_second'] or 0))
+    if args.json:
+        run = {'filter': format_spec(parse_spec(args.filter)),
+               'mode': 'grey' if args.grey else 'color',
+               'jobs': args.jobs or os.cpu_count() or 1,
+               'totals': totals, 'results': results}
+        if args.json == '-':
+            json.dump(run, sys.stdout, indent=1)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(run, f, indent=1)
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
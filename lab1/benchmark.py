@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmark for the image filters.
+
+Every filter case is run on the bundled test_images and on synthetic
+images of the requested sizes.  For each (image, filter) pair the best of
+`repeat` calls is reported in megapixels per second, together with the
+peak memory allocated by one call (measured separately with tracemalloc,
+which slows the call down).  With --json the results, plus the Python
+version and platform, are written in a machine-readable form so that runs
+can be compared over time.
+
+    python benchmark.py --synthetic 1024x768 --filter 'blurred:*' --json out.json
+    python benchmark.py --lab ../lab0 --filter edges
+
+--reference instead prints the before/after table of the original
+tap-by-tap correlate against lab.correlate, and --pyramid N compares
+removing N seams with lab.pyramid_seam_carving (for each --levels) against
+the exact carver: time, and the total energy of the removed pixels
+relative to the exact seams (1.0 is as good as exact).
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import fnmatch
+import argparse
+import platform
+import importlib.util
+import tracemalloc
+
+import lab
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# kernels that are neither box nor separable, so they go through
+# lab.correlate_general
+KERNELS = {
+    'sharpen3': [[0, -1, 0],
+                 [-1, 5, -1],
+                 [0, -1, 0]],
+    'emboss3': [[-2, -1, 0],
+                [-1, 1, 1],
+                [0, 1, 2]],
+    'ring5': [[0, 1, 1, 1, 0],
+              [1, 0, 0, 0, 1],
+              [1, 0, -8, 0, 1],
+              [1, 0, 0, 0, 1],
+              [0, 1, 1, 1, 0]],
+}
+
+BLUR_SIZES = tuple(range(1, 32))
+SHARPEN_SIZES = (3, 11)
+SEAM_COLUMNS = 2
+
+
+def correlate_reference(image, kernel):
+    """
+    The original correlate(): every kernel entry of every pixel goes through
+    get_pixel_outRange.  Kept here as the "before" of the benchmark.
+    """
+    result = {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': ([0]*len(image['pixels'])),
+        }
+    dis = len(kernel)//2
+    for x in range(image['width']):
+        for y in range(image['height']):
+            cor = 0
+            for i in range(len(kernel)):
+                for z in range(len(kernel[i])):
+                    cor += lab.get_pixel_outRange(image, x-dis+z, y-dis+i) * kernel[i][z]
+            lab.set_pixel(result, x, y, cor)
+    return result
+
+
+def load_lab(directory):
+    """
+    Import the lab.py found in the given directory (e.g. ../lab0) under the
+    name 'lab_under_test', so that different versions can be benchmarked.
+    """
+    spec = importlib.util.spec_from_file_location(
+        'lab_under_test', os.path.join(directory, 'lab.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def filter_cases(module, blur_sizes=BLUR_SIZES, sharpen_sizes=SHARPEN_SIZES,
+                 seam_columns=SEAM_COLUMNS):
+    """
+    Return a list of (name, kind, filter) for every benchmark case that the
+    lab module supports; kind is 'grey' or 'color', the kind of image the
+    filter takes.
+    """
+    cases = [('inverted', 'grey', module.inverted)]
+    for kname in sorted(KERNELS):
+        cases.append(('correlate:' + kname, 'grey',
+                      lambda im, k=KERNELS[kname]: module.correlate(im, k)))
+    for n in blur_sizes:
+        cases.append(('blurred:%d' % n, 'grey', lambda im, n=n: module.blurred(im, n)))
+    for n in sharpen_sizes:
+        cases.append(('sharpened:%d' % n, 'grey', lambda im, n=n: module.sharpened(im, n)))
+    cases.append(('edges', 'grey', module.edges))
+    if not hasattr(module, 'color_filter_from_greyscale_filter'):
+        return cases
+    color = module.color_filter_from_greyscale_filter
+    cases.extend([
+        ('color:inverted', 'color', color(module.inverted)),
+        ('color:blurred:9', 'color', color(module.make_blur_filter(9))),
+        ('color:sharpened:3', 'color', color(module.make_sharpen_filter(3))),
+        ('color:edges', 'color', color(module.edges)),
+        ('filter_cascade', 'color', module.filter_cascade([
+            color(module.edges), color(module.inverted),
+            color(module.make_blur_filter(5)), color(module.make_sharpen_filter(3))])),
+        ('seam_carving:%d' % seam_columns, 'color',
+         lambda im: module.seam_carving(im, seam_columns)),
+    ])
+    return cases
+
+
+def synthetic_image(width, height, color=False, seed=0):
+    """
+    Return a width-by-height image of reproducible random pixels.
+    """
+    data = bytearray(random.Random(seed).randbytes(width*height*(3 if color else 1)))
+    if color:
+        pixels = lab.ColorPixels.from_interleaved(data)
+    else:
+        pixels = data
+    return {'height': height, 'width': width, 'pixels': pixels}
+
+
+def convert_image(module, image):
+    """
+    Return the image with its pixels in the form the given lab module uses,
+    which is plain lists for a module without a packed representation.
+    """
+    if hasattr(module, 'compact_image'):
+        return module.compact_image(lab.image_as_lists(image))
+    return lab.image_as_lists(image)
+
+
+def load_images(filenames, sizes, module):
+    """
+    Return a list of (name, {'grey': image, 'color': image}) for the given
+    image files and synthetic WIDTHxHEIGHT sizes.  'color' is missing when
+    the module has no color images.
+    """
+    has_color = hasattr(module, 'load_color_image')
+    images = []
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if has_color:
+            entry = {'grey': module.load_greyscale_image(filename),
+                     'color': module.load_color_image(filename)}
+        else:
+            entry = {'grey': module.load_image(filename)}
+        images.append((name, entry))
+    for size in sizes:
+        width, height = [int(v) for v in size.lower().split('x')]
+        entry = {'grey': convert_image(module, synthetic_image(width, height))}
+        if has_color:
+            entry['color'] = convert_image(module, synthetic_image(width, height, True))
+        images.append(('synthetic-' + size, entry))
+    return images
+
+
+def measure(func, image, repeat=1, memory=True):
+    """
+    Return (best seconds, peak bytes) for calls of func(image): the time is
+    the best of `repeat` calls, and the peak memory (None if memory is False)
+    is measured on one extra call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(image)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def seconds_per_megapixel(func, image, repeat):
+    """
+    Return the best time of `repeat` calls of func(image), in seconds per
+    megapixel of the image.
+    """
+    best, peak = measure(func, image, repeat, memory=False)
+    return best / (image['width'] * image['height'] / 1e6)
+
+
+def bench_filters(images, cases, repeat=1, memory=True, report=None):
+    """
+    Time every case on every image of its kind.  Returns a list of result
+    dictionaries; report, if given, is called with each one as it is made.
+    """
+    results = []
+    for name, entry in images:
+        for fname, kind, func in cases:
+            if kind not in entry:
+                continue
+            image = entry[kind]
+            seconds, peak = measure(func, image, repeat, memory)
+            megapixels = image['width'] * image['height'] / 1e6
+            result = {
+                'image': name,
+                'width': image['width'],
+                'height': image['height'],
+                'filter': fname,
+                'seconds': seconds,
+                'megapixels_per_second': megapixels / seconds if seconds else None,
+                'peak_memory_bytes': peak,
+            }
+            results.append(result)
+            if report is not None:
+                report(result)
+    return results
+
+
+def bench_correlate(filenames, kernels, repeat=1):
+    """
+    Time correlate_reference and lab.correlate on every image with every
+    kernel.  Returns a list of (image name, kernel name, before, after) with
+    times in seconds per megapixel.
+    """
+    rows = []
+    for filename in filenames:
+        image = lab.load_greyscale_image(filename)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        for kname, kernel in kernels.items():
+            before = seconds_per_megapixel(
+                lambda im: correlate_reference(im, kernel), image, repeat)
+            after = seconds_per_megapixel(
+                lambda im: lab.correlate(im, kernel), image, repeat)
+            rows.append((name, kname, before, after))
+    return rows
+
+
+def bench_pyramid(images, ncols, levels=(1, 2, 3), band=None, report=None):
+    """
+    Time the exact carver and the pyramid carver at each number of levels,
+    removing ncols seams from every color image.  Returns a list of result
+    dictionaries; report, if given, is called with each one as it is made.
+    """
+    results = []
+    for name, entry in images:
+        image = entry['color']
+        k = min(ncols, image['width']-1)
+        energy = lab.compute_energy(lab.greyscale_image_from_color_image(image))['pixels']
+        for level in (0,) + tuple(levels):
+            start = time.perf_counter()
+            removed = lab.pyramid_seam_indices(image, k, level, band)
+            seconds = time.perf_counter() - start
+            cost = sum(energy[i] for i in removed)
+            if level == 0:
+                exact_seconds, exact_cost, exact = seconds, cost, set(removed)
+            result = {
+                'image': name,
+                'width': image['width'],
+                'height': image['height'],
+                'filter': 'pyramid:%d' % level if level else 'exact',
+                'seams': k,
+                'seconds': seconds,
+                'speedup': exact_seconds / seconds if seconds else None,
+                'energy_ratio': cost / exact_cost if exact_cost else 1.0,
+                'same_pixels': len(exact.intersection(removed)) / len(removed) if removed else 1.0,
+            }
+            results.append(result)
+            if report is not None:
+                report(result)
+    return results
+
+
+def print_pyramid_result(result):
+    """
+    Print one result of bench_pyramid as a row of the results table.
+    """
+    print('%-22s %-10s %6d %10.3f %8.1fx %8.3f %8.3f' % (
+        result['image'], result['filter'], result['seams'], result['seconds'],
+        result['speedup'] or 0, result['energy_ratio'], result['same_pixels']))
+    sys.stdout.flush()
+
+
+def print_result(result):
+    """
+    Print one result of bench_filters as a row of the results table.
+    """
+    peak = result['peak_memory_bytes']
+    print('%-22s %-18s %10.3f %10.2f %10s' % (
+        result['image'], result['filter'], result['seconds'],
+        result['megapixels_per_second'] or 0,
+        '-' if peak is None else '%.1f' % (peak / 2**20)))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the image filters on the test images.')
+    parser.add_argument('images', nargs='*',
+                        default=sorted(glob.glob(os.path.join(TEST_DIRECTORY, 'test_images', '*.png'))))
+    parser.add_argument('--synthetic', action='append', default=[], metavar='WxH',
+                        help='also time a synthetic image of this size (repeatable)')
+    parser.add_argument('--filter', action='append', metavar='PATTERN',
+                        help="only time filters matching this pattern, e.g. 'blurred:*'")
+    parser.add_argument('--lab', default=TEST_DIRECTORY, metavar='DIR',
+                        help='directory of the lab.py to benchmark')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='calls per measurement; the best one is kept')
+    parser.add_argument('--seam-columns', type=int, default=SEAM_COLUMNS)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc peak memory measurement')
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument('--reference', action='store_true',
+                        help='compare lab.correlate with the original correlate instead')
+    parser.add_argument('--kernel', action='append', choices=sorted(KERNELS),
+                        help='kernel to time with --reference (default: all)')
+    parser.add_argument('--pyramid', type=int, metavar='N',
+                        help='compare pyramid and exact seam carving, removing N seams')
+    parser.add_argument('--levels', type=int, action='append',
+                        help='pyramid levels to compare with --pyramid (default: 1, 2, 3)')
+    parser.add_argument('--band', type=int,
+                        help='band half-width for --pyramid (default: 2**levels)')
+    args = parser.parse_args(argv)
+
+    if args.reference:
+        kernels = {k: KERNELS[k] for k in (args.kernel or sorted(KERNELS))}
+        print('%-16s %-9s %12s %12s %8s' % ('image', 'kernel', 'before s/MP', 'after s/MP', 'speedup'))
+        for name, kname, before, after in bench_correlate(args.images, kernels, args.repeat):
+            print('%-16s %-9s %12.3f %12.3f %7.1fx' % (name, kname, before, after, before/after))
+        return 0
+
+    module = lab if os.path.samefile(args.lab, TEST_DIRECTORY) else load_lab(args.lab)
+    cases = filter_cases(module, seam_columns=args.seam_columns)
+    if args.filter:
+        cases = [c for c in cases if any(fnmatch.fnmatchcase(c[0], p) for p in args.filter)]
+    images = load_images(args.images, args.synthetic, module)
+    report = None
+    if args.pyramid is not None:
+        if args.json != '-':
+            print('%-22s %-10s %6s %10s %9s %8s %8s' % (
+                'image', 'carver', 'seams', 'seconds', 'speedup', 'energy', 'same'))
+            report = print_pyramid_result
+        results = bench_pyramid(images, args.pyramid, args.levels or (1, 2, 3), args.band, report)
+    else:
+        if args.json != '-':
+            print('%-22s %-18s %10s %10s %10s' % ('image', 'filter', 'seconds', 'MP/s', 'peak MiB'))
+            report = print_result
+        results = bench_filters(images, cases, args.repeat, not args.no_memory, report)
+    if args.json:
+        run = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'lab': os.path.abspath(args.lab),
+            'repeat': args.repeat,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(run, sys.stdout, indent=1)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(run, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
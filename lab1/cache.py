@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""
+An on-disk cache of filter results.
+
+A result is stored under a key made from a digest of the input pixels, the
+filter that was applied and the version of lab.py (a digest of its source,
+so editing a filter invalidates what it cached).  Every entry is one file in
+the cache directory holding the raw pixels of the result after a small
+header (its kind, width and height), so reading an entry never runs code
+from the shared directory, and a file that does not have that exact form is
+a miss.  Reading an entry touches it, and when the directory grows beyond
+its size limit the least recently used entries are deleted.  Several
+processes can share a directory: entries are written atomically and an
+entry deleted by another process is simply a miss.
+
+    c = cache.open_cache('.filter-cache')
+    result = cache.cached(c, lab.blurred, image, 9)
+    filt = cache.cached_cascade(c, [('blur 5', lab.make_blur_filter(5)),
+                                    ('edges', lab.edges)])
+
+cached_cascade runs the stages that lab.filter_cascade plans (folded point
+filters, one color split per run of greyscale filters) and keeps the result
+of every stage, so a cascade starting with the same steps as one run
+before, on the same image, starts from the longest stored prefix.  batch.py
+names the steps of its filter specs this way.  Results that are not byte
+images, color images or lists of all-integer or all-float pixels are
+computed but not stored.
+"""
+
+import os
+import sys
+import struct
+import hashlib
+from array import array
+
+import lab
+
+CACHE_SIZE = 1 << 30
+
+# an entry is a header (magic, pixel kind, width, height) and the pixels:
+# bytes ('B'), three planes of bytes ('C'), or little-endian int64 ('q') or
+# float64 ('d') values
+ENTRY_SUFFIX = '.image'
+ENTRY_HEADER = '<4scII'
+ENTRY_MAGIC = b'LAB1'
+ENTRY_ITEM_SIZES = {b'B': 1, b'C': 3, b'q': 8, b'd': 8}
+
+# digest of the lab.py the results came from
+VERSION = None
+
+
+def lab_version():
+    """
+    Return a digest of the source of lab.py.
+    """
+    global VERSION
+    if VERSION is None:
+        with open(lab.__file__, 'rb') as f:
+            VERSION = hashlib.sha256(f.read()).hexdigest()[:16]
+    return VERSION
+
+
+def open_cache(directory, max_bytes=CACHE_SIZE):
+    """
+    Return a cache (a dictionary) kept in the given directory, which is
+    created if needed, holding at most about max_bytes of results.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cache = {'directory': directory, 'max_bytes': max_bytes, 'size': 0,
+             'hits': 0, 'misses': 0}
+    cache['size'] = sum(size for path, size, mtime in cache_entries(cache))
+    return cache
+
+
+def cache_entries(cache):
+    """
+    Return (path, size, last use) for every entry of the cache.
+    """
+    entries = []
+    with os.scandir(cache['directory']) as it:
+        for entry in it:
+            if entry.name.endswith(ENTRY_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def entry_path(cache, key):
+    """
+    Return the file holding the entry with the given key.
+    """
+    return os.path.join(cache['directory'], key + ENTRY_SUFFIX)
+
+
+def image_digest(image):
+    """
+    Return a digest of the size and pixels of an image.  Images with the
+    same pixels have the same digest whether they are stored compactly or
+    as lists.
+    """
+    pixels = image['pixels']
+    if not isinstance(pixels, (bytes, bytearray, lab.ColorPixels)):
+        pixels = lab.compact_image(image)['pixels']
+    h = hashlib.sha256(b'%d %d ' % (image['width'], image['height']))
+    if isinstance(pixels, (bytes, bytearray)):
+        h.update(b'grey ')
+        h.update(pixels)
+    elif isinstance(pixels, lab.ColorPixels):
+        h.update(b'color ')
+        for plane in pixels.planes:
+            h.update(bytes(plane))
+    else:
+        # values that do not fit in bytes
+        h.update(b'list ')
+        h.update(repr(list(pixels)).encode())
+    return h.hexdigest()
+
+
+def encode_image(image):
+    """
+    Return the contents of the cache entry for an image, or None if its
+    pixels cannot be stored.
+    """
+    pixels = image['pixels']
+    if isinstance(pixels, (bytes, bytearray)):
+        kind, data = b'B', bytes(pixels)
+    elif isinstance(pixels, lab.ColorPixels):
+        kind, data = b'C', b''.join(bytes(plane) for plane in pixels.planes)
+    elif isinstance(pixels, list) and all(type(p) is int for p in pixels):
+        try:
+            values = array('q', pixels)
+        except OverflowError:
+            return None
+        kind, data = b'q', little_endian(values).tobytes()
+    elif isinstance(pixels, list) and all(type(p) is float for p in pixels):
+        kind, data = b'd', little_endian(array('d', pixels)).tobytes()
+    else:
+        return None
+    return struct.pack(ENTRY_HEADER, ENTRY_MAGIC, kind, image['width'], image['height']) + data
+
+
+def decode_image(data):
+    """
+    Return the image in the contents of a cache entry, or None if they are
+    not a valid entry.
+    """
+    size = struct.calcsize(ENTRY_HEADER)
+    if len(data) < size:
+        return None
+    magic, kind, w, h = struct.unpack(ENTRY_HEADER, data[:size])
+    body = data[size:]
+    n = w*h
+    if magic != ENTRY_MAGIC or len(body) != n*ENTRY_ITEM_SIZES.get(kind, -1):
+        return None
+    if kind == b'B':
+        pixels = bytearray(body)
+    elif kind == b'C':
+        pixels = lab.ColorPixels(*[bytearray(body[k*n:(k+1)*n]) for k in range(3)])
+    else:
+        values = array(kind.decode())
+        values.frombytes(body)
+        pixels = little_endian(values).tolist()
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+
+def little_endian(values):
+    """
+    Return the array with its items in little-endian order (swapping them in
+    place on big-endian machines; the swap is its own inverse).
+    """
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def result_key(digest, name):
+    """
+    Return the cache key of the result of the filter called name (which
+    must describe the filter and its arguments) on an image with the given
+    digest.
+    """
+    text = '%s\0%s\0%s' % (lab_version(), digest, name)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cache_get(cache, key):
+    """
+    Return the image stored under key, or None.
+    """
+    path = entry_path(cache, key)
+    try:
+        with open(path, 'rb') as f:
+            image = decode_image(f.read())
+        if image is not None:
+            os.utime(path)
+    except OSError:
+        image = None
+    if image is None:
+        cache['misses'] += 1
+        return None
+    cache['hits'] += 1
+    return image
+
+
+def cache_put(cache, key, image):
+    """
+    Store an image under key, evicting the least recently used entries if
+    the cache is now too big.  Images that cannot be stored are skipped.
+    """
+    data = encode_image(image)
+    if data is None:
+        return
+    path = entry_path(cache, key)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    cache['size'] += len(data)
+    if cache['size'] > cache['max_bytes']:
+        evict(cache)
+
+
+def evict(cache):
+    """
+    Delete the least recently used entries until the cache fits in its
+    size limit.  The sizes are read again from the directory, which other
+    processes may have changed.
+    """
+    entries = sorted(cache_entries(cache), key=lambda e: e[2])
+    size = sum(e[1] for e in entries)
+    for path, entry_size, mtime in entries:
+        if size <= cache['max_bytes']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+    cache['size'] = size
+
+
+def cached(cache, func, image, *args):
+    """
+    Return func(image, *args), from the cache if it was computed before.
+    func must be a module-level function whose result depends only on the
+    image and the arguments (e.g. lab.blurred, lab.edges, lab.seam_carving).
+    """
+    name = '%s.%s%r' % (func.__module__, func.__qualname__, args)
+    key = result_key(image_digest(image), name)
+    result = cache_get(cache, key)
+    if result is None:
+        result = func(image, *args)
+        cache_put(cache, key, result)
+    return result
+
+
+def cached_cascade(cache, steps):
+    """
+    Return a filter with the effect of lab.filter_cascade on the filters of
+    steps, a list of (name, filter) pairs, running the same planned stages
+    and storing the result after every stage under the names of the steps
+    it covers.  The name must describe the filter and its arguments.  It
+    starts from the result of the longest prefix of the steps that is
+    already stored for the image, which may have been stored by another
+    cascade, and plans the remaining steps from there.
+    """
+    filters = [filt for name, filt in steps]
+    names = []
+    for name, filt in steps:
+        names.append(name if not names else names[-1] + ', ' + name)
+    # stages planned for the steps from a given start
+    plans = {}
+
+    def filter(im):
+        digest = image_digest(im)
+        result = im
+        start = 0
+        for i in range(len(names)-1, -1, -1):
+            stored = cache_get(cache, result_key(digest, names[i]))
+            if stored is not None:
+                result = stored
+                start = i+1
+                break
+        if start not in plans:
+            plans[start] = lab.plan_cascade(filters[start:])
+        done = start
+        for stage, count in plans[start]:
+            result = stage(result)
+            done += count
+            cache_put(cache, result_key(digest, names[done-1]), result)
+        return result
+    return filter
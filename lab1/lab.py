@@ -38,28 +38,202 @@ def set_pixel(image, x, y, c):
     """
     image['pixels'][x+(image['width']*y)] = c
 
-def apply_per_pixel(image, func):
-    result = {
+def pack_pixels(values):
+    """
+    Return the pixel values as a bytearray if they are all integers in the
+    range [0, 255], and as a list otherwise.
+    """
+    try:
+        return bytearray(values)
+    except (TypeError, ValueError):
+        return list(values)
+
+def byte_pixels(image):
+    """
+    Return True if every pixel of the greyscale image is an integer in the
+    range [0, 255] (so that pack_pixels would make a bytearray of them),
+    without copying the pixels.
+    """
+    pixels = image['pixels']
+    return (isinstance(pixels, (bytes, bytearray))
+            or all(isinstance(c, int) and 0 <= c <= 255 for c in pixels))
+
+class ColorPixels:
+    """
+    The pixels of a color image, stored as three bytearrays ("planes") of
+    red, green and blue values in row-major order.  Indexing, iteration,
+    len() and assignment work on (r, g, b) tuples, so it can be used in place
+    of the list of tuples in a color image dictionary, while the planes can
+    be handed to greyscale filters as they are.
+    """
+    def __init__(self, red, green, blue):
+        self.planes = [red, green, blue]
+
+    @classmethod
+    def from_interleaved(cls, data):
+        """
+        Make ColorPixels from interleaved r, g, b bytes (as PIL stores them).
+        """
+        return cls(bytearray(data[0::3]), bytearray(data[1::3]), bytearray(data[2::3]))
+
+    def interleaved(self):
+        """
+        Return the pixels as interleaved r, g, b bytes.
+        """
+        data = bytearray(3*len(self))
+        for k, plane in enumerate(self.planes):
+            data[k::3] = plane
+        return data
+
+    def __len__(self):
+        return len(self.planes[0])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(zip(*(plane[i] for plane in self.planes)))
+        return tuple(plane[i] for plane in self.planes)
+
+    def __setitem__(self, i, c):
+        for plane, v in zip(self.planes, c):
+            plane[i] = v
+
+    def __delitem__(self, i):
+        for plane in self.planes:
+            del plane[i]
+
+    def __iter__(self):
+        return zip(*self.planes)
+
+    def __eq__(self, other):
+        if isinstance(other, ColorPixels):
+            return self.planes == other.planes
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'ColorPixels(%r)' % list(self)
+
+def pack_color_pixels(red, green, blue):
+    """
+    Make ColorPixels from three channels (copying them) if all their values
+    are integers in the range [0, 255], or a list of tuples otherwise.
+    """
+    try:
+        return ColorPixels(bytearray(red), bytearray(green), bytearray(blue))
+    except (TypeError, ValueError):
+        return list(zip(red, green, blue))
+
+def compact_image(image):
+    """
+    Return a copy of the image whose pixels are stored compactly: a
+    bytearray for greyscale images and ColorPixels for color images, as
+    long as all values are integers in the range [0, 255].
+    """
+    pixels = image['pixels']
+    if isinstance(pixels, ColorPixels):
+        pixels = pack_color_pixels(*pixels.planes)
+    elif len(pixels) and isinstance(pixels[0], tuple):
+        pixels = pack_color_pixels(*zip(*pixels))
+    else:
+        pixels = pack_pixels(pixels)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+def image_as_lists(image):
+    """
+    Return a copy of the image whose pixels are stored in a plain list (of
+    numbers, or of (r, g, b) tuples for color images), the representation
+    used before pixels were kept in byte buffers.
+    """
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': list(image['pixels']),
+        }
+
+def apply_per_pixel(image, func, lut=None):
+    """
+    Return a new image whose pixels are func applied to each pixel of the
+    given image.  8-bit images have only 256 possible pixel values, so func
+    is called once for each of them to make a lookup table (see make_lut;
+    lut, if given, is that table made in advance), which is then applied to
+    the whole image at once; other images call func on every pixel, in
+    row-major order.
+    """
+    if byte_pixels(image):
+        return apply_lut(image, make_lut(func) if lut is None else lut)
+    return {
         'height': image['height'],
         'width': image['width'],
-        'pixels': ([0]*len(image['pixels'])),
+        'pixels': pack_pixels([func(c) for c in image['pixels']]),
         }
+
+def make_lut(func):
     """
-    Get inverted image pixels
+    Return the lookup table of a point operation: entry c is func(c), for
+    every 8-bit pixel value c.  The table is a bytearray if every entry is
+    an integer in [0, 255], and a list otherwise.
     """
-    for x in range(result['width']):
-        for y in range(result['height']):
-             color = get_pixel(image, x, y)
-             newcolor = func(color)
-             set_pixel(result, x, y, newcolor)
+    return pack_pixels([func(c) for c in range(256)])
+
+def compose_luts(*luts):
+    """
+    Return a single lookup table with the same effect as applying the given
+    tables one after the other, first to last.  Every table but the last
+    must map into [0, 255].
+    """
+    result = bytearray(range(256))
+    for lut in luts:
+        if not isinstance(result, bytearray):
+            raise ValueError('only the last lookup table may map outside [0, 255]')
+        if isinstance(lut, (bytes, bytearray)):
+            result = result.translate(lut)
+        else:
+            result = pack_pixels([lut[c] for c in result])
     return result
 
+def apply_lut(image, lut):
+    """
+    Return a new image whose pixels are lut[c] for each pixel c of the given
+    8-bit image.  Pixels already in a bytearray are used as they are;
+    others are packed into one first.
+    """
+    pixels = image['pixels']
+    if not isinstance(pixels, bytearray):
+        pixels = pack_pixels(pixels)
+        if not isinstance(pixels, bytearray):
+            raise ValueError('lookup tables apply only to 8-bit images')
+    if isinstance(lut, (bytes, bytearray)):
+        pixels = pixels.translate(lut)
+    else:
+        pixels = pack_pixels([lut[c] for c in pixels])
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': pixels,
+        }
+
 def inverted(image):
     return apply_per_pixel(image, lambda c: 255-c)
 
+# marks inverted as a point filter for filter_cascade (see make_point_filter)
+inverted.point = lambda c: 255-c
+
+def make_point_filter(func):
+    """
+    Return a filter that applies func to every pixel of a greyscale image,
+    with the lookup table made once.  The filter carries func as its `point`
+    attribute, so that filter_cascade can fold it together with neighbouring
+    point filters.
+    """
+    lut = make_lut(func)
+    def point(im):
+        return apply_per_pixel(im, func, lut)
+    point.point = func
+    point.keeps_input = True
+    return point
+
 # HELPER FUNCTIONS
     
-def correlate(image, kernel):
+def correlate(image, kernel, exact=False):
     """
     Compute the result of correlating the given image with the given kernel.
 
@@ -71,26 +245,435 @@ def correlate(image, kernel):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
 
-    DESCRIBE YOUR KERNEL REPRESENTATION HERE
+    The kernel is a list of n rows, each a list of n numbers, centered on the
+    pixel being computed, or a kernel already prepared by compile_kernel.
+    Box kernels (every entry the same) are computed from running window
+    sums, so their cost does not depend on n; other separable integer
+    kernels are computed as a horizontal pass followed by a vertical pass;
+    any other kernel goes through correlate_general, which adds the taps in
+    the same order as correlate_pixel (two passes would round float sums
+    differently).
+
+    Integer kernels on integer pixels are summed entirely in integers.  By
+    default a box kernel of 1/d entries reproduces the rounding of a float
+    sum taken tap by tap; with exact=True (and integer pixels) its results
+    are instead the integer window sum divided once by d, so the rounding of
+    those results is exact.
+    """
+    kernel = compile_kernel(kernel)
+    if kernel['box'] is not None:
+        return correlate_box(image, kernel['size'], kernel['box'], exact=exact)
+    if kernel['separable'] is not None:
+        column, row = kernel['separable']
+        return correlate_separable(image, column, row)
+    return correlate_general(image, kernel)
+
+def compile_kernel(kernel):
+    """
+    Prepare a kernel (a list of rows) for correlate, returning a dictionary
+    with:
+        'rows': the kernel entries, as a tuple of tuples
+        'size', 'radius': the number of rows and the distance from the
+            center row to the top row
+        'extent': how far the kernel reaches (up, down, left, right)
+        'taps': the non-zero entries as (row offset, column offset, value),
+            in row-major order
+        'box': the common value of every entry of a box kernel, or None
+        'separable': integer (column, row) factors of a rank-1 integer
+            kernel, or None
+        'integer': True if every entry is an integer
+        'gain': the sum of the absolute values of the entries, which bounds
+            how much larger than the pixels the results can be
+    ('integer' and 'gain' let backend.py and parallel.py size integer
+    buffers.)
+    A kernel that is already compiled is returned unchanged.
+    """
+    if isinstance(kernel, dict):
+        return kernel
+    rows = tuple(tuple(row) for row in kernel)
+    n = len(rows)
+    dis = n//2
+    width = max([len(row) for row in rows] + [0])
+    integer = all(isinstance(k, int) for row in rows for k in row)
+    return {
+        'rows': rows,
+        'size': n,
+        'radius': dis,
+        'extent': (dis, max(n-1-dis, 0), dis, max(width-1-dis, 0)),
+        'taps': [(i-dis, z-dis, rows[i][z]) for i in range(n)
+                 for z in range(len(rows[i])) if rows[i][z]],
+        'box': box_kernel_value(rows),
+        'separable': separate_kernel(rows) if integer else None,
+        'integer': integer,
+        'gain': sum(abs(k) for row in rows for k in row),
+    }
+
+# compiled kernels by (kind, size), least recently used first
+KERNEL_CACHE = {}
+KERNEL_CACHE_SIZE = 64
+
+def cached_kernel(kind, n):
+    """
+    Return the compiled kernel of the given kind ('box' for box_blur(n)) and
+    size, compiling it only if it is not among the KERNEL_CACHE_SIZE most
+    recently used ones.
+    """
+    key = (kind, n)
+    if key in KERNEL_CACHE:
+        kernel = KERNEL_CACHE.pop(key)
+    else:
+        kernel = compile_kernel(KERNEL_KINDS[kind](n))
+        if len(KERNEL_CACHE) >= KERNEL_CACHE_SIZE:
+            del KERNEL_CACHE[next(iter(KERNEL_CACHE))]
+    # (re-)insert as the most recently used
+    KERNEL_CACHE[key] = kernel
+    return kernel
+
+def correlate_pixel(image, kernel, x, y):
+    """
+    Return the correlation of the kernel with the image at (x, y), summing
+    the kernel entries row by row.
     """
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': ([0]*len(image['pixels'])),
-        }
-    #distance from center to edge of kernal
     dis = len(kernel)//2
-    #iterate over every pixel in image
-    for x in range(image['width']):
-        for y in range(image['height']):
-            cor = 0;
-            for i in range(len(kernel)):
-                for z in range(len(kernel[i])):
-                    cor += get_pixel_outRange(image, x-dis+z, y-dis+i) * kernel[i][z]
-            set_pixel(result, x, y, cor)
-    return result
-    raise NotImplementedError
+    cor = 0
+    for i in range(len(kernel)):
+        for z in range(len(kernel[i])):
+            cor += get_pixel_outRange(image, x-dis+z, y-dis+i) * kernel[i][z]
+    return cor
+
+def box_kernel_value(kernel):
+    """
+    Return the common value of every entry if the kernel is a square box
+    kernel whose value is an integer or 1/d for an integer d, or None
+    otherwise.  Multiplying a window sum by any other value can round
+    differently from adding the taps one by one, so those kernels are left
+    to correlate_general.
+    """
+    n = len(kernel)
+    if n == 0 or any(len(row) != n for row in kernel):
+        return None
+    value = kernel[0][0]
+    for row in kernel:
+        for k in row:
+            if k != value:
+                return None
+    if not isinstance(value, int) and box_divisor(value) is None:
+        return None
+    return value
+
+def box_divisor(value):
+    """
+    Return the integer d such that value == 1/d, or None if there is none.
+    """
+    if not value:
+        return None
+    d = round(1/value)
+    return d if d and 1/d == value else None
+
+def separate_kernel(kernel):
+    """
+    If the square kernel is separable (every row is a multiple of one row),
+    return (column, row) such that kernel[i][j] == column[i] * row[j] exactly;
+    otherwise return None.  Integer kernels are split into integer factors.
+    """
+    n = len(kernel)
+    if n == 0 or any(len(row) != n for row in kernel):
+        return None
+    # pivot on the non-zero entry of smallest magnitude so that integer
+    # kernels such as Sobel divide exactly
+    pivot = None
+    for i in range(n):
+        for j in range(n):
+            k = kernel[i][j]
+            if k and (pivot is None or abs(k) < abs(kernel[pivot[0]][pivot[1]])):
+                pivot = (i, j)
+    if pivot is None:
+        return None
+    row = list(kernel[pivot[0]])
+    p = kernel[pivot[0]][pivot[1]]
+    if all(isinstance(k, int) for r in kernel for k in r):
+        if any(kernel[i][pivot[1]] % p for i in range(n)):
+            return None
+        column = [kernel[i][pivot[1]] // p for i in range(n)]
+    else:
+        column = [kernel[i][pivot[1]] / p for i in range(n)]
+    for i in range(n):
+        for j in range(n):
+            if column[i] * row[j] != kernel[i][j]:
+                return None
+    return column, row
+
+def image_rows(image):
+    """
+    Return the rows of the image as a list of lists of pixel values.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    return [list(pixels[y*w:(y+1)*w]) for y in range(image['height'])]
+
+def extend_row(row, before, after):
+    """
+    Return the row extended by repeating its first value `before` times and
+    its last value `after` times (the edge behaviour of get_pixel_outRange).
+    """
+    return [row[0]]*before + row + [row[-1]]*after
+
+def clamp(v, low, high):
+    """
+    Return v limited to the range [low, high].
+    """
+    if v < low:
+        return low
+    if v > high:
+        return high
+    return v
+
+def correlate_separable(image, column, row):
+    """
+    Correlate the image with the kernel whose entries are column[i] * row[j]:
+    first every row with `row`, then every column of that result with
+    `column`.  Zero weights are skipped.
+    """
+    w = image['width']
+    h = image['height']
+    n = len(row)
+    dis = n//2
+    # horizontal pass
+    rows = []
+    for r in image_rows(image):
+        ext = extend_row(r, dis, n-1-dis)
+        acc = [0]*w
+        for j in range(n):
+            if row[j]:
+                k = row[j]
+                acc = [a + k*p for a, p in zip(acc, ext[j:j+w])]
+        rows.append(acc)
+    # vertical pass
+    pixels = []
+    for y in range(h):
+        acc = [0]*w
+        for i in range(n):
+            if column[i]:
+                k = column[i]
+                src = rows[clamp(y-dis+i, 0, h-1)]
+                acc = [a + k*p for a, p in zip(acc, src)]
+        pixels.extend(acc)
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+def correlate_box(image, n, value, table=None, exact=False):
+    """
+    Correlate the image with the n-by-n kernel whose entries all equal value.
+    Window sums come from running sums over the rows (see running_box_sums)
+    or, if table is given (it must be summed_area_table(image), shared by
+    several box sizes), from that table, so the cost per pixel is
+    independent of n.  exact is as
+    for correlate.  Values that are neither integers nor 1/d for an integer
+    d go through correlate_general instead (see box_kernel_value).
+    """
+    if not isinstance(value, int) and box_divisor(value) is None:
+        return correlate_general(image, [[value]*n]*n)
+    pixels = []
+    for row in box_rows(image, n, value, table, exact):
+        pixels.extend(row)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+def box_rows(image, n, value, table=None, exact=False):
+    """
+    Yield the rows of correlate_box(image, n, value, table, exact) one at a
+    time, from top to bottom, so that a caller can combine each row with the
+    image before the next one is computed.
+    """
+    if table is not None:
+        window_sums = box_sums(table, n)
+    else:
+        window_sums = running_box_sums(image, n)
+    d = box_divisor(value)
+    if exact and d is not None and d != 1 and (table is not None or integer_pixels(image)):
+        # one correctly rounded division of the exact integer sum (with
+        # d == 1 the sums below are already exact, and stay integers for
+        # an integer kernel)
+        for acc in window_sums:
+            yield [a / d for a in acc]
+        return
+    # a window sum that is exactly halfway between two multiples of 1/value
+    # would be rounded according to the float error of a tap-by-tap sum, so
+    # those few pixels are recomputed in that order
+    half = d//2 if d is not None and d % 2 == 0 else None
+    for y, acc in enumerate(window_sums):
+        row = [a*value for a in acc]
+        if half is not None:
+            for x in [x for x, a in enumerate(acc) if a % d == half]:
+                row[x] = correlate_pixel(image, [[value]*n]*n, x, y)
+        yield row
 
+def running_box_sums(image, n):
+    """
+    Yield the sums of the n-by-n windows centered on the pixels of each row
+    (beyond the edges, pixels are those of the nearest edge), keeping running
+    sums (one value in, one value out per step) in both directions.  Only
+    the horizontal sums of the rows in the current window are kept.
+    """
+    w = image['width']
+    h = image['height']
+    pixels = image['pixels']
+    dis = n//2
+    sums = {}
+    def horizontal(y):
+        # horizontal window sums of row y (clamped to the image)
+        y = clamp(y, 0, h-1)
+        if y not in sums:
+            ext = extend_row(list(pixels[y*w:(y+1)*w]), dis, n-1-dis)
+            s = sum(ext[:n])
+            row = [s]
+            for x in range(w-1):
+                s += ext[x+n] - ext[x]
+                row.append(s)
+            sums[y] = row
+        return sums[y]
+    # vertical window sums, moving the window down one row at a time
+    acc = [0]*w
+    for i in range(n):
+        acc = [a + b for a, b in zip(acc, horizontal(i-dis))]
+    for y in range(h):
+        yield acc
+        if y < h-1:
+            new = horizontal(y+n-dis)
+            old = horizontal(y-dis)
+            acc = [a + b - c for a, b, c in zip(acc, new, old)]
+            # rows above the next window are not needed again
+            for k in [k for k in sums if k <= y-dis]:
+                del sums[k]
+
+def integer_pixels(image):
+    """
+    Return True if every pixel of the greyscale image is an integer.
+    """
+    pixels = image['pixels']
+    return isinstance(pixels, (bytes, bytearray)) or all(isinstance(p, int) for p in pixels)
+
+# SUMMED-AREA TABLES
+
+def summed_area_table(image):
+    """
+    Return the summed-area table of a greyscale image, built in one pass:
+    a dictionary with the 'width' and 'height' of the image and 'rows', in
+    which rows[y][x] is the sum of the pixels above and to the left of
+    (x, y), so that the sum of any rectangle takes four lookups.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    rows = [[0]*(w+1)]
+    for y in range(image['height']):
+        # running sum along the row, added to the row above
+        s = 0
+        row = [0]
+        for p in pixels[y*w:(y+1)*w]:
+            s += p
+            row.append(s)
+        rows.append([a + b for a, b in zip(rows[-1], row)])
+    return {'width': w, 'height': image['height'], 'rows': rows}
+
+def extended_table_row(table, y):
+    """
+    Return row y of the summed-area table of the image extended beyond its
+    top and bottom edges as in get_pixel_outRange (for y < 0, the negated
+    sum of the -y rows above the image).  Each extra row repeats an edge
+    row, so outside the table the rows grow linearly.
+    """
+    rows = table['rows']
+    h = table['height']
+    if y < 0:
+        return [y*v for v in rows[1]]
+    if y > h:
+        k = y - h
+        return [a + k*(a - b) for a, b in zip(rows[h], rows[h-1])]
+    return rows[y]
+
+def extended_prefix(row, w, x):
+    """
+    Return entry x of a row of a summed-area table of width w, extended
+    beyond the left and right edges in the same way as extended_table_row.
+    """
+    if x < 0:
+        return x*row[1]
+    if x > w:
+        return row[w] + (x - w)*(row[w] - row[w-1])
+    return row[x]
+
+def rectangle_sum(table, x0, y0, x1, y1):
+    """
+    Return the sum of the pixels (x, y) with x0 <= x < x1 and y0 <= y < y1
+    of the image whose summed-area table is given, where the pixels beyond
+    the edges are those of get_pixel_outRange, in constant time.
+    """
+    w = table['width']
+    top = extended_table_row(table, y0)
+    bottom = extended_table_row(table, y1)
+    return (extended_prefix(bottom, w, x1) - extended_prefix(bottom, w, x0)
+            - extended_prefix(top, w, x1) + extended_prefix(top, w, x0))
+
+def box_sums(table, n):
+    """
+    Yield, for each row of the image whose summed-area table is given, the
+    sums of the n-by-n windows centered on its pixels (the same as
+    running_box_sums), four table entries per pixel.
+    """
+    w = table['width']
+    h = table['height']
+    dis = n//2
+    rows = {}
+    def extended(y):
+        # row y of the table, extended left and right far enough for every
+        # window; index i holds entry i-dis
+        row = extended_table_row(table, y)
+        return ([x*row[1] for x in range(-dis, 0)] + row
+                + [row[w] + k*(row[w] - row[w-1]) for k in range(1, n-dis)])
+    for y in range(h):
+        top = rows.pop(y-dis) if y-dis in rows else extended(y-dis)
+        bottom = extended(y-dis+n)
+        rows[y-dis+n] = bottom
+        diff = [b - t for b, t in zip(bottom, top)]
+        yield [b - a for a, b in zip(diff, diff[n:])]
+
+def correlate_general(image, kernel):
+    """
+    Correlate the image with an arbitrary kernel.  For pixels whose whole
+    window lies inside the image, each kernel entry is applied to a slice of
+    the flat pixel list at a fixed offset from the row start; only the border
+    band, where the window leaves the image, clamps coordinates to the
+    nearest edge pixel (through precomputed row and column offset tables).
+    """
+    w = image['width']
+    h = image['height']
+    pixels = image['pixels']
+    kernel = compile_kernel(kernel)
+    taps = kernel['taps']
+    top, bottom, left, right = kernel['extent']
+    result = [0]*(w*h)
+    # interior: the window never leaves the image
+    x0 = left
+    x1 = w - right
+    if x1 > x0:
+        for y in range(top, h-bottom):
+            acc = [0]*(x1-x0)
+            for dy, dz, k in taps:
+                start = (y+dy)*w + x0 + dz
+                acc = [a + p*k for a, p in zip(acc, pixels[start:start+x1-x0])]
+            result[y*w+x0:y*w+x1] = acc
+    # border band: clamp through the offset tables
+    row_offset = [clamp(y, 0, h-1)*w for y in range(-top, h+bottom)]
+    col_offset = [clamp(x, 0, w-1) for x in range(-left, w+right)]
+    for y in range(h):
+        if top <= y < h-bottom and x1 > x0:
+            xs = list(range(x0)) + list(range(x1, w))
+        else:
+            xs = range(w)
+        for x in xs:
+            cor = 0
+            for dy, dz, k in taps:
+                cor += pixels[row_offset[y+dy+top] + col_offset[x+dz+left]] * k
+            result[y*w+x] = cor
+    return {'height': h, 'width': w, 'pixels': result}
 
 def round_and_clip_image(image):
     """
@@ -102,96 +685,138 @@ def round_and_clip_image(image):
     Any locations with values higher than 255 in the input should have value
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
+
+    The clipped values are stored back into the dictionary as a bytearray
+    (one byte per pixel).
     """
-    for i in range(len(image['pixels'])):
-            image['pixels'][i] = int(round(image['pixels'][i]))
-            if image['pixels'][i] < 0:
-                image['pixels'][i] = 0
-            elif image['pixels'][i] > 255:
-                image['pixels'][i] = 255
+    clipped = bytearray(len(image['pixels']))
+    for i, c in enumerate(image['pixels']):
+        c = int(round(c))
+        if c < 0:
+            c = 0
+        elif c > 255:
+            c = 255
+        clipped[i] = c
+    image['pixels'] = clipped
 
 # FILTERS
 
-def blurred(image, n):
+def blurred(image, n, table=None, exact=False):
     """
     Return a new image representing the result of applying a box blur (with
     kernel size n) to the given input image.
 
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
+
+    table, if given, is summed_area_table(image), which can be shared by
+    blurs of several sizes (see blurred_sizes).  With exact=True, pixels are
+    the exact mean of their window rounded half to even, rather than the
+    rounding of a float sum (see correlate).
     """
     # first, create a representation for the appropriate n-by-n kernel (you may
     # wish to define another helper function for this)
-    box_blurred = box_blur(n)
+    box_blurred = cached_kernel('box', n)
     # then compute the correlation of the input image with that kernel
-    result = correlate(image, box_blurred)
+    result = correlate_box(image, n, box_blurred['box'], table, exact)
     # and, finally, make sure that the output is a valid image (using the
     # helper function from above) before returning it.
     round_and_clip_image(result)
     return result
 
+def blurred_sizes(image, sizes, exact=False):
+    """
+    Return blurred(image, n, exact=exact) for each n in sizes, all computed
+    from one summed-area table of the image.
+    """
+    table = summed_area_table(image) if integer_pixels(image) else None
+    return [blurred(image, n, table, exact) for n in sizes]
+
 def box_blur(n):
     """
     create a representation for the appropriate n-by-n kernel, and return it
     """
-    kernel = []
-    # generate an n-by-n kernel
-    for i in range(n):
-        # generate an empty row list
-        row = []
-        for j in range(n):
-            # n-by-n square of dentical values that sum to 1
-            row.append(1/n**2)
-        kernel.append(row)
-    return kernel
+    # n-by-n square of identical values that sum to 1
+    value = 1/n**2
+    return [[value]*n for i in range(n)]
 
-def sharpened(i, n):
+KERNEL_KINDS = {
+    'box': box_blur,
+}
+
+def sharpened(i, n, exact=False, table=None):
     """
     Returns a new image, the result of an "unsharp mask" on self.
     n is the size of box blur kernel
+
+    The blurred copy is never stored: each row of it comes from the running
+    window sums of the box blur (see running_box_sums), is combined with the
+    same row of the image and is rounded and clipped straight into the
+    output buffer.  With exact=True (and integer pixels), each pixel is
+    computed as (2*d*p - sum) / d with a single division, so it is rounded
+    exactly.  table is as for blurred.
     """
-    result = {
-        'height': i['height'],
-        'width': i['width'],
-        'pixels': ([0]*len(i['pixels'])),
-        }
-    # generate the blurred copy of the image
-    blurred = correlate(i, box_blur(n))
-    # iterate over loop and use blurred image do calculation
-    for x in range(i['width']):
-        for y in range(i['height']):
-            c = 2 * get_pixel(i, x, y)-get_pixel(blurred, x, y)
-            set_pixel(result, x, y, c)
-    # ensure that the final image is made up of integer pixels in range [0,255]
-    round_and_clip_image(result)
-    return result
+    w = i['width']
+    pixels = i['pixels']
+    result = bytearray(len(pixels))
+    if exact and (table is not None or integer_pixels(i)):
+        d = n*n
+        window_sums = box_sums(table, n) if table is not None else running_box_sums(i, n)
+        rows = ([round((2*d*p - s) / d) for p, s in zip(pixels[y*w:(y+1)*w], sums)]
+                for y, sums in enumerate(window_sums))
+    else:
+        value = cached_kernel('box', n)['box']
+        rows = ([round(2*p - b) for p, b in zip(pixels[y*w:(y+1)*w], blurred_row)]
+                for y, blurred_row in enumerate(box_rows(i, n, value, table)))
+    for y, row in enumerate(rows):
+        # ensure that the final image is made up of integer pixels in range [0,255]
+        result[y*w:(y+1)*w] = bytes([0 if c < 0 else 255 if c > 255 else c for c in row])
+    return {'height': i['height'], 'width': w, 'pixels': result}
 
 def edges(im):
+    """
+    Return a new image containing the magnitude of the Sobel gradient of the
+    given image, rounded and clipped to [0, 255].
+
+    Kx and Ky are separable, so each output row only needs the three
+    (edge-extended) input rows around it: their vertical [1, 2, 1] sum and
+    [-1, 0, 1] difference give Ox and Oy for the whole row, and the
+    magnitude is rounded and clipped right away.  The rows are kept in a
+    rolling window, so no full-size Ox, Oy or unclipped image is built.
+    """
+    w = im['width']
+    h = im['height']
+    pixels = im['pixels']
+    integral = isinstance(pixels, (bytes, bytearray)) or all(isinstance(p, int) for p in pixels)
     result = {
-        'height': im['height'],
-        'width': im['width'],
-        'pixels': ([0]*len(im['pixels'])),
+        'height': h,
+        'width': w,
+        'pixels': bytearray(w*h),
     }
-    # Initialize two kernels: Kx and Ky
-    Kx = [[-1, 0, 1],
-          [-2, 0, 2],
-          [-1, 0, 1]]
-    Ky = [[-1, -2, -1],
-          [0, 0, 0],
-          [1, 2, 1]]
-    # computing Ox and Oy by correlating the input with Kx and Ky respectively
-    Ox = correlate(im, Kx)
-    Oy = correlate(im, Ky)
-    # loop over pixels
-    for x in range(im['width']):
-        for y in range(im['height']):
-            # do calculations
-            c = ((get_pixel(Ox, x, y))**2 + (get_pixel(Oy, x, y))**2)**0.5
-            set_pixel(result, x, y, c)
-    # ensure that the final image is made up of integer pixels in range [0,255]
-    round_and_clip_image(result)
+    def extended_row(y):
+        y = clamp(y, 0, h-1)
+        return extend_row(list(pixels[y*w:(y+1)*w]), 1, 1)
+    above = extended_row(-1)
+    here = extended_row(0)
+    for y in range(h):
+        below = extended_row(y+1)
+        smooth = [a + 2*b + c for a, b, c in zip(above, here, below)]
+        diff = [c - a for a, c in zip(above, below)]
+        ox = [r - l for l, r in zip(smooth, smooth[2:])]
+        oy = [l + 2*m + r for l, m, r in zip(diff, diff[1:], diff[2:])]
+        squares = [gx*gx + gy*gy for gx, gy in zip(ox, oy)]
+        if integral:
+            row = [SOBEL_MAGNITUDE[s] if s < 65281 else 255 for s in squares]
+        else:
+            row = [min(255, max(0, int(round(s**0.5)))) for s in squares]
+        result['pixels'][y*w:(y+1)*w] = bytes(row)
+        above, here = here, below
     return result
 
+# rounded square root of every integer below 255.5**2, the largest squared
+# Sobel magnitude that does not clip to 255
+SOBEL_MAGNITUDE = bytes(round(s**0.5) for s in range(65281))
+
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
 def load_greyscale_image(filename):
@@ -199,23 +824,76 @@ def load_greyscale_image(filename):
     Loads an image from the given file and returns a dictionary
     representing that image.  This also performs conversion to greyscale.
 
+    The pixels are returned as a bytearray (one byte per pixel).
+
     Invoked as, for example:
        i = load_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
-        elif img.mode == 'L':
-            pixels = list(img_data)
-        else:
-            raise ValueError('Unsupported image mode: %r' % img.mode)
-        w, h = img.size
-        return {'height': h, 'width': w, 'pixels': pixels}
+        return greyscale_image_from_pil(img)
+
+
+def greyscale_image_from_pil(img):
+    """
+    Convert a PIL image to a greyscale image dictionary, the same way
+    load_greyscale_image does.
+    """
+    if img.mode.startswith('RGB'):
+        if img.mode != 'RGB':
+            img = Image.merge('RGB', img.split()[:3])
+        pixels = luma_from_pil(img)
+    elif img.mode == 'LA':
+        pixels = bytearray(img.getchannel(0).tobytes())
+    elif img.mode == 'L':
+        pixels = bytearray(img.tobytes())
+    else:
+        raise ValueError('Unsupported image mode: %r' % img.mode)
+    w, h = img.size
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+
+def luma_from_pil(img):
+    """
+    Return round(.299 * r + .587 * g + .114 * b) for every pixel of a PIL
+    image in mode 'RGB', as a bytearray.
+
+    PIL converts with a matrix by adding 0.5 and truncating, so converting
+    with the same weights plus and minus 0.0005 brackets the exact value:
+    both agree unless 299*r + 587*g + 114*b ends in exactly 500, where the
+    floating point expression can round either way.  Only those pixels are
+    computed in Python.
+    """
+    up = img.convert('L', (.299, .587, .114, .0005)).tobytes()
+    down = img.convert('L', (.299, .587, .114, -.0005)).tobytes()
+    pixels = bytearray(up)
+    if up != down:
+        # every byte of up is that of down or one more, so this subtraction
+        # never borrows and leaves a 1 exactly at the halfway pixels
+        halves = (int.from_bytes(up, 'little')
+                  - int.from_bytes(down, 'little')).to_bytes(len(up), 'little')
+        w = img.size[0]
+        i = halves.find(1)
+        while i >= 0:
+            r, g, b = img.getpixel((i % w, i // w))
+            pixels[i] = round(.299 * r + .587 * g + .114 * b)
+            i = halves.find(1, i+1)
+    return pixels
+
+
+def pil_from_greyscale_image(image):
+    """
+    Return a PIL image (mode 'L') with the pixels of the greyscale image.
+    """
+    size = (image['width'], image['height'])
+    try:
+        # bytes() takes byte buffers and lists of integers in [0, 255]
+        return Image.frombytes('L', size, bytes(image['pixels']))
+    except (TypeError, ValueError):
+        pass
+    out = Image.new(mode='L', size=size)
+    out.putdata(image['pixels'])
+    return out
 
 
 def save_greyscale_image(image, filename, mode='PNG'):
@@ -225,8 +903,7 @@ def save_greyscale_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = pil_from_greyscale_image(image)
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -239,13 +916,60 @@ def color_filter_from_greyscale_filter(filt):
     Given a filter that takes a greyscale image as input and produces a
     greyscale image as output, returns a function that takes a color image as
     input and produces the filtered color image.
+
+    A filter with a true `keeps_input` attribute (the library's own, such as
+    inverted, blurred and the filters of make_blur_filter) promises not to
+    modify its argument, so it is given the planes of the color image
+    without copying them; any other filter gets copies of the channels.
     """
     def color_filter(im):
-        red, green, blue = spilt_color(im)
-        result = combine_image(filt(red), filt(green), filt(blue))
+        if getattr(filt, 'keeps_input', False):
+            red, green, blue = color_planes(im)
+        else:
+            red, green, blue = spilt_color(im)
+        result = image_from_planes(filt(red), filt(green), filt(blue), im)
         return result
+    # lets filter_cascade keep the channels split between color filters
+    color_filter.greyscale = filt
     return color_filter
 
+def color_planes(im):
+    """
+    Like spilt_color, but the channels of ColorPixels share its planes
+    instead of copying them, so they must not be modified.
+    """
+    if not isinstance(im['pixels'], ColorPixels):
+        return spilt_color(im)
+    return tuple({'height': im['height'], 'width': im['width'], 'pixels': plane}
+                 for plane in im['pixels'].planes)
+
+def image_from_planes(red, green, blue, source=None):
+    """
+    Like combine_image, but byte channels become the planes of the result
+    without being copied, except for a channel that is one of the planes of
+    source (the image the channels came from) or the same as another
+    channel, so that the result never shares a plane.
+    """
+    channels = [red['pixels'], green['pixels'], blue['pixels']]
+    if not all(isinstance(c, bytearray) for c in channels):
+        return combine_image(red, green, blue)
+    shared = list(source['pixels'].planes) if source is not None and \
+        isinstance(source['pixels'], ColorPixels) else []
+    planes = []
+    for c in channels:
+        if any(c is p for p in shared + planes):
+            c = bytearray(c)
+        planes.append(c)
+    return {'height': red['height'], 'width': red['width'],
+            'pixels': ColorPixels(*planes)}
+
+# the library's greyscale filters never modify the image they are given
+# (see color_filter_from_greyscale_filter)
+inverted.keeps_input = True
+blurred.keeps_input = True
+sharpened.keeps_input = True
+edges.keeps_input = True
+
 def copy(im):
         """
         Return a new instance of Image with identical size and pixels to this
@@ -265,6 +989,11 @@ def spilt_color(im):
     red = copy(im)
     green = copy(im)
     blue = copy(im)
+    if isinstance(im['pixels'], ColorPixels):
+        # each channel is a copy of one plane
+        red['pixels'], green['pixels'], blue['pixels'] = [
+            bytearray(plane) for plane in im['pixels'].planes]
+        return red, green, blue
     # iterate over loop
     for x in range(im['width']):
         for y in range(im['height']):
@@ -280,22 +1009,21 @@ def combine_image(red, green, blue):
     result = {
         'height': red['height'],
         'width': red['width'],
-        'pixels': []
+        'pixels': pack_color_pixels(red['pixels'], green['pixels'],
+                                    blue['pixels']),
         }
-    for y in range(red['height']):
-        for x in range(red['width']):
-            result['pixels'].append((get_pixel(red, x, y), get_pixel(green, x, y),
-                                    get_pixel(blue, x, y)))
     return result
             
-def make_blur_filter(n):
+def make_blur_filter(n, exact=False):
     def blur(im):
-        return blurred(im, n)
+        return blurred(im, n, exact=exact)
+    blur.keeps_input = True
     return blur
 
-def make_sharpen_filter(n):
+def make_sharpen_filter(n, exact=False):
     def sharpen(im):
-        return sharpened(im, n)
+        return sharpened(im, n, exact)
+    sharpen.keeps_input = True
     return sharpen
     raise NotImplementedError
 
@@ -305,37 +1033,670 @@ def filter_cascade(filters):
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    The cascade is planned once, when it is built: consecutive point filters
+    (those with a `point` attribute, such as inverted) are folded into a
+    single lookup table, and a run of filters made by
+    color_filter_from_greyscale_filter splits a color image into its
+    channels once, runs the whole greyscale run on each channel, and
+    combines them once at the end.  blurred, sharpened and edges round and
+    clip their output, so consecutive ones are not merged into one kernel
+    (that would change the result).
+    """
+    plan = [stage for stage, count in plan_cascade(filters)]
+    cascade = greyscale_cascade(plan)
+    if len(plan) == 1 and hasattr(plan[0], 'greyscale'):
+        # a cascade of color filters is itself one, and can be nested
+        cascade.greyscale = plan[0].greyscale
+    return cascade
+
+def plan_cascade(filters):
+    """
+    Return the stages filter_cascade runs for the given filters, as (filter,
+    count) pairs: each stage has the effect of the next count filters
+    applied in turn.
+    """
+    runs = []
+    for filt in filters:
+        greyscale = getattr(filt, 'greyscale', None)
+        if greyscale is not None and runs and runs[-1][0] == 'color':
+            runs[-1][1].append(greyscale)
+        elif greyscale is not None:
+            runs.append(('color', [greyscale]))
+        else:
+            runs.append(('image', [filt]))
+    plan = []
+    for kind, run in runs:
+        if kind == 'color':
+            plan.append((color_filter_from_greyscale_filter(
+                greyscale_cascade(fold_point_filters(run))), len(run)))
+        else:
+            plan.append((run[0], 1))
+    return fold_point_stages(plan)
+
+def greyscale_cascade(filters):
     """
+    Return a filter that applies the given filters in turn, without any
+    planning.
+    """
+    if len(filters) == 1:
+        return filters[0]
     def filter(im):
         result = im
-        n = len(filters)
-        for i in range(n):
-            result = filters[i](result)
+        for filt in filters:
+            result = filt(result)
         return result
+    filter.keeps_input = all(getattr(filt, 'keeps_input', False) for filt in filters)
     return filter
 
+def fold_point_filters(filters):
+    """
+    Return a list of filters with the same effect as the given ones applied
+    in turn, in which every run of point filters is replaced by a single
+    point filter whose table is their composition.
+    """
+    return [filt for filt, count in fold_point_stages([(filt, 1) for filt in filters])]
+
+def fold_point_stages(stages):
+    """
+    Like fold_point_filters, for (filter, count) stages as plan_cascade
+    returns them; a folded stage counts the filters of all the stages it
+    replaces.
+    """
+    result = []
+    for filt, count in stages:
+        func = getattr(filt, 'point', None)
+        previous = getattr(result[-1][0], 'point', None) if result else None
+        if func is not None and previous is not None:
+            result[-1] = (make_point_filter(lambda c, f=previous, g=func: g(f(c))),
+                          result[-1][1] + count)
+        else:
+            result.append((filt, count))
+    return result
+
 
 # SEAM CARVING
 
 # Main Seam Carving Implementation
 
-def seam_carving(image, ncols):
+def seam_carving(image, ncols, energy=None):
     """
     Starting from the given image, use the seam carving technique to remove
     ncols (an integer) columns from the image.
+
+    The seams are the same as repeating seam_carving_step, but the greyscale
+    image, energy and cumulative energy map are kept between seams (see
+    make_seam_carver) and only the parts a removed seam can change are
+    recomputed.  energy selects another energy (see seam_energy).
+
+    At least one column must be left: ncols must be less than the width.
     """
+    if ncols >= image['width']:
+        raise ValueError('cannot remove %d columns from an image %d wide'
+                         % (ncols, image['width']))
+    carver = make_seam_carver(image, energy=energy)
     for i in range(ncols):
+        carver_remove_seam(carver, carver_seam(carver))
+    return carver_image(carver)
+
+def seam_carving_rows(image, nrows):
+    """
+    Remove nrows rows from the image by removing horizontal seams.  The
+    image is transposed once, carved with seam_carving and transposed back
+    (greyscale and energy do not depend on the orientation), so a seam is
+    a horizontal path, with ties going to the topmost pixel.
+    """
+    return transposed(seam_carving(transposed(image), nrows))
+
+def seam_insertion(image, ncols, energy=None):
+    """
+    Widen the image by ncols columns without stretching its important
+    content.  The ncols seams seam_carving would remove first are found in
+    one incremental pass (at most width-1 at a time), and a new pixel is
+    inserted to the right of every pixel of those seams, the average of it
+    and its right neighbour.  energy is as for seam_carving (an energy with
+    masks only fits the first pass, so ncols must then be less than the
+    width).
+    """
+    while ncols > 0:
+        k = min(ncols, max(image['width']-1, 1))
+        result = copy(image)
+        result['pixels'] = pixels_with(image['pixels'], image['width'],
+                                       seam_indices(image, k, energy))
+        result['width'] += k
+        image = result
+        ncols -= k
+    return image
+
+def seam_insertion_rows(image, nrows):
+    """
+    Make the image nrows rows taller by inserting horizontal seams (see
+    seam_insertion).
+    """
+    return transposed(seam_insertion(transposed(image), nrows))
+
+def content_aware_resize(image, width, height):
+    """
+    Return the image resized to width by height pixels: columns are removed
+    or inserted with vertical seams, then rows with horizontal seams.
+    """
+    if width < image['width']:
+        image = seam_carving(image, image['width'] - width)
+    elif width > image['width']:
+        image = seam_insertion(image, width - image['width'])
+    if height < image['height']:
+        image = seam_carving_rows(image, image['height'] - height)
+    elif height > image['height']:
+        image = seam_insertion_rows(image, height - image['height'])
+    return image
+
+def seam_indices(image, k, energy=None):
+    """
+    Return the indices into the pixels of the image of the first k seams
+    that seam_carving would remove with the given energy (k must be less
+    than the width, unless the image is one column wide).
+    """
+    if image['width'] < 2:
+        return [y for y in range(image['height'])]*k
+    carver = make_seam_carver(image, energy=energy)
+    for i in range(k):
+        carver_remove_seam(carver, carver_seam(carver))
+    return carver['removed']
+
+def pyramid_seam_carving(image, ncols, levels=2, band=None):
+    """
+    Remove ncols columns like seam_carving, but find the seams coarse to
+    fine, trading exactness for speed on large images (see
+    pyramid_seam_indices for the meaning of levels and band).
+    """
+    result = copy(image)
+    result['pixels'] = pixels_without(image['pixels'],
+                                      pyramid_seam_indices(image, ncols, levels, band))
+    result['width'] -= ncols
+    return result
+
+def pyramid_seam_indices(image, ncols, levels=2, band=None):
+    """
+    Return the indices into the pixels of the image of ncols approximate
+    minimum-energy seams, found coarse to fine.
+
+    The greyscale image is shrunk by f = 2**levels in both directions and
+    carved exactly at that size; each coarse seam is projected to full
+    resolution and guides the next f full-resolution seams, each of which is
+    the cheapest path (by the same cumulative energy, with the same
+    tie-breaking) that stays within band pixels of the projected seam.
+    Only that band's cumulative energy is computed, and the full-resolution
+    energy is kept up to date incrementally as in seam_carving.
+
+    levels=0 is the exact carver; more levels and a narrower band (at least
+    f, the default) are faster and further from it.
+    """
+    if ncols >= image['width']:
+        raise ValueError('cannot remove %d columns from an image %d wide'
+                         % (ncols, image['width']))
+    if levels == 0:
+        return seam_indices(image, ncols)
+    f = 2**levels
+    band = max(band or f, f)
+    fine = make_seam_carver(image, cumulative=False)
+    grey = {'height': fine['height'], 'width': fine['width'],
+            'pixels': bytearray().join(fine['grey'])}
+    small = downsampled(grey, f)
+    coarse = make_seam_carver(small, small)
+    for i in range(ncols):
+        if coarse['width'] > 1:
+            guide = carver_seam(coarse)
+        else:
+            guide = None
+        carver_remove_seam(fine, band_seam(fine, guide, coarse, band))
+        if guide is not None and (i+1) % f == 0:
+            carver_remove_seam(coarse, guide)
+    return fine['removed']
+
+def band_seam(carver, guide, coarse, band):
+    """
+    Return the minimum-energy seam of the carver among the seams within band
+    columns of the coarse seam guide (a column of the coarse carver for each
+    of its rows) scaled up to the carver's size, or among all seams if guide
+    is None.
+    """
+    w = carver['width']
+    h = carver['height']
+    energy = carver['energy']
+    # the columns [lo, hi] each row may use
+    bounds = []
+    for y in range(h):
+        if guide is None:
+            bounds.append((0, w-1))
+            continue
+        cx = guide[min(y*coarse['height']//h, coarse['height']-1)]
+        g = (2*cx + 1)*w // (2*coarse['width'])
+        bounds.append((max(g-band, 0), min(g+band, w-1)))
+    lo, hi = bounds[0]
+    prev = list(energy[0][lo:hi+1])
+    parents = [None]
+    infinity = float('inf')
+    for y in range(1, h):
+        plo, phi = lo, hi
+        lo, hi = bounds[y]
+        row = []
+        back = []
+        for x in range(lo, hi+1):
+            a = max(x-1, plo, 0)
+            b = min(x+1, phi, w-1)
+            if a > b:
+                row.append(infinity)
+                back.append(None)
+                continue
+            window = prev[a-plo:b-plo+1]
+            m = min(window)
+            row.append(energy[y][x] + m)
+            back.append(a + window.index(m))
+        prev = row
+        parents.append((lo, back))
+    x = lo + prev.index(min(prev))
+    seam = [x]
+    for y in range(h-1, 0, -1):
+        start, back = parents[y]
+        x = back[x-start]
+        seam.append(x)
+    seam.reverse()
+    return seam
+
+def downsampled(image, f):
+    """
+    Return a greyscale image shrunk by f in both directions, each pixel the
+    rounded mean of an f-by-f block (smaller at the right and bottom edges).
+    """
+    w = image['width']
+    h = image['height']
+    pixels = image['pixels']
+    result = []
+    for top in range(0, h, f):
+        rows = [pixels[y*w:(y+1)*w] for y in range(top, min(top+f, h))]
+        sums = [sum(column) for column in zip(*rows)]
+        for left in range(0, w, f):
+            block = sums[left:left+f]
+            result.append((2*sum(block) + len(rows)*len(block)) // (2*len(rows)*len(block)))
+    return {'height': -(-h // f), 'width': -(-w // f), 'pixels': bytearray(result)}
+
+def transposed(image):
+    """
+    Return the image flipped over its main diagonal, so that its rows are
+    the columns of the given image.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    def columns(values):
+        if isinstance(values, (bytes, bytearray)):
+            return bytearray().join(values[x::w] for x in range(w))
+        return [v for x in range(w) for v in values[x::w]]
+    if isinstance(pixels, ColorPixels):
+        pixels = ColorPixels(*[columns(plane) for plane in pixels.planes])
+    else:
+        pixels = columns(pixels)
+    return {'height': w, 'width': image['height'], 'pixels': pixels}
+
+def seam_carving_step(image):
+    """
+    Remove one seam from the image, computing everything from scratch.  The
+    image must be at least two columns wide.
+    """
+    if image['width'] < 2:
+        raise ValueError('cannot remove a seam from an image %d wide' % image['width'])
     # Make a greyscale copy of the current image
-        result = greyscale_image_from_color_image(image)
+    result = greyscale_image_from_color_image(image)
     # calculate energy map by calling the compute_energy function
-        energy = compute_energy(result)
+    energy = compute_energy(result)
     # Compute a "cumulative energy map"
-        energy_map = cumulative_energy_map(energy)
+    energy_map, parents = cumulative_energy_with_parents(energy)
     # find minimum energy seam
-        min_list = minimum_energy_seam(energy_map)
+    min_list = minimum_energy_seam(energy_map, parents)
     # remove the computed path
-        image = image_without_seam(image, min_list)
-    return image
+    return image_without_seam(image, min_list)
+
+# Incremental Seam Carving
+
+def make_seam_carver(image, grey=None, cumulative=True, energy=None):
+    """
+    Return the state kept by seam_carving between seams, as a dictionary:
+        'width', 'height': the current size
+        'image': the original image
+        'columns': for each row, the columns of the original image that
+            are still there
+        'removed': the indices into the original pixels that were removed
+        'grey': the greyscale image, as a list of bytearray rows
+        'energy_spec': the energy in use (see seam_energy)
+        'energy': its value at each pixel, as a list of rows, along with any
+            rows the energy caches (its 'planes')
+        'cumulative': the cumulative energy map, as a list of rows, or None
+            if cumulative is False (for callers that find seams some other
+            way)
+    The color pixels are only touched once, by carver_image.  grey, if
+    given, is used instead of the greyscale version of the image.
+    """
+    w = image['width']
+    h = image['height']
+    if grey is None:
+        grey = greyscale_image_from_color_image(image)
+    spec = seam_energy(energy)
+    carver = {
+        'width': w,
+        'height': h,
+        'image': image,
+        'columns': [list(range(w)) for y in range(h)],
+        'removed': [],
+        'grey': [bytearray(grey['pixels'][y*w:(y+1)*w]) for y in range(h)],
+        'energy_spec': spec,
+    }
+    spec['compute'](carver)
+    if cumulative:
+        carver['cumulative'] = cumulative_rows(carver['energy'], carver['grey'],
+                                               spec.get('costs'))
+    else:
+        carver['cumulative'] = None
+    return carver
+
+def carver_image(carver):
+    """
+    Return the current image of a seam carver.
+    """
+    return {'height': carver['height'], 'width': carver['width'],
+            'pixels': pixels_without(carver['image']['pixels'], carver['removed'])}
+
+def cumulative_rows(energy_rows, grey=None, costs=None):
+    """
+    Return the cumulative energy map of the given energy rows, with the same
+    values as cumulative_energy_map: each entry adds the smallest of the (up
+    to) three entries above it.  If costs is given (see seam_energy), the
+    cost of each step is added to the entry it comes from.
+    """
+    result = [list(energy_rows[0])] if energy_rows else []
+    if costs is not None:
+        for y, row in enumerate(energy_rows[1:], 1):
+            prev = result[-1]
+            w = len(row)
+            result.append([e + cheapest_step(prev, costs(grey, x, y, w), x, w)[0]
+                           for x, e in enumerate(row)])
+        return result
+    for row in energy_rows[1:]:
+        prev = result[-1]
+        left = prev[:1] + prev[:-1]
+        right = prev[1:] + prev[-1:]
+        result.append([e + min(a, b, c) for e, a, b, c in zip(row, left, prev, right)])
+    return result
+
+def cheapest_step(prev, costs, x, w):
+    """
+    Return (value, column) for the cheapest way to reach column x from the
+    row above, whose cumulative values are prev, when stepping from the
+    left, middle and right costs the three given costs.  Ties go to the
+    leftmost column.
+    """
+    best, column = None, None
+    for c, cost in zip(range(x-1, x+2), costs):
+        if 0 <= c < w:
+            value = prev[c] + cost
+            if best is None or value < best:
+                best, column = value, c
+    return best, column
+
+def carver_seam(carver):
+    """
+    Return the minimum-energy seam of a seam carver, as the column of the
+    seam in each row from top to bottom.  Ties go to the leftmost pixel, as
+    in minimum_energy_seam.
+    """
+    w = carver['width']
+    cumulative = carver['cumulative']
+    costs = carver['energy_spec'].get('costs')
+    last = cumulative[-1]
+    x = last.index(min(last))
+    seam = [x]
+    for y in range(len(cumulative)-1, 0, -1):
+        row = cumulative[y-1]
+        if costs is not None:
+            x = cheapest_step(row, costs(carver['grey'], x, y, w), x, w)[1]
+        else:
+            lo = max(x-1, 0)
+            window = row[lo:min(x+2, w)]
+            x = lo + window.index(min(window))
+        seam.append(x)
+    seam.reverse()
+    return seam
+
+def sobel_pixel(rows, x, y, w, h):
+    """
+    Return the value of edges() at (x, y) for an image given as rows of
+    integer pixels.
+    """
+    above = rows[max(y-1, 0)]
+    here = rows[y]
+    below = rows[min(y+1, h-1)]
+    l = max(x-1, 0)
+    r = min(x+1, w-1)
+    ox = (above[r] + 2*here[r] + below[r]) - (above[l] + 2*here[l] + below[l])
+    oy = (below[l] + 2*below[x] + below[r]) - (above[l] + 2*above[x] + above[r])
+    s = ox*ox + oy*oy
+    return SOBEL_MAGNITUDE[s] if s < 65281 else 255
+
+def carver_remove_seam(carver, seam):
+    """
+    Remove the seam (a column for each row) from a seam carver.
+
+    Greyscale values depend on one pixel only, so they are just deleted.
+    The energy of a pixel depends on its 3-by-3 neighbourhood, which is
+    unchanged (up to a shift) unless a column within one of it was removed
+    in one of its rows, so in each row only the columns between
+    min(seam)-1 and max(seam) over that row and its neighbours are updated
+    by the energy.  A cumulative value is recomputed only there and below a
+    cumulative value that changed in the row above.
+    """
+    w = carver['width'] - 1
+    h = carver['height']
+    spec = carver['energy_spec']
+    original_width = carver['image']['width']
+    for y, (columns, x) in enumerate(zip(carver['columns'], seam)):
+        carver['removed'].append(y*original_width + columns.pop(x))
+    for key in ('grey', 'energy', 'cumulative') + spec.get('planes', ()):
+        if carver[key] is not None:
+            for row, x in zip(carver[key], seam):
+                del row[x]
+    carver['width'] = w
+    grey = carver['grey']
+    energy = carver['energy']
+    cumulative = carver['cumulative']
+    update = spec['update']
+    costs = spec.get('costs')
+    changed = None
+    for y in range(h):
+        near = seam[max(y-1, 0):y+2]
+        lo = max(min(near)-1, 0)
+        hi = min(max(near), w-1)
+        update(carver, seam, y, lo, hi)
+        if cumulative is None:
+            continue
+        if changed is not None:
+            lo = min(lo, max(changed[0]-1, 0))
+            hi = max(hi, min(changed[1]+1, w-1))
+        row = cumulative[y]
+        prev = cumulative[y-1] if y else None
+        changed = None
+        for x in range(lo, hi+1):
+            c = energy[y][x]
+            if prev is None:
+                pass
+            elif costs is not None:
+                c += cheapest_step(prev, costs(grey, x, y, w), x, w)[0]
+            else:
+                c += min(prev[max(x-1, 0):x+2])
+            if c != row[x]:
+                row[x] = c
+                changed = (x, x) if changed is None else (changed[0], x)
+
+# Seam Energies
+#
+# An energy is a dictionary of functions used by the seam carver:
+#     'compute': compute(carver) sets carver['energy'] (and any cached rows)
+#         from carver['grey'] for the whole image, once
+#     'update': update(carver, seam, y, lo, hi) is called for every row y
+#         after the seam has been deleted from all the rows, and must set
+#         carver['energy'][y][x] for lo <= x <= hi, the only columns whose
+#         energy can have changed
+#     'planes' (optional): the names of other rows the energy keeps in the
+#         carver, from which the seam is deleted along with the energy
+#     'costs' (optional): costs(grey, x, y, w) returns the extra cost of
+#         reaching (x, y) from the row above from the left, middle and right
+#         (it may only look at the 3-by-2 neighbourhood ending at (x, y))
+
+def seam_energy(energy):
+    """
+    Return the energy named by energy (a key of ENERGIES, or None for
+    'sobel'), or energy itself if it is already a dictionary.
+    """
+    if energy is None:
+        energy = 'sobel'
+    if isinstance(energy, dict):
+        return energy
+    if energy not in ENERGIES:
+        raise ValueError('Unknown energy: %r (available: %s)'
+                         % (energy, ', '.join(sorted(ENERGIES))))
+    return ENERGIES[energy]
+
+def sobel_compute(carver):
+    """
+    Set the energy of a carver to compute_energy of its greyscale image.
+    """
+    w = carver['width']
+    grey = {'height': carver['height'], 'width': w,
+            'pixels': bytearray().join(carver['grey'])}
+    pixels = bytearray(compute_energy(grey)['pixels'])
+    carver['energy'] = [pixels[y*w:(y+1)*w] for y in range(carver['height'])]
+
+def sobel_update(carver, seam, y, lo, hi):
+    """
+    Recompute the Sobel energy of columns lo to hi of row y.
+    """
+    grey = carver['grey']
+    row = carver['energy'][y]
+    w = carver['width']
+    h = carver['height']
+    for x in range(lo, hi+1):
+        row[x] = sobel_pixel(grey, x, y, w, h)
+
+def gradient_compute(carver):
+    """
+    Set the energy of a carver to the gradient magnitude |dx| + |dy| of its
+    greyscale image, with central differences (pixels beyond the edges are
+    the nearest edge pixel), keeping the two terms as the 'ox' and 'oy'
+    rows.
+    """
+    grey = carver['grey']
+    h = carver['height']
+    carver['ox'] = [bytearray(abs(r - l) for l, r in zip(row[:1] + row[:-1], row[1:] + row[-1:]))
+                    for row in grey]
+    carver['oy'] = [bytearray(abs(b - a) for a, b in zip(grey[max(y-1, 0)], grey[min(y+1, h-1)]))
+                    for y in range(h)]
+    carver['energy'] = [[a + b for a, b in zip(ox, oy)]
+                        for ox, oy in zip(carver['ox'], carver['oy'])]
+
+def gradient_update(carver, seam, y, lo, hi):
+    """
+    Update the gradient energy of columns lo to hi of row y.  dx only
+    depends on row y, so it is only recomputed next to the seam in that
+    row; dy is recomputed from lo to hi.
+    """
+    grey = carver['grey']
+    w = carver['width']
+    h = carver['height']
+    here = grey[y]
+    above = grey[max(y-1, 0)]
+    below = grey[min(y+1, h-1)]
+    ox = carver['ox'][y]
+    oy = carver['oy'][y]
+    for x in range(max(seam[y]-1, 0), min(seam[y], w-1)+1):
+        ox[x] = abs(here[min(x+1, w-1)] - here[max(x-1, 0)])
+    row = carver['energy'][y]
+    for x in range(lo, hi+1):
+        oy[x] = abs(below[x] - above[x])
+        row[x] = ox[x] + oy[x]
+
+def forward_compute(carver):
+    """
+    Forward energy has no energy of its own, only step costs.
+    """
+    carver['energy'] = [bytearray(carver['width']) for y in range(carver['height'])]
+
+def forward_update(carver, seam, y, lo, hi):
+    """
+    Forward energy has no energy of its own, only step costs.
+    """
+    carver['energy'][y][lo:hi+1] = bytes(hi+1-lo)
+
+def forward_costs(grey, x, y, w):
+    """
+    Return the forward energy costs of reaching (x, y) from the left, middle
+    and right: the differences between the pixels that become neighbours
+    when the pixel at (x, y) is removed, as in Rubinstein, Shamir and Avidan
+    (2008).
+    """
+    here = grey[y]
+    left = here[max(x-1, 0)]
+    right = here[min(x+1, w-1)]
+    up = grey[y-1][x]
+    middle = abs(right - left)
+    return (middle + abs(up - left), middle, middle + abs(up - right))
+
+ENERGIES = {
+    'sobel': {'compute': sobel_compute, 'update': sobel_update},
+    'gradient': {'compute': gradient_compute, 'update': gradient_update,
+                 'planes': ('ox', 'oy')},
+    'forward': {'compute': forward_compute, 'update': forward_update,
+                'costs': forward_costs},
+}
+
+MASK_ENERGY = 1 << 20
+
+def masked_energy(energy=None, protect=None, remove=None, weight=MASK_ENERGY):
+    """
+    Return an energy that adds weight to the energy (see seam_energy) of the
+    pixels that are not 0 in the greyscale image protect, and subtracts it
+    from those that are not 0 in remove, so that seams avoid the first and
+    go through the second.  The masks must be the size of the image being
+    carved, and are carved along with it.
+    """
+    base = seam_energy(energy)
+
+    def compute(carver):
+        w = carver['width']
+        h = carver['height']
+        bonus = [0]*(w*h)
+        for mask, sign in ((protect, 1), (remove, -1)):
+            if mask is None:
+                continue
+            if (mask['width'], mask['height']) != (w, h):
+                raise ValueError('mask is %dx%d, image is %dx%d'
+                                 % (mask['width'], mask['height'], w, h))
+            for i, p in enumerate(mask['pixels']):
+                if p:
+                    bonus[i] += sign*weight
+        carver['mask'] = [bonus[y*w:(y+1)*w] for y in range(h)]
+        base['compute'](carver)
+        carver['energy'] = [[e + b for e, b in zip(row, m)]
+                            for row, m in zip(carver['energy'], carver['mask'])]
+
+    def update(carver, seam, y, lo, hi):
+        base['update'](carver, seam, y, lo, hi)
+        row = carver['energy'][y]
+        mask = carver['mask'][y]
+        for x in range(lo, hi+1):
+            row[x] += mask[x]
+
+    result = {'compute': compute, 'update': update,
+              'planes': base.get('planes', ()) + ('mask',)}
+    if 'costs' in base:
+        result['costs'] = base['costs']
+    return result
 
 # Optional Helper Functions for Seam Carving
 
@@ -346,12 +1707,13 @@ def greyscale_image_from_color_image(image):
     Returns a greyscale image (represented as a dictionary).
     """
     result = copy(image)
-    # iterate every pixels in image and set the pixel in result as greyscale
-    for y in range(image['height']):
-        for x in range(image['width']):
-            set_pixel(result, x, y, round(.299 * get_pixel(image, x, y)[0] +
-                                      .587 * get_pixel(image, x, y)[1] +
-                                      .114 * get_pixel(image, x, y)[2]))
+    pixels = image['pixels']
+    if isinstance(pixels, ColorPixels) and len(pixels):
+        result['pixels'] = luma_from_pil(pil_from_color_image(image))
+        return result
+    # convert every pixel in image (in row-major order) to greyscale
+    result['pixels'] = pack_pixels([round(.299 * r + .587 * g + .114 * b)
+                                    for r, g, b in pixels])
     return result
 
 def compute_energy(grey):
@@ -373,18 +1735,47 @@ def cumulative_energy_map(energy):
     the values in the 'pixels' array may not necessarily be in the range [0,
     255].
     """
+    return cumulative_energy_with_parents(energy)[0]
+
+def cumulative_energy_with_parents(energy):
+    """
+    Compute the cumulative energy map one row at a time, and record for
+    every pixel (below the top row) the index into 'pixels' of the adjacent
+    pixel above it whose cumulative energy was added, choosing the leftmost
+    one on ties, as adjacent_pixels does.  Returns (cumulative energy map,
+    list of those indices), where the top row's entries are None.
+    """
+    w = energy['width']
+    h = energy['height']
+    pixels = energy['pixels']
     result = copy(energy)
-    # For each pixel in the row
-    for y in range(energy['height']):
-        for x in range(energy['width']):
-            # Set this value in the "cumulative energmap" to be:
-            # the value of that location in the energy map, added to the
-            # minimum of the cumulative energies from the "adjacent" pixels in the row
-            # above
-            pre_energy = adjacent_pixels(result, x, y)[0]
-            c = pre_energy + get_pixel(energy, x, y)
-            set_pixel(result, x, y, c)
-    return result
+    if w < 2:
+        # a single column: adjacent_pixels reads the (still zero) pixel
+        # being computed, so nothing is added
+        result['pixels'] = list(pixels)
+        return result, [None]*len(pixels)
+    # Set every value in the "cumulative energy map" to be:
+    # the value of that location in the energy map, added to the
+    # minimum of the cumulative energies from the "adjacent" pixels in the row
+    # above
+    prev = list(pixels[:w])
+    values = list(prev)
+    parents = [None]*w
+    for y in range(1, h):
+        # entry x of left, prev and right is the pixel above-left, above and
+        # above-right of x (the edge columns repeat their own pixel instead)
+        left = prev[:1] + prev[:-1]
+        right = prev[1:] + prev[-1:]
+        base = (y-1)*w
+        row = [e + min(a, b, c) for e, a, b, c in zip(pixels[y*w:(y+1)*w], left, prev, right)]
+        parents.extend([base + x-1 if a <= b and a <= c else base + x if b <= c else base + x+1
+                        for x, a, b, c in zip(range(w), left, prev, right)])
+        if parents[y*w] < base:
+            parents[y*w] = base
+        values.extend(row)
+        prev = row
+    result['pixels'] = values
+    return result, parents
 
 def adjacent_pixels(im, x, y):
     """
@@ -415,18 +1806,29 @@ def adjacent_pixels(im, x, y):
                 x1 = i
     return (mini, x1)
 
-def minimum_energy_seam(c):
+def minimum_energy_seam(c, parents=None):
     """
     Given a cumulative energy map, returns a list of the indices into the
     'pixels' list that correspond to pixels contained in the minimum-energy
     seam (computed as described in the lab 1 writeup).
+
+    parents, if given, are the back-pointers from
+    cumulative_energy_with_parents, and the seam is found by following
+    them up from the bottom row.
     """
     energy_cols = []
     # Get the x coordinate of minimum pixel in the last row
-    x1 = c['pixels'][((c['height']-1)*c['width']):].index(min(c['pixels'][((c['height']-1)*c['width']):]))
+    last = c['pixels'][((c['height']-1)*c['width']):]
+    x1 = last.index(min(last))
     # calculate the index of that pixel
     index = x1 + c['width']*(c['height']-1)
     energy_cols.append(index)
+    if parents is not None and c['width'] > 1:
+        for y in range(c['height']-1):
+            index = parents[index]
+            energy_cols.append(index)
+        energy_cols.reverse()
+        return energy_cols
     # iterate over loop, starting from the second last row to the top row
     for y in range(c['height']-2, -1, -1):
         # set x1 to the x coordinate of minimum pixel in that row
@@ -445,17 +1847,79 @@ def image_without_seam(im, s):
     in the given list.
     """
     result = copy(im)
-    # generate result as a copy of im
-    for y in range(im['height']):
-        for x in range(im['width']):
-            set_pixel(result, x, y, get_pixel(im, x, y))
-    # pop out index from result in the list
-    for i in range(len(s)-1, -1, -1):
-        result['pixels'].pop(s[i])
+    result['pixels'] = pixels_without(im['pixels'], s)
     # adjust the width of the im
     result['width']-=1
     return result
 
+def image_without_seams(im, seams):
+    """
+    Remove several seams at once.  Each seam is a list of indices as
+    returned by minimum_energy_seam, into the image left after removing the
+    seams before it (the order in which seam_carving finds them); the pixels
+    of the original image are then compacted in a single pass.
+    """
+    w = im['width']
+    # the columns of the original image still left in each row
+    columns = [list(range(w)) for y in range(im['height'])]
+    removed = []
+    for k, seam in enumerate(seams):
+        for i in seam:
+            y, x = divmod(i, w-k)
+            removed.append(y*w + columns[y].pop(x))
+    result = copy(im)
+    result['pixels'] = pixels_without(im['pixels'], removed)
+    result['width'] = w - len(seams)
+    return result
+
+def pixels_with(pixels, width, indices):
+    """
+    Return a copy of the pixels (a bytearray, ColorPixels or list, for an
+    image of the given width) with a new pixel after each of the given
+    indices (an index may appear more than once): the average of that pixel
+    and the one to its right, or a copy of it at the right edge.
+    """
+    positions = sorted(indices)
+    def average(a, b):
+        if isinstance(a, tuple):
+            return tuple((u + v + 1)//2 for u, v in zip(a, b))
+        return (a + b + 1)//2
+    def widen(values):
+        pieces = []
+        start = 0
+        for i in positions:
+            j = i if i % width == width-1 else i+1
+            pieces.append(values[start:i+1])
+            new = average(values[i], values[j])
+            pieces.append(bytes((new,)) if isinstance(values, (bytes, bytearray)) else [new])
+            start = i+1
+        pieces.append(values[start:])
+        if isinstance(values, (bytes, bytearray)):
+            return bytearray().join(pieces)
+        return [v for piece in pieces for v in piece]
+    if isinstance(pixels, ColorPixels):
+        return ColorPixels(*[widen(plane) for plane in pixels.planes])
+    return widen(pixels)
+
+def pixels_without(pixels, indices):
+    """
+    Return a copy of the pixels (a bytearray, ColorPixels or list) without
+    the ones at the given indices, joined from the slices between them.
+    """
+    bounds = []
+    start = 0
+    for i in sorted(indices):
+        bounds.append((start, i))
+        start = i+1
+    bounds.append((start, len(pixels)))
+    def compact(values):
+        if isinstance(values, (bytes, bytearray)):
+            return bytearray().join(values[a:b] for a, b in bounds)
+        return [v for a, b in bounds for v in values[a:b]]
+    if isinstance(pixels, ColorPixels):
+        return ColorPixels(*[compact(plane) for plane in pixels.planes])
+    return compact(pixels)
+
 def threshold(im, low, high):
     red, green, blue = spilt_color(im)
     red = threshold_Helper(red, low, high)
@@ -465,34 +1929,51 @@ def threshold(im, low, high):
     return result
 
 def threshold_Helper(im, low, high):
-    result = copy(im)
-    for y in range(im['height']):
-        for x in range(im['width']):
-            if(get_pixel(im, x, y) > high):
-                set_pixel(result, x, y, 255)
-            elif(get_pixel(im, x, y) < low):
-                set_pixel(result, x, y, 0)
-            else:
-                set_pixel(result, x, y, get_pixel(im, x, y))
-    return result
+    """
+    Set pixels above high to 255 and pixels below low to 0, leaving the rest
+    unchanged (a point operation, so it is applied through a lookup table).
+    """
+    return apply_per_pixel(im, lambda c: 255 if c > high else 0 if c < low else c)
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING COLOR IMAGES
 
 def load_color_image(filename):
     """
     Loads a color image from the given file and returns a dictionary
-    representing that image.
+    representing that image.  The pixels are returned as ColorPixels, which
+    stores the red, green and blue planes as PIL splits them.
 
     Invoked as, for example:
        i = load_color_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img = img.convert('RGB')  # in case we were given a greyscale image
-        img_data = img.getdata()
-        pixels = list(img_data)
-        w, h = img.size
-        return {'height': h, 'width': w, 'pixels': pixels}
+        return color_image_from_pil(img)
+
+
+def color_image_from_pil(img):
+    """
+    Convert a PIL image to a color image dictionary, the same way
+    load_color_image does.
+    """
+    img = img.convert('RGB')  # in case we were given a greyscale image
+    pixels = ColorPixels(*[bytearray(band.tobytes()) for band in img.split()])
+    w, h = img.size
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+
+def pil_from_color_image(image):
+    """
+    Return a PIL image (mode 'RGB') with the pixels of the color image.
+    """
+    size = (image['width'], image['height'])
+    if isinstance(image['pixels'], ColorPixels):
+        # the planes are only interleaved here, on the way out
+        return Image.merge('RGB', [Image.frombytes('L', size, bytes(plane))
+                                   for plane in image['pixels'].planes])
+    out = Image.new(mode='RGB', size=size)
+    out.putdata(image['pixels'])
+    return out
 
 
 def save_color_image(image, filename, mode='PNG'):
@@ -502,8 +1983,7 @@ def save_color_image(image, filename, mode='PNG'):
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
     """
-    out = Image.new(mode='RGB', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = pil_from_color_image(image)
     if isinstance(filename, str):
         out.save(filename)
     else:
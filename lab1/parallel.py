@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+"""
+Run correlate and the greyscale filters on several processes at once.
+
+The image is split into horizontal bands, each processed with `halo` extra
+rows above and below it exactly as in tiled.py, so the result is identical
+to the single-process filter.  The input pixels are copied once into a
+shared memory block that every worker maps, and each worker writes its
+rows straight into a shared output block, so no pixel data is pickled
+between processes: a task is only (function, arguments, band bounds and
+the names of the blocks).
+
+The worker processes and the two shared blocks are kept between calls: the
+module starts one pool (get_pool), grown when a call asks for more workers,
+and reuses the blocks while they are big enough, so a call only pays for
+copying the pixels in and out.  Any call can be given pool=, a
+ProcessPoolExecutor of the caller's, instead.  shutdown() stops the pool and
+frees the blocks; it also runs at exit.
+
+Filters are given as a module-level function plus its extra arguments
+(e.g. lab.blurred, (5,)) because closures cannot be sent to a worker.
+
+parallel_color_filter instead runs the three channels of a color image at
+the same time: on threads when the filter is a NumPy backend function
+(NumPy releases the GIL in whole-array operations), and otherwise on
+processes sharing the planes in the same way.
+"""
+
+import os
+import sys
+import atexit
+import threading
+from array import array
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import lab
+import tiled
+import backend
+
+# blocks mapped in each worker by worker_views(), by name
+WORKER = {}
+
+# the process pool and the shared blocks ('source' and 'target') kept
+# between calls, used by one call at a time
+POOL = {'executor': None, 'processes': 0}
+BLOCKS = {}
+LOCK = threading.Lock()
+
+
+def integer_typecode(bound):
+    """
+    Return the narrowest array typecode holding integers of absolute value
+    up to bound: 'i' (32 bits) or 'q' (64 bits).
+    """
+    if bound < 2**31 and array('i').itemsize == 4:
+        return 'i'
+    return 'q'
+
+
+def pixel_typecode(pixels):
+    """
+    Return the array typecode used to share the given pixels: 'B' for byte
+    buffers, 'i' or 'q' for other integers and 'd' for anything else.
+    """
+    if isinstance(pixels, (bytes, bytearray)):
+        return 'B'
+    if all(isinstance(p, int) for p in pixels):
+        return integer_typecode(max(map(abs, pixels), default=0))
+    return 'd'
+
+
+def get_pool(processes):
+    """
+    Return the module's process pool, started (or restarted with more
+    workers) so that it has at least the given number of workers.
+    """
+    if POOL['executor'] is None or POOL['processes'] < processes:
+        if POOL['executor'] is not None:
+            POOL['executor'].shutdown()
+        POOL['executor'] = ProcessPoolExecutor(max_workers=processes)
+        POOL['processes'] = processes
+    return POOL['executor']
+
+
+def shutdown():
+    """
+    Stop the module's process pool and free the shared blocks.
+    """
+    if POOL['executor'] is not None:
+        POOL['executor'].shutdown()
+        POOL['executor'] = None
+        POOL['processes'] = 0
+    for role in list(BLOCKS):
+        block = BLOCKS.pop(role)
+        block.close()
+        block.unlink()
+
+
+atexit.register(shutdown)
+
+
+def shared_block(role, size):
+    """
+    Return the shared block for the given role ('source' or 'target'),
+    replaced by a new one if it holds fewer than size bytes.
+    """
+    block = BLOCKS.get(role)
+    if block is None or block.size < size:
+        if block is not None:
+            block.close()
+            block.unlink()
+        block = BLOCKS[role] = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    return block
+
+
+def share(values, typecode):
+    """
+    Copy the values, as the given type, into the shared source block and
+    return it.
+    """
+    data = array(typecode, values)
+    size = len(data)*data.itemsize
+    block = shared_block('source', size)
+    block.buf[:size] = data.tobytes()
+    return block
+
+
+def worker_views(layout):
+    """
+    Worker side: return memoryviews of the shared input and output
+    described by layout, (width, height, source block name, source type,
+    target block name, target type).  Blocks are mapped the first time they
+    are seen, and blocks of earlier calls that have been replaced are
+    unmapped.  The views must be released after use.
+    """
+    width, height, source, source_type, target, target_type = layout
+    blocks = WORKER.setdefault('blocks', {})
+    for name in list(blocks):
+        if name not in (source, target):
+            blocks.pop(name).close()
+    for name in (source, target):
+        if name not in blocks:
+            blocks[name] = shared_memory.SharedMemory(name=name)
+    return blocks[source].buf.cast(source_type), blocks[target].buf.cast(target_type)
+
+
+def run_band(func, args, layout, top, start, stop, bottom):
+    """
+    Worker task: apply func to rows [top, bottom) of the shared input and
+    write rows [start, stop) of its result to the shared output.
+    """
+    w = layout[0]
+    source, target = worker_views(layout)
+    try:
+        band = source[top*w:bottom*w]
+        pixels = bytearray(band) if band.format == 'B' else band.tolist()
+        band.release()
+        band = {'height': bottom - top, 'width': w, 'pixels': pixels}
+        result = tiled.crop_rows(func(band, *args), start - top, stop - top)
+        target[start*w:stop*w] = array(target.format, result['pixels'])
+    finally:
+        source.release()
+        target.release()
+
+
+def run_channel(func, args, layout, k):
+    """
+    Worker task: apply func to channel k of the shared planes (stored one
+    after the other, each a third of the rows of layout) and write its
+    result to the same place in the shared output.
+    """
+    w = layout[0]
+    height = layout[1] // 3
+    n = w*height
+    source, target = worker_views(layout)
+    try:
+        plane = source[k*n:(k+1)*n]
+        pixels = bytearray(plane) if plane.format == 'B' else plane.tolist()
+        plane.release()
+        result = func({'height': height, 'width': w, 'pixels': pixels}, *args)
+        target[k*n:(k+1)*n] = array(target.format, result['pixels'])
+    finally:
+        source.release()
+        target.release()
+
+
+def run_tasks(pool, tasks):
+    """
+    Submit the (function, arguments...) tasks to the pool (the module's
+    pool if pool is None) and wait for all of them.
+    """
+    executor = pool or POOL['executor']
+    try:
+        futures = [executor.submit(*task) for task in tasks]
+        for future in futures:
+            future.result()
+    except BrokenProcessPool:
+        if pool is None:
+            # start a new pool next time
+            POOL['executor'] = None
+            POOL['processes'] = 0
+        raise
+
+
+def parallel_apply(image, func, args, halo, target_type='B', processes=None,
+                   band_height=None, pool=None):
+    """
+    Return func(image, *args) computed in bands on a process pool (the
+    module's, or pool if given).  func must keep the size of the image, and
+    its pixels must fit target_type ('B' for clipped images, 'i', 'q' or 'd'
+    for unclipped correlations).
+    """
+    w = image['width']
+    h = image['height']
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or h < 2:
+        return func(image, *args)
+    if band_height is None:
+        # a few bands per process so that uneven bands even out
+        band_height = max(-(-h // (4*processes)), halo + 1, 1)
+    with LOCK:
+        if pool is None:
+            get_pool(processes)
+        source_type = pixel_typecode(image['pixels'])
+        source = share(image['pixels'], source_type)
+        target = shared_block('target', w*h*array(target_type).itemsize)
+        layout = (w, h, source.name, source_type, target.name, target_type)
+        run_tasks(pool, [(run_band, func, args, layout) + bounds
+                         for bounds in tiled.strip_bounds(h, band_height, halo)])
+        output = target.buf.cast(target_type)[:w*h]
+        if target_type == 'B':
+            pixels = bytearray(output)
+        else:
+            pixels = output.tolist()
+        output.release()
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+
+def parallel_correlate(image, kernel, processes=None, band_height=None, exact=False,
+                       pool=None):
+    """
+    Same as lab.correlate, computed on a process pool.  Integer results are
+    collected in 32-bit integers when the kernel's gain guarantees they fit.
+    """
+    kernel = lab.compile_kernel(kernel)
+    source_type = pixel_typecode(image['pixels'])
+    if source_type != 'd' and kernel['integer']:
+        bound = 255 if source_type == 'B' else max(map(abs, image['pixels']), default=0)
+        target_type = integer_typecode(max(bound, 1)*kernel['gain'])
+    else:
+        target_type = 'd'
+    top, bottom, left, right = kernel['extent']
+    return parallel_apply(image, lab.correlate, (kernel, exact), max(top, bottom),
+                          target_type, processes, band_height, pool)
+
+
+def parallel_blurred(image, n, processes=None, band_height=None, exact=False, pool=None):
+    """
+    Same as lab.blurred, computed on a process pool.
+    """
+    return parallel_apply(image, lab.blurred, (n, None, exact), n//2, 'B',
+                          processes, band_height, pool)
+
+
+def parallel_sharpened(image, n, processes=None, band_height=None, exact=False, pool=None):
+    """
+    Same as lab.sharpened, computed on a process pool.
+    """
+    return parallel_apply(image, lab.sharpened, (n, exact), n//2, 'B', processes,
+                          band_height, pool)
+
+
+def parallel_edges(image, processes=None, band_height=None, pool=None):
+    """
+    Same as lab.edges, computed on a process pool.
+    """
+    return parallel_apply(image, lab.edges, (), 1, 'B', processes, band_height, pool)
+
+
+def parallel_color_filter(func, args=(), mode=None, target_type='B', processes=None,
+                          pool=None):
+    """
+    Return a color filter that applies func(channel, *args) to the three
+    channels at once, like lab.color_filter_from_greyscale_filter.  mode is
+    'thread', 'process' or None to choose: threads for functions of the
+    NumPy backend while it is in use, processes otherwise.  target_type and
+    pool are as for parallel_apply.
+    """
+    if mode is None:
+        mode = 'thread' if func.__module__ == backend.__name__ and backend.use_numpy(None) else 'process'
+    if mode not in ('thread', 'process'):
+        raise ValueError('Unsupported mode: %r' % (mode,))
+
+    def color_filter(im):
+        workers = min(processes or os.cpu_count() or 1, 3)
+        if (mode == 'process' and workers > 1) or getattr(func, 'keeps_input', False):
+            # worker processes get their own copy through shared memory
+            channels = lab.color_planes(im)
+        else:
+            channels = lab.spilt_color(im)
+        if workers == 1:
+            results = [func(c, *args) for c in channels]
+        elif mode == 'thread':
+            with ThreadPoolExecutor(max_workers=workers) as threads:
+                results = list(threads.map(lambda c: func(c, *args), channels))
+        else:
+            results = run_channels(channels, func, args, target_type, workers, pool)
+        return lab.image_from_planes(*results, im)
+    return color_filter
+
+
+def run_channels(channels, func, args, target_type, processes, pool=None):
+    """
+    Apply func to each of the channels on a process pool, through one shared
+    block holding all the channels and one holding all the results.
+    """
+    w = channels[0]['width']
+    h = channels[0]['height']
+    source_type = pixel_typecode(channels[0]['pixels'])
+    if source_type == 'B':
+        values = bytearray().join(c['pixels'] for c in channels)
+    else:
+        values = [p for c in channels for p in c['pixels']]
+    with LOCK:
+        if pool is None:
+            get_pool(processes)
+        source = share(values, source_type)
+        target = shared_block('target', 3*w*h*array(target_type).itemsize)
+        layout = (w, 3*h, source.name, source_type, target.name, target_type)
+        run_tasks(pool, [(run_channel, func, args, layout, k) for k in range(3)])
+        output = target.buf.cast(target_type)[:3*w*h]
+        results = []
+        for k in range(3):
+            plane = output[k*w*h:(k+1)*w*h]
+            pixels = bytearray(plane) if target_type == 'B' else plane.tolist()
+            plane.release()
+            results.append({'height': h, 'width': w, 'pixels': pixels})
+        output.release()
+    return results
+
+
+if __name__ == '__main__':
+    import time
+    image = lab.load_greyscale_image(sys.argv[1])
+    for name, func in (('serial', lambda im: lab.blurred(im, 9)),
+                       ('parallel', lambda im: parallel_blurred(im, 9))):
+        start = time.perf_counter()
+        func(image)
+        print('%-8s %.3fs' % (name, time.perf_counter() - start))
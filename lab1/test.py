@@ -2,10 +2,19 @@
 
 import os
 import lab
+import tiled
+import backend
+import parallel
+import batch
+import cache
 import pickle
 import hashlib
+import tempfile
 import unittest
 import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
 
 TEST_DIRECTORY = os.path.dirname(__file__)
 
@@ -61,6 +70,47 @@ class TestImage(Lab1Test):
         }
         self.compare_color_images(result, expected)
 
+    def test_compact_color_round_trip(self):
+        im = lab.load_color_image('test_images/tree.png')
+        self.assertIsInstance(im['pixels'], lab.ColorPixels)
+        self.assertEqual([len(p) for p in im['pixels'].planes], [im['width']*im['height']]*3)
+        interleaved = im['pixels'].interleaved()
+        self.assertEqual(list(interleaved[:6]), list(im['pixels'][0] + im['pixels'][1]))
+        self.assertEqual(lab.ColorPixels.from_interleaved(interleaved), im['pixels'])
+        as_lists = lab.image_as_lists(im)
+        self.assertTrue(all(isinstance(p, tuple) for p in as_lists['pixels']))
+        self.compare_color_images(lab.compact_image(as_lists), im)
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, 'out.png')
+            lab.save_color_image(as_lists, outfile)
+            self.compare_color_images(lab.load_color_image(outfile), im)
+
+    def test_load_greyscale_matches_float_luma(self):
+        for fname in sorted(os.listdir(os.path.join(TEST_DIRECTORY, 'test_images'))):
+            if not fname.endswith('.png'):
+                continue
+            filename = os.path.join(TEST_DIRECTORY, 'test_images', fname)
+            with self.subTest(f=fname):
+                self.assertEqual(list(lab.load_greyscale_image(filename)['pixels']),
+                                 load_greyscale_image(filename)['pixels'])
+        # every color where .299*r + .587*g + .114*b is exactly halfway
+        # between two integers, and its neighbours
+        by_residue = collections.defaultdict(list)
+        for b in range(256):
+            by_residue[114*b % 1000].append(b)
+        pixels = [(r, g, b+d) for r in range(256) for g in range(256)
+                  for b in by_residue[(500 - 299*r - 587*g) % 1000]
+                  for d in (-1, 0, 1) if 0 <= b+d <= 255]
+        w = len(pixels)
+        im = lab.compact_image({'height': 1, 'width': w, 'pixels': pixels})
+        expected = [round(.299 * r + .587 * g + .114 * b) for r, g, b in pixels]
+        self.assertEqual(list(lab.greyscale_image_from_color_image(im)['pixels']), expected)
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, 'halves.png')
+            lab.save_color_image(im, outfile)
+            self.assertEqual(list(lab.load_greyscale_image(outfile)['pixels']), expected)
+            self.assertEqual(load_greyscale_image(outfile)['pixels'], expected)
+
 class TestColorFilters(Lab1Test):
     def test_color_filter_inverted(self):
         im = lab.load_color_image('test_images/centered_pixel.png')
@@ -127,6 +177,26 @@ class TestColorFilters(Lab1Test):
                     self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
                     self.compare_color_images(result, expected)
 
+    def test_color_filter_does_not_share_planes(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+        oim = object_hash(im)
+        def blacken(grey):
+            lab.set_pixel(grey, 0, 0, 0)
+            return grey
+        def unchanged(grey):
+            return grey
+        unchanged.keeps_input = True
+        for filt in (blacken, unchanged):
+            with self.subTest(filt=filt.__name__):
+                result = lab.color_filter_from_greyscale_filter(filt)(im)
+                self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+                for plane in result['pixels'].planes:
+                    self.assertFalse(any(plane is p for p in im['pixels'].planes))
+        self.assertEqual(lab.get_pixel(result, 0, 0), lab.get_pixel(im, 0, 0))
+        color_filter = parallel.parallel_color_filter(blacken, processes=1)
+        self.assertEqual(lab.get_pixel(color_filter(im), 0, 0), (0, 0, 0))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
     def test_blur_filter_1(self):
         blur_filter = lab.make_blur_filter(3)
         self.assertTrue(callable(blur_filter), 'make_blur_filter should return a function.')
@@ -259,6 +329,308 @@ class TestCascade(Lab1Test):
                 self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
                 self.compare_color_images(result, expected)
 
+    def test_cascade_folding(self):
+        im = lab.load_color_image('test_images/mushroom.png')
+        halve = lab.make_point_filter(lambda c: c//2)
+        color_halve = lab.color_filter_from_greyscale_filter(halve)
+        cascade = [self.color_inverted, color_halve, self.color_edges,
+                   self.color_inverted, self.color_inverted, self.color_blur_5]
+        self.assertEqual(len(lab.fold_point_filters([lab.inverted, halve, lab.edges,
+                                                     lab.inverted, lab.inverted])), 3)
+        plan = lab.plan_cascade([lab.inverted, halve, lab.edges, lab.inverted, lab.inverted])
+        self.assertEqual([count for stage, count in plan], [2, 1, 2])
+        self.assertEqual([count for stage, count in lab.plan_cascade(cascade + [lab.inverted])],
+                         [6, 1])
+        expected = im
+        for filt in cascade:
+            expected = filt(expected)
+        result = lab.filter_cascade(cascade)(im)
+        self.compare_color_images(result, expected)
+        # a cascade of color filters can itself be folded into another one
+        nested = lab.filter_cascade([lab.filter_cascade(cascade[:3]),
+                                     lab.filter_cascade(cascade[3:])])
+        self.assertTrue(hasattr(nested, 'greyscale'))
+        self.compare_color_images(nested(im), expected)
+
+class TestNumpyBackend(Lab1Test):
+    def setUp(self):
+        if 'numpy' not in backend.BACKENDS:
+            self.skipTest('NumPy is not installed')
+
+    def test_color_filters(self):
+        cases = [
+            ('frog', 'edges', backend.edges),
+            ('frog', 'inverted', backend.inverted),
+            ('tree', 'edges', backend.edges),
+            ('tree', 'inverted', backend.inverted),
+            ('cat', 'blurred3', lambda im: backend.blurred(im, 3)),
+            ('mushroom', 'blurred5', lambda im: backend.blurred(im, 5)),
+            ('construct', 'sharpened3', lambda im: backend.sharpened(im, 3)),
+            ('bluegill', 'sharpened5', lambda im: backend.sharpened(im, 5)),
+        ]
+        for fname, result_name, filt in cases:
+            with self.subTest(f=fname, filt=result_name):
+                inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+                expfile = os.path.join(TEST_DIRECTORY, 'test_results', f'{fname}_{result_name}.png')
+                im = lab.load_color_image(inpfile)
+                oim = object_hash(im)
+                color_filt = backend.color_filter_from_greyscale_filter(filt, 'numpy')
+                result = color_filt(im)
+                self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+                self.compare_color_images(result, lab.load_color_image(expfile))
+
+    def test_matches_python(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+        kernels = ([[0, -1, 0], [-1, 5, -1], [0, -1, 0]],
+                   [[1, 2, 1], [2, 4, 2], [1, 2, 1]],
+                   [[.1, .2, .1], [.2, .4, .2], [.1, .2, .1]],
+                   [[0.3]*3]*3,
+                   lab.box_blur(6))
+        for kernel in kernels:
+            self.assertEqual(backend.correlate(im, kernel, 'numpy')['pixels'],
+                             backend.correlate(im, kernel, 'python')['pixels'])
+        for n in (1, 2, 6, 9):
+            self.compare_greyscale_images(backend.blurred(im, n, 'numpy'), lab.blurred(im, n))
+            self.compare_greyscale_images(backend.sharpened(im, n, 'numpy'), lab.sharpened(im, n))
+            self.compare_greyscale_images(backend.blurred(im, n, 'numpy', exact=True),
+                                          lab.blurred(im, n, exact=True))
+            self.compare_greyscale_images(backend.sharpened(im, n, 'numpy', exact=True),
+                                          lab.sharpened(im, n, True))
+        self.assertEqual(backend.correlate(im, lab.box_blur(4), 'numpy', exact=True)['pixels'],
+                         lab.correlate(im, lab.box_blur(4), exact=True)['pixels'])
+        # a box of 0.3 is not 1/d, so it is summed tap by tap
+        result = backend.correlate_box_array(backend.to_array(im), 3, 0.3)
+        self.assertEqual(result.ravel().tolist(), lab.correlate_general(im, [[0.3]*3]*3)['pixels'])
+        # byte pixels and small integer kernels are summed in 32 bits
+        self.assertEqual(backend.correlate_array(backend.to_array(im), kernels[0]).dtype,
+                         backend.numpy.int32)
+
+
+class TestTiled(Lab1Test):
+    def test_apply_in_strips(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+        for filt, halo in ((lab.make_blur_filter(5), 2),
+                           (lab.make_sharpen_filter(4), 2),
+                           (lab.edges, 1),
+                           (lab.filter_cascade([lab.edges, lab.make_blur_filter(3)]), 2)):
+            color_filter = lab.color_filter_from_greyscale_filter(filt)
+            for strip_height in (1, 7, 1000):
+                with self.subTest(halo=halo, strip_height=strip_height):
+                    result = tiled.apply_in_strips(im, color_filter, halo, strip_height)
+                    self.compare_color_images(result, color_filter(im))
+
+    def test_process_in_strips(self):
+        inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'frog.png')
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, 'out.png')
+            tiled.process_in_strips(inpfile, outfile, lab.edges, 1, strip_height=10)
+            expected = lab.edges(lab.load_greyscale_image(inpfile))
+            self.compare_greyscale_images(lab.load_greyscale_image(outfile), expected)
+            color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+            tiled.process_in_strips(inpfile, outfile, color_blur, 1, strip_height=9, color=True)
+            self.compare_color_images(lab.load_color_image(outfile), color_blur(lab.load_color_image(inpfile)))
+
+    def test_streamed_formats(self):
+        img = Image.open(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png')).convert('RGB')
+        sources = {'rgb.png': img, 'grey.png': img.convert('L'), 'palette.png': img.quantize(64),
+                   'rgba.png': img.convert('RGBA'), 'rgb.ppm': img, 'grey.pgm': img.convert('L')}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, source in sources.items():
+                inpfile = os.path.join(tmp, name)
+                source.save(inpfile)
+                with self.subTest(f=name):
+                    # rows come back in pieces exactly as PIL decodes them whole
+                    with open(inpfile, 'rb') as f:
+                        reader = tiled.row_reader(f)
+                        self.assertNotEqual(reader['read'].__qualname__.split('.')[0], 'pil_row_reader')
+                        pieces = [reader['read'](k) for k in (1, 6, img.height - 7)]
+                    whole = Image.open(inpfile)
+                    self.assertEqual(b''.join(p.tobytes() for p in pieces), whole.tobytes())
+                    filt = lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(5))
+                    for outname in ('out.png', 'out.ppm', 'out.bmp'):
+                        outfile = os.path.join(tmp, outname)
+                        tiled.process_in_strips(inpfile, outfile, filt, 2, strip_height=8, color=True)
+                        self.compare_color_images(lab.load_color_image(outfile),
+                                                  filt(lab.load_color_image(inpfile)))
+
+    def test_empty_input(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            inpfile = os.path.join(tmp, 'empty.pgm')
+            with open(inpfile, 'wb') as f:
+                f.write(b'P5\n4 0\n255\n')
+            outfile = os.path.join(tmp, 'out.png')
+            with self.assertRaises(ValueError):
+                tiled.process_in_strips(inpfile, outfile, lab.inverted, 0)
+            self.assertFalse(os.path.exists(outfile))
+
+
+class TestParallel(Lab1Test):
+    def test_parallel_filters(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+        oim = object_hash(im)
+        kernel = [[0, -1, 0],
+                  [-1, 5, -1],
+                  [0, -1, 0]]
+        cases = [
+            (parallel.parallel_blurred(im, 5, 2, 7), lab.blurred(im, 5)),
+            (parallel.parallel_sharpened(im, 3, 2, 7), lab.sharpened(im, 3)),
+            (parallel.parallel_edges(im, 2, 7), lab.edges(im)),
+            (parallel.parallel_correlate(im, kernel, 2, 7), lab.correlate(im, kernel)),
+        ]
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+        for result, expected in cases:
+            self.compare_greyscale_images(result, expected)
+        result = parallel.parallel_correlate(im, lab.box_blur(3), 2, 7)
+        self.assertEqual(result['pixels'], lab.correlate(im, lab.box_blur(3))['pixels'])
+        result = parallel.parallel_blurred(im, 4, 2, 7, exact=True)
+        self.compare_greyscale_images(result, lab.blurred(im, 4, exact=True))
+        # an integer box kernel keeps integer results in exact mode
+        kernel = [[1]*3]*3
+        result = parallel.parallel_correlate(im, kernel, 2, 7, exact=True)
+        self.assertEqual(result['pixels'], lab.correlate(im, kernel)['pixels'])
+        self.assertEqual(lab.correlate(im, kernel, exact=True)['pixels'], result['pixels'])
+        self.assertTrue(all(isinstance(p, int) for p in result['pixels']))
+
+    def test_parallel_color_filter(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        oim = object_hash(im)
+        expected = lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(3))(im)
+        for mode in ('process', 'thread'):
+            with self.subTest(mode=mode):
+                filt = parallel.parallel_color_filter(lab.sharpened, (3,), mode, processes=3)
+                self.compare_color_images(filt(im), expected)
+        # unclipped channels come back as lists of tuples
+        kernel = [[0, 1, 0], [1, -4, 1], [0, 1, 0]]
+        filt = parallel.parallel_color_filter(lab.correlate, (kernel,), 'process', 'q', processes=3)
+        expected = lab.color_filter_from_greyscale_filter(lambda c: lab.correlate(c, kernel))(im)
+        self.assertEqual(list(filt(im)['pixels']), list(expected['pixels']))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_parallel_pool(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+        expected = lab.blurred(im, 3)
+        self.compare_greyscale_images(parallel.parallel_blurred(im, 3, 2, 2), expected)
+        executor = parallel.POOL['executor']
+        source = parallel.BLOCKS['source']
+        # later calls reuse the pool and the shared blocks
+        self.compare_greyscale_images(parallel.parallel_edges(im, 2, 2), lab.edges(im))
+        self.compare_greyscale_images(parallel.parallel_blurred(im, 3, 2, 3), expected)
+        self.assertIs(parallel.POOL['executor'], executor)
+        self.assertIs(parallel.BLOCKS['source'], source)
+        # or run on the caller's own executor
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            for n in (3, 5):
+                result = parallel.parallel_blurred(im, n, 2, 2, pool=pool)
+                self.compare_greyscale_images(result, lab.blurred(im, n))
+        self.assertIs(parallel.POOL['executor'], executor)
+
+
+class TestBatch(Lab1Test):
+    def test_batch(self):
+        sources = [os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % f)
+                   for f in ('smallfrog', 'centered_pixel')]
+        spec = 'blur 3,invert, threshold 40 200, seam 2'
+        self.assertEqual(batch.format_spec(batch.parse_spec(spec)),
+                         'blur 3, invert, threshold 40 200, seam 2')
+        for bad in ('blur', 'blur x', 'unknown 3', 'invert,,edges'):
+            with self.assertRaises(ValueError):
+                batch.parse_spec(bad)
+        with self.assertRaises(ValueError):
+            batch.build_filter(batch.parse_spec('seam 2'), color=False)
+        color = lab.color_filter_from_greyscale_filter
+        filt = lab.filter_cascade([color(lab.make_blur_filter(3)), color(lab.inverted),
+                                   lambda im: lab.threshold(im, 40, 200),
+                                   lambda im: lab.seam_carving(im, 2)])
+        with tempfile.TemporaryDirectory() as tmp:
+            for jobs in (1, 2):
+                with self.subTest(jobs=jobs):
+                    results, elapsed = batch.run_batch(sources, tmp, spec, jobs=jobs, force=True)
+                    self.assertEqual(sorted(r['status'] for r in results), ['done', 'done'])
+                    for source in sources:
+                        out = os.path.join(tmp, os.path.basename(source))
+                        self.compare_color_images(lab.load_color_image(out),
+                                                  filt(lab.load_color_image(source)))
+            # up to date outputs are skipped, until the filter changes
+            results, elapsed = batch.run_batch(sources, tmp, spec, jobs=1)
+            self.assertEqual([r['status'] for r in results], ['skipped', 'skipped'])
+            results, elapsed = batch.run_batch(sources, tmp, 'edges', color=False, jobs=1)
+            self.assertEqual([r['status'] for r in results], ['done', 'done'])
+            out = os.path.join(tmp, 'smallfrog.png')
+            self.compare_greyscale_images(lab.load_greyscale_image(out),
+                                          lab.edges(lab.load_greyscale_image(sources[0])))
+            totals = batch.summary(results, elapsed)
+            self.assertEqual((totals['done'], totals['skipped'], totals['failed']), (2, 0, 0))
+            # writing into the directory of the inputs would overwrite them
+            source = os.path.join(tmp, 'smallfrog.png')
+            before = lab.load_greyscale_image(source)
+            with self.assertRaises(ValueError):
+                batch.run_batch([source], tmp, 'invert', color=False, jobs=1)
+            with self.assertRaises(ValueError):
+                batch.run_batch([source], os.path.join(tmp, '.', ''), 'invert', color=False, jobs=1)
+            self.assertEqual(lab.load_greyscale_image(source), before)
+
+
+class TestCache(Lab1Test):
+    def test_cached_results(self):
+        im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'tree.png'))
+        oim = object_hash(im)
+        with tempfile.TemporaryDirectory() as tmp:
+            c = cache.open_cache(tmp)
+            for i in range(2):
+                self.compare_greyscale_images(cache.cached(c, lab.blurred, im, 5), lab.blurred(im, 5))
+            self.assertEqual((c['hits'], c['misses']), (1, 1))
+            # the same pixels stored as a list are the same image
+            self.compare_greyscale_images(cache.cached(c, lab.blurred, lab.image_as_lists(im), 5),
+                                          lab.blurred(im, 5))
+            self.assertEqual(c['hits'], 2)
+            cache.cached(c, lab.blurred, im, 3)
+            self.assertEqual(c['hits'], 2)
+            # results that are not bytes are stored as raw values too
+            kernel = [[0, 1, 0], [1, -4, 1], [0, 1, 0]]
+            for i in range(2):
+                self.assertEqual(cache.cached(c, lab.correlate, im, kernel),
+                                 lab.correlate(im, kernel))
+            self.assertEqual(c['hits'], 3)
+            # anything else in an entry file is a miss, never loaded
+            key = cache.result_key(cache.image_digest(im), 'lab.blurred(5,)')
+            for path, size, mtime in cache.cache_entries(c):
+                with open(path, 'wb') as f:
+                    f.write(b'\x80\x04garbage')
+            self.assertIsNone(cache.cache_get(c, key))
+            self.compare_greyscale_images(cache.cached(c, lab.blurred, im, 5), lab.blurred(im, 5))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_cascade_prefixes(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        with tempfile.TemporaryDirectory() as tmp:
+            c = cache.open_cache(tmp)
+            def cascade(spec):
+                return cache.cached_cascade(c, batch.named_steps(batch.parse_spec(spec)))
+            for spec in ('blur 3, invert, seam 2', 'blur 3, invert, edges'):
+                expected = batch.build_filter(batch.parse_spec(spec))(im)
+                with self.subTest(spec=spec):
+                    self.compare_color_images(cascade(spec)(im), expected)
+                    self.compare_color_images(cascade(spec)(im), expected)
+            # 'blur 3, invert' ran as one planned stage (one color split), so
+            # only its result was stored, and the second cascade started from it
+            digest = cache.image_digest(im)
+            stored = [name for name in ('blur 3', 'blur 3, invert', 'blur 3, invert, seam 2',
+                                        'blur 3, invert, edges')
+                      if os.path.exists(cache.entry_path(c, cache.result_key(digest, name)))]
+            self.assertEqual(stored, ['blur 3, invert', 'blur 3, invert, seam 2',
+                                      'blur 3, invert, edges'])
+            self.assertEqual(len(cache.cache_entries(c)), 3)
+            # least recently used entries go first
+            small = cache.open_cache(tmp, c['size'] // 2)
+            cascade('blur 3, invert, edges')(im)
+            cache.evict(small)
+            self.assertLessEqual(small['size'], c['size'] // 2)
+            c = small
+            self.compare_color_images(cascade('blur 3, invert, edges')(im),
+                                      batch.build_filter(batch.parse_spec('blur 3, invert, edges'))(im))
+            self.assertEqual(c['misses'], 0)
+
+
 class TestSeamCarvingHelpers(Lab1Test):
     def test_greyscale(self):
         for fname in ('pattern', 'smallfrog', 'bluegill', 'twocats', 'tree'):
@@ -324,7 +696,22 @@ class TestSeamCarvingHelpers(Lab1Test):
         result = lab.minimum_energy_seam(im)
         self.assertEqual(len(result), len(seam))
         self.assertEqual(set(result), set(seam))
-            
+
+    def test_min_seam_from_parents(self):
+        for fname in ('pattern', 'smallfrog', 'bluegill', 'twocats', 'tree'):
+            infile = os.path.join(TEST_DIRECTORY, 'test_results', f'{fname}_energy.pickle')
+            with open(infile, 'rb') as f:
+                energy = pickle.load(f)
+            cem, parents = lab.cumulative_energy_with_parents(energy)
+            expfile = os.path.join(TEST_DIRECTORY, 'test_results', f'{fname}_minimum_energy_seam.pickle')
+            with open(expfile, 'rb') as f:
+                seam = pickle.load(f)
+            with self.subTest(f=fname):
+                self.assertEqual(cem, lab.cumulative_energy_map(energy))
+                result = lab.minimum_energy_seam(cem, parents)
+                self.assertEqual(result, lab.minimum_energy_seam(cem))
+                self.assertEqual(set(result), set(seam))
+
     def test_seam_removal(self):
         for fname in ('pattern', 'bluegill', 'twocats', 'tree'):
             infile = os.path.join(TEST_DIRECTORY, 'test_results', f'{fname}_minimum_energy_seam.pickle')
@@ -338,6 +725,20 @@ class TestSeamCarvingHelpers(Lab1Test):
 
             self.compare_color_images(result, lab.load_color_image(expfile))
 
+    def test_batch_seam_removal(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'bluegill.png'))
+        oim = object_hash(im)
+        seams = []
+        expected = im
+        for i in range(6):
+            energy = lab.compute_energy(lab.greyscale_image_from_color_image(expected))
+            seam = lab.minimum_energy_seam(lab.cumulative_energy_map(energy))
+            seams.append(seam)
+            expected = lab.image_without_seam(expected, seam)
+        self.compare_color_images(lab.image_without_seams(im, seams), expected)
+        self.compare_color_images(lab.image_without_seams(lab.image_as_lists(im), seams), expected)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
 
 class TestSeamCarving(Lab1Test):
     def test_endtoend_centeredpixel(self):
@@ -390,6 +791,114 @@ class TestSeamCarving(Lab1Test):
         result = lab.seam_carving(im, 100)
         lab.save_color_image(result, '/Users/yaxinliu/Downloads/lab1/Seam.png')
 
+    def test_incremental_matches_step_by_step(self):
+        for fname, ncols in (('bluegill', 8), ('smallfrog', 49)):
+            im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png'))
+            oim = object_hash(im)
+            expected = im
+            for i in range(ncols):
+                expected = lab.seam_carving_step(expected)
+            with self.subTest(f=fname):
+                self.compare_color_images(lab.seam_carving(im, ncols), expected)
+                self.compare_color_images(lab.seam_carving(lab.image_as_lists(im), ncols), expected)
+                self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_carve_to_one_column(self):
+        im = {'height': 3, 'width': 3,
+              'pixels': [(i*37 % 256, i*11 % 256, i*5 % 256) for i in range(9)]}
+        expected = {'height': 3, 'width': 1,
+                    'pixels': [(37, 11, 5), (148, 44, 20), (222, 66, 30)]}
+        self.compare_color_images(lab.seam_carving(im, 2), expected)
+        # at least one column must be left
+        for ncols in (3, 4):
+            with self.assertRaises(ValueError):
+                lab.seam_carving(im, ncols)
+        column = {'height': 3, 'width': 1, 'pixels': [(200, 200, 200), (0, 0, 0), (200, 200, 200)]}
+        self.compare_color_images(lab.seam_carving(column, 0), column)
+        with self.assertRaises(ValueError):
+            lab.seam_carving(column, 1)
+        with self.assertRaises(ValueError):
+            lab.seam_carving_step(column)
+
+    def test_horizontal_seams(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        oim = object_hash(im)
+        expected = lab.transposed(im)
+        for i in range(5):
+            expected = lab.seam_carving_step(expected)
+        expected = lab.transposed(expected)
+        self.compare_color_images(lab.seam_carving_rows(im, 5), expected)
+        self.compare_color_images(lab.transposed(lab.transposed(im)), im)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_seam_insertion(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        oim = object_hash(im)
+        result = lab.seam_insertion(im, 7)
+        self.assertEqual((result['width'], result['height']), (im['width']+7, im['height']))
+        # removing the seams that were duplicated gives back the original
+        seams = lab.seam_indices(im, 7)
+        self.assertEqual(len(seams), 7*im['height'])
+        kept = []
+        for y in range(im['height']):
+            columns = sorted(i % im['width'] for i in seams if i // im['width'] == y)
+            # the j-th inserted pixel of a row lands right after column columns[j]
+            inserted = {x + j + 1 for j, x in enumerate(columns)}
+            row = lab.image_as_lists(result)['pixels'][y*result['width']:(y+1)*result['width']]
+            kept.extend(p for x, p in enumerate(row) if x not in inserted)
+        self.assertEqual(kept, list(im['pixels']))
+        # more columns than the width are inserted in several rounds
+        wide = lab.seam_insertion(im, 2*im['width'])
+        self.assertEqual(wide['width'], 3*im['width'])
+        resized = lab.content_aware_resize(im, im['width']+3, im['height']-4)
+        self.assertEqual((resized['width'], resized['height']), (im['width']+3, im['height']-4))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_pyramid_seam_carving(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'bluegill.png'))
+        oim = object_hash(im)
+        exact = lab.seam_carving(im, 6)
+        self.compare_color_images(lab.pyramid_seam_carving(im, 6, 0), exact)
+        # a band covering the whole image finds the exact seams
+        self.compare_color_images(lab.pyramid_seam_carving(im, 6, 1, im['width']), exact)
+        for levels in (1, 2, 3):
+            result = lab.pyramid_seam_carving(im, 6, levels)
+            self.assertEqual((result['width'], result['height']), (exact['width'], exact['height']))
+            removed = lab.pyramid_seam_indices(im, 6, levels)
+            self.assertEqual(len(set(removed)), 6*im['height'])
+            # one pixel from every row for every seam
+            self.assertEqual(sorted(i // im['width'] for i in removed),
+                             sorted(list(range(im['height']))*6))
+        with self.assertRaises(ValueError):
+            lab.pyramid_seam_carving(im, im['width'], 2)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_seam_energies(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        oim = object_hash(im)
+        self.compare_color_images(lab.seam_carving(im, 4, 'sobel'), lab.seam_carving(im, 4))
+        w, h = im['width'], im['height']
+        protect = {'height': h, 'width': w, 'pixels': bytearray(w*h)}
+        for y in range(h):
+            protect['pixels'][y*w + w//2] = 1
+        for name in ('sobel', 'gradient', 'forward'):
+            with self.subTest(energy=name):
+                # the incrementally updated state matches a fresh carver
+                carver = lab.make_seam_carver(im, energy=name)
+                for i in range(5):
+                    lab.carver_remove_seam(carver, lab.carver_seam(carver))
+                    fresh = lab.make_seam_carver(lab.carver_image(carver), energy=name)
+                    self.assertEqual([list(row) for row in carver['energy']],
+                                     [list(row) for row in fresh['energy']])
+                    self.assertEqual(carver['cumulative'], fresh['cumulative'])
+                # seams never go through protected pixels
+                energy = lab.masked_energy(name, protect=protect)
+                removed = lab.seam_indices(im, 5, energy)
+                self.assertFalse(any(i % w == w//2 for i in removed))
+        with self.assertRaises(ValueError):
+            lab.seam_carving(im, 1, 'nonsense')
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
 class TestCreativeFilter(Lab1Test):
     def test_endtoend_centeredpixel(self):
         im = lab.load_color_image('test_images/centered_pixel.png')
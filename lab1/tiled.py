@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+
+"""
+Apply lab filters to an image one horizontal strip at a time.
+
+Each strip is read together with `halo` extra rows above and below it (the
+kernel radius of the filter: n//2 for blurred/sharpened with size n, 1 for
+edges, 0 for inverted, and the sum of these for a cascade), filtered, and
+only its own rows are kept.  Rows of a strip that touch the real top or
+bottom of the image are extended exactly as in the whole-image filter, and
+the halo covers every other row a kept pixel depends on, so the output is
+identical to filtering the whole image at once.
+
+process_in_strips reads and writes files a strip at a time as well, so
+for the formats below only a few strips are ever in memory, however tall
+the image is:
+
+  * 8-bit non-interlaced PNGs are read by inflating the image data one
+    strip of scanlines at a time and having PIL decode each strip as a
+    small PNG of its own (its first row preceded by the last row of the
+    previous strip, which the PNG row filters may refer to).  Binary
+    PGM/PPM files are read row by row directly.  Any other file
+    (including 16-bit and interlaced PNGs) is decoded whole by PIL, in its
+    packed form (one byte per channel).
+  * .png outputs are written by a streaming PNG encoder and .pgm/.ppm/.pnm
+    outputs as raw rows, each strip as soon as it is filtered.  Other
+    formats are assembled in a PIL image and saved at the end.
+"""
+
+import io
+import os
+import sys
+import zlib
+import struct
+import argparse
+
+from PIL import Image
+
+import lab
+
+
+def strip_bounds(height, strip_height, halo):
+    """
+    Yield (top, start, stop, bottom) for every strip: the strip covers rows
+    [start, stop) and is read with its halo as rows [top, bottom).
+    """
+    for start in range(0, height, strip_height):
+        stop = min(start + strip_height, height)
+        yield max(start - halo, 0), start, stop, min(stop + halo, height)
+
+
+def crop_rows(image, start, stop):
+    """
+    Return a new image made of rows [start, stop) of the given image.
+    """
+    w = image['width']
+    pixels = image['pixels']
+    if isinstance(pixels, lab.ColorPixels):
+        rows = lab.ColorPixels(*[plane[w*start:w*stop] for plane in pixels.planes])
+    else:
+        rows = pixels[w*start:w*stop]
+    return {'height': stop - start, 'width': w, 'pixels': rows}
+
+
+def apply_in_strips(image, filt, halo, strip_height=64):
+    """
+    Apply filt to an in-memory image strip by strip and return the result.
+    filt may change the width of the image but not its height.
+    """
+    strips = []
+    for top, start, stop, bottom in strip_bounds(image['height'], strip_height, halo):
+        result = filt(crop_rows(image, top, bottom))
+        strips.append(crop_rows(result, start - top, stop - top))
+    return join_rows(strips)
+
+
+def join_rows(strips):
+    """
+    Stack images of the same width on top of each other.
+    """
+    first = strips[0]['pixels']
+    if isinstance(first, lab.ColorPixels):
+        pixels = lab.ColorPixels(*[bytearray().join(s['pixels'].planes[k] for s in strips)
+                                   for k in range(3)])
+    elif isinstance(first, (bytes, bytearray)):
+        pixels = bytearray().join(s['pixels'] for s in strips)
+    else:
+        pixels = [p for s in strips for p in s['pixels']]
+    return {'height': sum(s['height'] for s in strips),
+            'width': strips[0]['width'], 'pixels': pixels}
+
+
+def process_in_strips(infile, outfile, filt, halo, strip_height=64, color=False):
+    """
+    Read the image in infile strip by strip, apply filt to each strip (as a
+    color image if color is True, and as a greyscale image otherwise), and
+    write the result to outfile, a strip at a time (see the module
+    docstring for the formats this works for).  An image with no rows
+    raises ValueError, and outfile is not written.
+    """
+    if color:
+        from_pil, to_pil = lab.color_image_from_pil, lab.pil_from_color_image
+    else:
+        from_pil, to_pil = lab.greyscale_image_from_pil, lab.pil_from_greyscale_image
+    writer = None
+    with open(infile, 'rb') as img_handle:
+        reader = row_reader(img_handle)
+        w, h = reader['size']
+        if h == 0:
+            raise ValueError('%s has no rows' % infile)
+        # rows [window_top, window_top + window height) of the source
+        window = None
+        window_top = 0
+        for top, start, stop, bottom in strip_bounds(h, strip_height, halo):
+            if window is not None:
+                window = crop_rows(window, top - window_top, window['height'])
+                window_top = top
+            have = window_top + (window['height'] if window is not None else 0)
+            if bottom > have:
+                rows = from_pil(reader['read'](bottom - have))
+                window = rows if window is None else join_rows([window, rows])
+            strip = crop_rows(window, 0, bottom - top)
+            result = crop_rows(filt(strip), start - top, stop - top)
+            if writer is None:
+                writer = row_writer(outfile, result['width'], h, color)
+            piece = to_pil(result)
+            writer['write'](piece.tobytes())
+            piece.close()
+    writer['close']()
+
+
+# READING ROWS
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# bytes per pixel of 8-bit PNGs, by color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def row_reader(f):
+    """
+    Return a reader of the image in the binary file f: a dictionary with
+    'size', the (width, height) of the image, and 'read', a function
+    returning the next count rows as a PIL image.
+    """
+    for open_rows in (png_row_reader, pnm_row_reader):
+        f.seek(0)
+        reader = open_rows(f)
+        if reader is not None:
+            return reader
+    f.seek(0)
+    return pil_row_reader(f)
+
+
+def png_chunk(kind, data):
+    """
+    Return a PNG chunk of the given kind (4 bytes) and data.
+    """
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data)))
+
+
+def read_png_chunk(f):
+    """
+    Return the kind and data of the next PNG chunk in f.
+    """
+    header = f.read(8)
+    if len(header) < 8:
+        raise ValueError('Truncated PNG file')
+    length, kind = struct.unpack('>I4s', header)
+    data = f.read(length)
+    f.read(4)  # CRC
+    return kind, data
+
+
+def png_row_reader(f):
+    """
+    Return a row reader (see row_reader) for an 8-bit, non-interlaced PNG
+    in f, or None if f holds anything else.
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        return None
+    kind, header = read_png_chunk(f)
+    if kind != b'IHDR' or len(header) != 13:
+        return None
+    w, h, depth, color_type, compression, filter_method, interlace = struct.unpack('>IIBBBBB', header)
+    if depth != 8 or interlace or color_type not in PNG_CHANNELS:
+        return None
+    # chunks needed to decode the rows
+    extra = []
+    while True:
+        kind, data = read_png_chunk(f)
+        if kind == b'IDAT':
+            break
+        if kind == b'IEND':
+            raise ValueError('PNG file without image data')
+        if kind in (b'PLTE', b'tRNS'):
+            extra.append(png_chunk(kind, data))
+    line = w*PNG_CHANNELS[color_type]
+    state = {'input': data, 'previous': None}
+    inflate = zlib.decompressobj()
+
+    def scanlines(count):
+        # the next count filtered scanlines (each a filter type byte and a row)
+        need = count*(line + 1)
+        out = []
+        size = 0
+        while size < need:
+            if not state['input']:
+                kind, data = read_png_chunk(f)
+                if kind != b'IDAT':
+                    raise ValueError('Truncated PNG image data')
+                state['input'] = data
+            chunk = inflate.decompress(state['input'], need - size)
+            state['input'] = inflate.unconsumed_tail
+            out.append(chunk)
+            size += len(chunk)
+        return b''.join(out)
+
+    def read(count):
+        raw = scanlines(count)
+        previous = state['previous']
+        height = count
+        if previous is not None:
+            raw = b'\0' + previous + raw
+            height += 1
+        strip = (PNG_SIGNATURE +
+                 png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, height, 8, color_type, 0, 0, 0)) +
+                 b''.join(extra) + png_chunk(b'IDAT', zlib.compress(raw, 1)) +
+                 png_chunk(b'IEND', b''))
+        img = Image.open(io.BytesIO(strip))
+        img.load()
+        state['previous'] = img.crop((0, height-1, w, height)).tobytes()
+        if previous is not None:
+            img = img.crop((0, 1, w, height))
+        return img
+
+    return {'size': (w, h), 'read': read}
+
+
+def pnm_row_reader(f):
+    """
+    Return a row reader (see row_reader) for a binary 8-bit PGM or PPM
+    file in f, or None if f holds anything else.
+    """
+    magic = f.read(2)
+    if magic not in (b'P5', b'P6'):
+        return None
+    # width, height and maximum value, separated by whitespace and comments
+    fields = []
+    c = f.read(1)
+    while len(fields) < 3:
+        if c == b'#':
+            f.readline()
+            c = f.read(1)
+        elif c.isspace():
+            c = f.read(1)
+        elif c.isdigit():
+            digits = b''
+            while c.isdigit():
+                digits += c
+                c = f.read(1)
+            fields.append(int(digits))
+        else:
+            return None
+    # a single whitespace character (already read) ends the header
+    w, h, maxval = fields
+    if maxval != 255:
+        return None
+    mode = 'L' if magic == b'P5' else 'RGB'
+    line = w*len(mode)
+
+    def read(count):
+        data = f.read(count*line)
+        if len(data) < count*line:
+            raise ValueError('Truncated PNM file')
+        return Image.frombytes(mode, (w, count), data)
+
+    return {'size': (w, h), 'read': read}
+
+
+def pil_row_reader(f):
+    """
+    Return a row reader (see row_reader) that decodes the whole image in f
+    with PIL.
+    """
+    img = Image.open(f)
+    img.load()
+    state = {'row': 0}
+
+    def read(count):
+        top = state['row']
+        state['row'] += count
+        return img.crop((0, top, img.width, top + count))
+
+    return {'size': img.size, 'read': read}
+
+
+# WRITING ROWS
+
+def row_writer(filename, width, height, color):
+    """
+    Return a writer of an image of the given size (color, or greyscale if
+    color is False) to filename: a dictionary with 'write', a function
+    taking the next rows as bytes (one byte per channel, as PIL's tobytes
+    gives them), and 'close', to call once every row is written.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.png':
+        return png_row_writer(filename, width, height, color)
+    if extension in ('.pgm', '.ppm', '.pnm'):
+        return pnm_row_writer(filename, width, height, color)
+    return pil_row_writer(filename, width, height, color)
+
+
+def png_row_writer(filename, width, height, color):
+    """
+    Return a row writer (see row_writer) that compresses the rows into a
+    PNG file as they come.
+    """
+    f = open(filename, 'wb')
+    f.write(PNG_SIGNATURE + png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, 8, 2 if color else 0, 0, 0, 0)))
+    line = width*(3 if color else 1)
+    deflate = zlib.compressobj()
+
+    def write(rows):
+        # every scanline with filter type 0 (none)
+        data = bytearray()
+        for start in range(0, len(rows), line):
+            data += b'\0'
+            data += rows[start:start+line]
+        compressed = deflate.compress(bytes(data))
+        if compressed:
+            f.write(png_chunk(b'IDAT', compressed))
+
+    def close():
+        f.write(png_chunk(b'IDAT', deflate.flush()))
+        f.write(png_chunk(b'IEND', b''))
+        f.close()
+
+    return {'write': write, 'close': close}
+
+
+def pnm_row_writer(filename, width, height, color):
+    """
+    Return a row writer (see row_writer) for a binary PPM (color) or PGM
+    (greyscale) file.
+    """
+    f = open(filename, 'wb')
+    f.write(b'%s\n%d %d\n255\n' % (b'P6' if color else b'P5', width, height))
+    return {'write': f.write, 'close': f.close}
+
+
+def pil_row_writer(filename, width, height, color):
+    """
+    Return a row writer (see row_writer) that collects the rows in a PIL
+    image and saves it, in the format given by the extension of filename,
+    when it is closed.
+    """
+    mode = 'RGB' if color else 'L'
+    out = Image.new(mode, (width, height))
+    state = {'row': 0}
+
+    def write(rows):
+        count = len(rows) // (width*len(mode))
+        piece = Image.frombytes(mode, (width, count), rows)
+        out.paste(piece, (0, state['row']))
+        state['row'] += count
+
+    def close():
+        out.save(filename)
+        out.close()
+
+    return {'write': write, 'close': close}
+
+
+FILTERS = {
+    'invert': (lambda n: lab.inverted, lambda n: 0),
+    'blur': (lab.make_blur_filter, lambda n: n//2),
+    'sharpen': (lab.make_sharpen_filter, lambda n: n//2),
+    'edges': (lambda n: lab.edges, lambda n: 1),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Filter an image strip by strip to bound memory use.')
+    parser.add_argument('infile')
+    parser.add_argument('outfile')
+    parser.add_argument('filter', choices=sorted(FILTERS))
+    parser.add_argument('n', type=int, nargs='?', default=3,
+                        help='kernel size for blur and sharpen')
+    parser.add_argument('--strip-height', type=int, default=64)
+    parser.add_argument('--color', action='store_true')
+    args = parser.parse_args(argv)
+    make_filter, halo = FILTERS[args.filter]
+    filt = make_filter(args.n)
+    if args.color:
+        filt = lab.color_filter_from_greyscale_filter(filt)
+    process_in_strips(args.infile, args.outfile, filt, halo(args.n),
+                      args.strip_height, args.color)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())